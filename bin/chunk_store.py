@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+from prettytable import PrettyTable
+from hol.library.chunks import ChunkStore
+from hol.ovf import BYTES_PER_GB
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+COMMANDS = ('ingest', 'pack', 'materialize', 'report', 'gc', 'chunks', 'missing')
+
+
+def library_templates(repository):
+    return sorted(name for name in os.listdir(repository)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(repository, name)))
+
+
+def print_report(report, store_bytes):
+    table = PrettyTable(['Template', 'Files', 'Packed', 'Logical (GB)', 'Stored (GB)', 'Unique (GB)', 'Shared (GB)',
+                         'Effective (GB)', 'Dedupe'])
+    table.align = 'l'
+    logical = 0
+    for t in report:
+        logical += t['logical_bytes']
+        table.add_row([t['template'], t['files'], t['packed'], round(t['logical_bytes'] / BYTES_PER_GB, 2),
+                       round(t['stored_bytes'] / BYTES_PER_GB, 2), round(t['unique_bytes'] / BYTES_PER_GB, 2),
+                       round(t['shared_bytes'] / BYTES_PER_GB, 2),
+                       round(t['effective_bytes'] / BYTES_PER_GB, 2), f"{t['ratio']}x" if t['ratio'] else ''])
+    print(table)
+    if store_bytes:
+        print(f'{logical / BYTES_PER_GB:.2f} GB of template files in {store_bytes / BYTES_PER_GB:.2f} GB of chunks '
+              f'({logical / store_bytes:.2f}x)')
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='content-addressed chunk store for the library: templates that share '
+                                        'disks share their storage')
+    parser.add_argument("command", choices=COMMANDS,
+                        help="ingest: chunk templates into the store; pack: remove files that are held in the store; "
+                             "materialize: reassemble packed templates and verify them; report: dedupe ratio per "
+                             "template; gc: drop chunks nothing uses; chunks: a template's chunk list (JSON); "
+                             "missing: which hashes of a chunk list (JSON, on stdin) are not held here")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--vapp_template_name", required=False, action="append", default=[],
+                        dest="vapp_template_names",
+                        help="template to work on (may be repeated; default: every template for ingest)")
+    parser.add_argument("--no_verify", required=False, action="store_false",
+                        dest="verify", default=True,
+                        help="pack: check chunk sizes only, without re-hashing them; materialize: skip the manifest "
+                             "check")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the result as JSON")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    templates = args.vapp_template_names
+    if args.command in ('pack', 'materialize', 'chunks') and not templates:
+        parser.error(f"'{args.command}' needs --vapp_template_name")
+    exit_code = 0
+    with ChunkStore(args.repository) as store:
+        if args.command == 'ingest':
+            result = {}
+            for template in templates or library_templates(args.repository):
+                result[template] = store.ingest(template)
+                logging.info(f"{template}: {result[template]['files']} file(s) chunked, "
+                             f"{result[template]['new_chunks']} new chunk(s), "
+                             f"{result[template]['new_bytes'] / BYTES_PER_GB:.2f} GB added to the store")
+        elif args.command == 'pack':
+            result = {template: store.pack(template, args.verify) for template in templates}
+            for template, freed in result.items():
+                logging.info(f'{template}: {freed / BYTES_PER_GB:.2f} GB freed')
+        elif args.command == 'materialize':
+            result = {template: store.materialize(template, args.verify) for template in templates}
+            for template, problems in result.items():
+                for file_name, problem in problems.items():
+                    logging.error(f'{template}/{file_name}: {problem}')
+                    exit_code = 1
+        elif args.command == 'gc':
+            removed, freed = store.gc()
+            result = {'chunks': removed, 'bytes': freed}
+            logging.info(f'{removed} chunk(s) removed, {freed / BYTES_PER_GB:.2f} GB freed')
+        elif args.command == 'chunks':
+            result = {template: store.chunk_list(template) for template in templates}
+        elif args.command == 'missing':
+            chunk_lists = json.load(sys.stdin)
+            result = store.missing(chunk_hash for files in chunk_lists.values() for chunks in files.values()
+                                   for offset, chunk_hash in chunks)
+        else:
+            result = store.report()
+            if not args.json_output:
+                print_report(result, store.store_bytes())
+
+    if args.json_output or args.command in ('chunks', 'missing'):
+        print(json.dumps(result, indent=2))
+    exit(exit_code)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import os
+import json
+from time import ctime
+from prettytable import PrettyTable
+from hol.xfer import read_hol_xfer_config, cleanup_oldest, get_reclaimable_free_space_bytes, EVICTION_POLICIES
+from hol.library import pin_template
+from hol.ovf import BYTES_PER_GB
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def print_eviction_plan(plan, json_output=False):
+    if json_output:
+        print(json.dumps([item.to_dict() for item in plan], indent=2))
+        return
+    table = PrettyTable(['Template', 'Size (GB)', 'Last Used', 'Uses', 'Refetch (s)'])
+    table.align = 'l'
+    for item in plan:
+        entry = item.to_dict()
+        table.add_row([entry['name'], entry['size_gb'], ctime(entry['last_used']), entry['use_count'],
+                       entry['refetch_seconds']])
+    print(table)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--cleanup_pattern", required=False,
+                        dest="cleanup_pattern", default='HOL-',
+                        help='pattern used to identify "cleanup-able" items')
+    parser.add_argument("--min_free_gb", required=False, type=int,
+                        dest="min_free_gb", default=None,
+                        help="free space target in GB (default: Library min_free_gb from the config)")
+    parser.add_argument("--policy", required=False,
+                        dest="policy", default=None, choices=list(EVICTION_POLICIES),
+                        help="eviction order (default: Library eviction_policy from the config, or oldest)")
+    parser.add_argument("--pin", required=False, action="append", default=[],
+                        dest="pin",
+                        help="never evict this template (may be repeated)")
+    parser.add_argument("--unpin", required=False, action="append", default=[],
+                        dest="unpin",
+                        help="allow this template to be evicted again (may be repeated)")
+    parser.add_argument("--delete", required=False, action="store_true",
+                        dest="really_delete", default=False,
+                        help="REALLY remove the planned templates (default is to print the plan)")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the eviction plan as JSON")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    args = parser.parse_args()
+
+    config = read_hol_xfer_config(args.yaml_config_path)
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    for template in args.pin:
+        pin_template(args.repository, template, pinned=True)
+        logging.info(f'pinned {template}')
+    for template in args.unpin:
+        pin_template(args.repository, template, pinned=False)
+        logging.info(f'unpinned {template}')
+
+    min_free_gb = args.min_free_gb if args.min_free_gb is not None else config['Library']['min_free_gb']
+    policy = args.policy or config['Library'].get('eviction_policy', 'oldest')
+    plan = cleanup_oldest(args.repository, args.cleanup_pattern, min_free_gb,
+                          really_delete=args.really_delete, policy=policy,
+                          pinned=config['Library'].get('pinned') or ())
+    print_eviction_plan(plan, args.json_output)
+    if not args.json_output:
+        free_gb = get_reclaimable_free_space_bytes(args.repository) / BYTES_PER_GB
+        action = 'moved to the trash' if args.really_delete else 'would remove'
+        print(f'{policy}: {action} {len(plan)} template(s), '
+              f'{sum(item.size_bytes for item in plan) / BYTES_PER_GB:.2f} GB; '
+              f'{free_gb:.2f} GB free, target {min_free_gb} GB')
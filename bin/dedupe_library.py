@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import os
+import json
+from prettytable import PrettyTable
+from hol.library.dedupe import dedupe_library, DEDUPE_MIN_SIZE
+from hol.ovf import BYTES_PER_GB
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def print_groups(groups, repository):
+    table = PrettyTable(['Keep', 'Duplicates', 'Size (GB)'])
+    table.align = 'l'
+    for group in groups:
+        table.add_row([os.path.relpath(group.keep, repository),
+                       '\n'.join(os.path.relpath(d, repository) for d in group.duplicates),
+                       round(group.size / BYTES_PER_GB, 2)])
+    print(table)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='replace byte-identical files in the library with reflinks (or hard links '
+                                        'where that is safe) to a single copy')
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--path", required=False, action="append", default=[],
+                        dest="extra_paths",
+                        help="another tree to include, e.g. an ISO library on the same filesystem (may be repeated)")
+    parser.add_argument("--min_size", required=False, type=int,
+                        dest="min_size", default=DEDUPE_MIN_SIZE,
+                        help="ignore files smaller than this (bytes)")
+    parser.add_argument("--apply", required=False, action="store_true",
+                        dest="apply", default=False,
+                        help="REALLY replace the duplicates (default is to print what would be done)")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the result as JSON")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    groups, counts = dedupe_library(args.repository, args.extra_paths, args.min_size, args.apply)
+    if args.json_output:
+        print(json.dumps({'groups': [group.to_dict() for group in groups], 'counts': counts}, indent=2))
+    else:
+        print_groups(groups, args.repository)
+        action = 'replaced' if args.apply else 'would replace'
+        print(f"{action} {counts['files']} duplicate(s), {counts['bytes'] / BYTES_PER_GB:.2f} GB")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# NOTE: requires key-based ssh from here to every target node (and from each node to its parent and the origin)
+
+import os
+import json
+import time
+import shlex
+import subprocess
+from prettytable import PrettyTable
+from hol.xfer import read_hol_xfer_config
+from hol.pull.fanout import plan_fanout, plan_depth, FANOUT_MODES, DEFAULT_FANOUT
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_node_names(file_name):
+    with open(file_name) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def remote_pull_command(configuration, vapp_template_name, origin, source_path, repository, remote_config, parent):
+    """
+    :return: shell command that pulls the template on a target node, relaying from parent unless it is the origin
+    """
+    scripts_path = configuration['Tools']['scripts']
+    argv = [os.path.join(scripts_path, 'pull_template.py'), '--vapp_template_name', vapp_template_name,
+            '--repository', repository, '--source_catalog', origin, '--source_path', source_path,
+            '--config', remote_config]
+    if parent != origin:
+        argv += ['--relay_from', parent, '--relay_path', repository]
+    return f'cd {shlex.quote(scripts_path)} && ' + ' '.join(shlex.quote(arg) for arg in argv)
+
+
+def run_pulls(configuration, assignments, vapp_template_name, origin, source_path, repository, remote_config,
+              log_dir):
+    """
+    start every node's pull at once (relaying nodes wait for their parent's bytes) and wait for all of them
+    :param assignments: list of (node, parent)
+    :return: dict of node => (exit code, seconds)
+    """
+    ssh_user = configuration['Infrastructure']['ssh_username']
+    running = {}
+    for node, parent in assignments:
+        command = remote_pull_command(configuration, vapp_template_name, origin, source_path, repository,
+                                      remote_config, parent)
+        log_path = os.path.join(log_dir, f'distribute-{vapp_template_name}-{node}.log')
+        log_f = open(log_path, 'a')
+        log_f.write(f'=== {time.ctime()} {node} <- {parent}: {command}\n')
+        log_f.flush()
+        logging.info(f'{node}: pulling from {parent} (log: {log_path})')
+        process = subprocess.Popen(['ssh', '-o', 'BatchMode=yes', f'{ssh_user}@{node}', command],
+                                   stdout=log_f, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        running[node] = (process, log_f, time.monotonic())
+    results = {}
+    for node, (process, log_f, start) in running.items():
+        exit_code = process.wait()
+        log_f.close()
+        results[node] = (exit_code, round(time.monotonic() - start, 1))
+        logging.log(logging.INFO if exit_code == 0 else logging.ERROR,
+                    f'{node}: exit code {exit_code} after {results[node][1]}s')
+    return results
+
+
+def nearest_good_ancestor(node, parents, results, origin):
+    parent = parents[node]
+    while parent != origin and results.get(parent, (1,))[0] != 0:
+        parent = parents[parent]
+    return parent
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='copy a template from one catalog node to many, each node relaying to the '
+                                        'next ones as it receives the bytes')
+    parser.add_argument("--vapp_template_name", required=True,
+                        dest="vapp_template_name",
+                        help="name of the vApp template (OVF base name)")
+    parser.add_argument("--origin", required=True,
+                        dest="origin",
+                        help="name or IP of the catalog node that has the template")
+    parser.add_argument("--target", required=False, action="append", default=[],
+                        dest="targets",
+                        help="catalog node that should get the template (may be repeated)")
+    parser.add_argument("--targets_file", required=False,
+                        dest="targets_file",
+                        help="file with one target node per line (nearby nodes next to each other)")
+    parser.add_argument("--mode", required=False, choices=FANOUT_MODES,
+                        dest="mode", default='tree',
+                        help="tree: every node feeds up to --fanout others; chain: each node feeds the next one")
+    parser.add_argument("--fanout", required=False, type=int,
+                        dest="fanout", default=DEFAULT_FANOUT,
+                        help="children per node in a tree")
+    parser.add_argument("--source_path", required=False,
+                        dest="source_path", default='/hol/lib',
+                        help="repository root path on the origin")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="repository root path on the target nodes")
+    parser.add_argument("--remote_config", required=False,
+                        dest="remote_config",
+                        help="config file path on the target nodes (default: next to Tools scripts)")
+    parser.add_argument("--log_dir", required=False,
+                        dest="log_dir", default='/tmp',
+                        help="where to write each node's output")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    parser.add_argument("--dry_run", required=False, action="store_true",
+                        dest="dry_run", default=False,
+                        help="print the plan and the commands only")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the plan and results as JSON")
+    args = parser.parse_args()
+
+    targets = list(args.targets)
+    if args.targets_file:
+        targets += read_node_names(args.targets_file)
+    if not targets:
+        parser.error('no targets given')
+    config = read_hol_xfer_config(args.yaml_config_path)
+    remote_config = args.remote_config or os.path.join(os.path.dirname(config['Tools']['scripts'].rstrip('/')),
+                                                       'config.yaml')
+    try:
+        plan = plan_fanout(args.origin, targets, args.mode, args.fanout)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.info(f'{len(plan)} node(s), {plan_depth(len(plan), args.mode, args.fanout)} hop(s) deep')
+
+    if args.dry_run:
+        if args.json_output:
+            print(json.dumps([node.to_dict() for node in plan], indent=2))
+        else:
+            for node in plan:
+                command = remote_pull_command(config, args.vapp_template_name, args.origin, args.source_path,
+                                              args.repository, remote_config, node.parent)
+                print(f"{'  ' * node.depth}{node.name} <- {node.parent}")
+                print(f"{'  ' * node.depth}  {command}")
+        exit(0)
+
+    os.makedirs(args.log_dir, exist_ok=True)
+    start = time.monotonic()
+    parents = {node.name: node.parent for node in plan}
+    results = run_pulls(config, [(node.name, node.parent) for node in plan], args.vapp_template_name, args.origin,
+                        args.source_path, args.repository, remote_config, args.log_dir)
+    failed = [node.name for node in plan if results[node.name][0] != 0]
+    if failed:
+        # once more for the nodes that failed, each from its closest ancestor that has the template
+        logging.warning(f'{len(failed)} node(s) failed, retrying: {failed}')
+        retry = [(name, nearest_good_ancestor(name, parents, results, args.origin)) for name in failed]
+        parents.update(retry)
+        results.update(run_pulls(config, retry, args.vapp_template_name, args.origin, args.source_path,
+                                 args.repository, remote_config, args.log_dir))
+    elapsed = time.monotonic() - start
+
+    if args.json_output:
+        print(json.dumps({'elapsed': round(elapsed, 1),
+                          'nodes': [dict(node.to_dict(), parent=parents[node.name], exit_code=results[node.name][0],
+                                         seconds=results[node.name][1]) for node in plan]}, indent=2))
+    else:
+        table = PrettyTable(['Node', 'Parent', 'Depth', 'Result', 'Seconds'])
+        table.align = 'l'
+        for node in plan:
+            exit_code, seconds = results[node.name]
+            table.add_row([node.name, parents[node.name], node.depth,
+                           'OK' if exit_code == 0 else f'FAILED ({exit_code})', seconds])
+        print(table)
+        print(f'{len(plan)} node(s) in {elapsed:.0f}s')
+    exit(0 if all(results[node.name][0] == 0 for node in plan) else 1)
@@ -1,13 +1,24 @@
 #!/usr/bin/env python3
 
 import os
+import math
+import time
 from hol.xfer import read_hol_xfer_config, read_hol_xfer_auth, get_cloud_creds, \
-    cleanup_oldest, get_free_space_bytes
-from hol.ovf import BYTES_PER_GB
+    cleanup_oldest, SpaceReservationLedger, RESERVATION_MARGIN
+from hol.xfer.vcd import VcdSession, VcdRestError, estimate_vcd_template_size
+from hol.xfer.export import plan_incremental_export, perform_incremental_export, export_staging_path, \
+    ACTION_DOWNLOAD, SourceFingerprint, decide_export, record_source_fingerprint, read_source_fingerprint, \
+    descriptor_changed, DECISION_SKIP, DECISION_INCREMENTAL
+from hol.ovf import BYTES_PER_GB, DigestCache
+from hol.library import record_library_event, record_library_access, EVENT_EXPORTED
+import requests
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+# local: an OVF in the library is good enough; source: ask VCD whether the catalog item changed since
+FRESHNESS_CHECKS = ('local', 'source')
+
 
 def perform_vcd_export(cloud_host,
                        cloud_org,
@@ -31,7 +42,8 @@ def perform_vcd_export(cloud_host,
     if os.path.isfile(full_file_target):
         logging.info(
             f'Export for {vapp_template_name} already exists -- LUCKY DAY!')
-        return
+        record_library_access(repository, vapp_template_name)
+        return True
     # TODO: I think the "&vdc={cloud_ovdc}" portion of the ovftool url is optional... check that!
     cloud_source = f"'vcloud://{user_name}:{vcd_password}@{cloud_host}:443/?org={cloud_org}" \
                    f"&catalog={cloud_catalog}&{media_type}={vapp_template_name}'"
@@ -39,7 +51,9 @@ def perform_vcd_export(cloud_host,
     if machine_output:
         options = f'--machineOutput {options}'
     cmd = f'{ovftool_path} {options} {cloud_source} {full_file_target} '
+    export_start = time.time()
     os.system(cmd)
+    export_seconds = time.time() - export_start
     # ovftool still has a bug that it generates NAME/NAME/NAME.ovf when you provide NAME/NAME.ovf as the destination
     bad_source = os.path.join(
         repository, vapp_template_name, vapp_template_name)
@@ -48,6 +62,108 @@ def perform_vcd_export(cloud_host,
         bad_source_files = os.path.join(bad_source, '*.*')
         good_source = os.path.join(repository, vapp_template_name)
         os.system(f'mv {bad_source_files} {good_source} && rmdir {bad_source}')
+    if os.path.isfile(full_file_target):
+        record_library_event(repository, vapp_template_name, EVENT_EXPORTED, source_cloud=cloud_host,
+                             source_org=cloud_org, source_catalog=cloud_catalog, duration=export_seconds)
+        return True
+    logging.error(f'export of {vapp_template_name} did not produce {full_file_target}')
+    return False
+
+
+def incremental_vcd_export(cloud_host, cloud_org, cloud_catalog, vapp_template_name, repository, credentials,
+                           ledger, wait_minutes=0, sample=True, source_changed=True):
+    """
+    bring an existing local copy up to date with the catalog item: only the files that differ are downloaded.
+    A new revision whose files are all unchanged still gets its descriptor (and a new manifest) swapped in.
+    :param source_changed: the catalog item is not the one the local copy was exported from (or nobody knows)
+    :return: True on success (also when nothing changed)
+    """
+    user_name, vcd_password = get_cloud_creds(credentials, cloud_host, cloud_org)
+    digest_cache = DigestCache.for_library(repository)
+    try:
+        with VcdSession(cloud_host, cloud_org, user_name, vcd_password) as session:
+            plan = plan_incremental_export(session, cloud_catalog, vapp_template_name, repository, sample,
+                                           digest_cache, source_changed)
+            if plan is None:
+                logging.error(f'{vapp_template_name} is not in {cloud_host}/{cloud_org}/{cloud_catalog}')
+                return False
+            changed = [f for f in plan.files if f.action == ACTION_DOWNLOAD]
+            logging.info(f'{vapp_template_name}: {len(changed)} of {len(plan.files)} file(s) to download, '
+                         f'{plan.download_bytes / BYTES_PER_GB:.2f} GB; {plan.reused_bytes / BYTES_PER_GB:.2f} GB '
+                         f'reused')
+            if not changed and not source_changed and not descriptor_changed(plan, repository):
+                logging.info(f'{vapp_template_name} is up to date')
+                record_library_access(repository, vapp_template_name)
+                return True
+            if not changed:
+                logging.info(f'{vapp_template_name}: new revision with the same files, swapping in its descriptor')
+            reservation_id = ledger.wait_and_reserve(vapp_template_name,
+                                                     int(plan.download_bytes * (1 + RESERVATION_MARGIN)),
+                                                     path=export_staging_path(repository, vapp_template_name),
+                                                     timeout=wait_minutes * 60)
+            if reservation_id is None:
+                logging.error(f'Unable to begin export: {plan.download_bytes / BYTES_PER_GB:.2f} GB requested, '
+                              f'{ledger.available_bytes() / BYTES_PER_GB:.2f} GB unreserved')
+                return False
+            export_start = time.time()
+            try:
+                perform_incremental_export(session, plan, repository, digest_cache=digest_cache)
+            finally:
+                ledger.release(reservation_id)
+    except (VcdRestError, requests.RequestException, OSError) as e:
+        logging.error(f'incremental export of {vapp_template_name} failed: {e}')
+        return False
+    finally:
+        if digest_cache is not None:
+            digest_cache.close()
+    record_library_event(repository, vapp_template_name, EVENT_EXPORTED,
+                         detail=f'incremental: {len(changed)} of {len(plan.files)} file(s) downloaded',
+                         source_cloud=cloud_host, source_org=cloud_org, source_catalog=cloud_catalog,
+                         duration=time.time() - export_start)
+    return True
+
+
+def fetch_source_fingerprint(cloud_host, cloud_org, cloud_catalog, vapp_template_name, credentials):
+    """
+    one catalogItem query: what the source looks like right now
+    :return: SourceFingerprint, or None if the item was not found or VCD could not be asked
+    """
+    user_name, vcd_password = get_cloud_creds(credentials, cloud_host, cloud_org)
+    try:
+        with VcdSession(cloud_host, cloud_org, user_name, vcd_password) as session:
+            record = session.find_catalog_item(cloud_catalog, vapp_template_name)
+    except (VcdRestError, requests.RequestException) as e:
+        logging.warning(f'unable to look up {vapp_template_name} in {cloud_host}/{cloud_org}/{cloud_catalog}: {e}')
+        return None
+    if record is None:
+        logging.warning(f'{vapp_template_name} is not in {cloud_host}/{cloud_org}/{cloud_catalog}')
+        return None
+    return SourceFingerprint.from_catalog_record(record, cloud_host, cloud_org, cloud_catalog)
+
+
+def save_source_fingerprint(repository, vapp_template_name, fingerprint):
+    if fingerprint is None:
+        return
+    try:
+        record_source_fingerprint(repository, vapp_template_name, fingerprint)
+    except (OSError, ValueError) as e:
+        logging.warning(f'unable to record the source fingerprint of {vapp_template_name}: {e}')
+
+
+def estimate_export_size(cloud_host, cloud_org, cloud_catalog, vapp_template_name, credentials):
+    """
+    :return: estimated bytes the export will write, or None if VCD could not tell us
+    """
+    user_name, vcd_password = get_cloud_creds(credentials, cloud_host, cloud_org)
+    try:
+        with VcdSession(cloud_host, cloud_org, user_name, vcd_password) as session:
+            size_bytes, source = estimate_vcd_template_size(session, cloud_catalog, vapp_template_name)
+    except (VcdRestError, requests.RequestException) as e:
+        logging.warning(f'unable to estimate the size of {vapp_template_name}: {e}')
+        return None
+    if size_bytes:
+        logging.info(f'{vapp_template_name} is about {size_bytes / BYTES_PER_GB:.2f} GB (from the {source})')
+    return size_bytes
 
 
 if __name__ == '__main__':
@@ -77,6 +193,25 @@ if __name__ == '__main__':
     parser.add_argument("--machine_output", required=False, action="store_true",
                         dest="machine_output", default=False,
                         help="use ovftool machineOutput option")
+    parser.add_argument("--wait_minutes", required=False, type=int,
+                        dest="wait_minutes", default=0,
+                        help="wait up to this long for space held by other exports/pulls (default: fail at once, "
+                             "exit code 97)")
+    parser.add_argument("--estimated_gb", required=False, type=float,
+                        dest="estimated_gb", default=None,
+                        help="size of the template if already known (skips the lookup in VCD)")
+    parser.add_argument("--incremental", required=False, action="store_true",
+                        dest="incremental", default=False,
+                        help="if the template is already here, download only the files that changed in the "
+                             "catalog and swap the new version in")
+    parser.add_argument("--no_sample", required=False, action="store_false",
+                        dest="sample", default=True,
+                        help="incremental: compare files by size only, without reading sampled ranges from VCD")
+    parser.add_argument("--freshness", required=False, choices=FRESHNESS_CHECKS,
+                        dest="freshness", default='local',
+                        help="local: skip the export if the OVF is here; source: skip only if the catalog item is "
+                             "the one that was exported and the local copy is complete, else export incrementally "
+                             "(or in full if there is no local copy)")
     args = parser.parse_args()
 
     # Read the configuration / environment settings
@@ -90,32 +225,84 @@ if __name__ == '__main__':
     ovf_file_name = f'{args.vapp_template_name}.ovf'
     full_file_target = os.path.join(
         args.repository, args.vapp_template_name, ovf_file_name)
-    if os.path.isfile(full_file_target):
+    if os.path.isfile(full_file_target) and not args.incremental and args.freshness == 'local':
         logging.info(
             f'Export for {args.vapp_template_name} already exists -- LUCKY DAY!')
+        record_library_access(args.repository, args.vapp_template_name)
         exit(0)
 
     creds = read_hol_xfer_auth(config['Tools']['credentials'])
     min_free_gb = config['Library']['min_free_gb']
-    if os.path.isdir(args.repository):
-        cleanup_oldest(args.repository, args.cleanup_pattern,
-                       min_free_gb, really_delete=False)
-        # we should have "enough" (estimated?) free space and can proceed with the export
-        requested_free_bytes = min_free_gb * BYTES_PER_GB
-        requested_free_gb = requested_free_bytes / BYTES_PER_GB
-        available_bytes = get_free_space_bytes(args.repository)
-        available_gb = available_bytes / BYTES_PER_GB
-        if available_gb > requested_free_gb:
-            perform_vcd_export(args.cloud_host,
-                               args.cloud_org,
-                               args.cloud_catalog,
-                               args.vapp_template_name,
-                               args.repository,
-                               creds,
-                               args.machine_output)
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    # taken before the export, so a revision published while it runs is noticed next time
+    fingerprint = fetch_source_fingerprint(args.cloud_host, args.cloud_org, args.cloud_catalog,
+                                           args.vapp_template_name, creds)
+    incremental = os.path.isfile(full_file_target)
+    if args.freshness == 'source' and incremental:
+        if fingerprint is None:
+            logging.warning(f'cannot check the source, keeping the local copy of {args.vapp_template_name}')
+            decision = DECISION_SKIP
         else:
-            logging.error(f'Unable to begin export: inadequate space able to be freed: '
-                          f'{requested_free_gb} GB requested, {available_gb} GB available after cleanup'
-                          f'using "{args.cleanup_pattern}"')
+            decision, reason = decide_export(args.repository, args.vapp_template_name, fingerprint)
+            logging.info(f'{args.vapp_template_name}: {decision} export ({reason})')
+        if decision == DECISION_SKIP:
+            record_library_access(args.repository, args.vapp_template_name)
+            exit(0)
+        incremental = decision == DECISION_INCREMENTAL
+
+    if incremental:
+        recorded = read_source_fingerprint(args.repository, args.vapp_template_name)
+        source_changed = fingerprint is None or recorded is None or not recorded.same_source(fingerprint)
+        if not incremental_vcd_export(args.cloud_host, args.cloud_org, args.cloud_catalog, args.vapp_template_name,
+                                      args.repository, creds, SpaceReservationLedger(args.repository),
+                                      args.wait_minutes, args.sample, source_changed):
+            exit(1)
+        save_source_fingerprint(args.repository, args.vapp_template_name, fingerprint)
+        exit(0)
+
+    # size the export up front: without an estimate, fall back to asking for min_free_gb
+    if args.estimated_gb:
+        estimated_bytes = int(args.estimated_gb * BYTES_PER_GB)
     else:
-        logging.error(f'Repository "{args.repository}" is not a directory!')
+        estimated_bytes = estimate_export_size(args.cloud_host, args.cloud_org, args.cloud_catalog,
+                                               args.vapp_template_name, creds)
+    if estimated_bytes:
+        requested_free_bytes = int(estimated_bytes * (1 + RESERVATION_MARGIN))
+    else:
+        requested_free_bytes = min_free_gb * BYTES_PER_GB
+    requested_free_gb = requested_free_bytes / BYTES_PER_GB
+
+    ledger = SpaceReservationLedger(args.repository)
+    # make room for this export on top of what running jobs still have to write, keeping min_free_gb as the floor
+    cleanup_threshold_gb = min_free_gb + math.ceil((requested_free_bytes + ledger.reserved_bytes()) / BYTES_PER_GB)
+    # eviction is a rename into the trash; the reaper gives the space back at a bounded rate
+    cleanup_oldest(args.repository, args.cleanup_pattern,
+                   cleanup_threshold_gb, really_delete=True,
+                   policy=config['Library'].get('eviction_policy', 'oldest'),
+                   pinned=config['Library'].get('pinned') or ())
+    target_path = os.path.join(args.repository, args.vapp_template_name)
+    reservation_id = ledger.wait_and_reserve(args.vapp_template_name, requested_free_bytes, path=target_path,
+                                             floor_bytes=min_free_gb * BYTES_PER_GB,
+                                             timeout=args.wait_minutes * 60)
+    if reservation_id is None:
+        available_gb = ledger.available_bytes() / BYTES_PER_GB
+        logging.error(f'Unable to begin export: inadequate space able to be freed: '
+                      f'{requested_free_gb:.2f} GB requested, {available_gb:.2f} GB unreserved after cleanup '
+                      f'using "{args.cleanup_pattern}"')
+        exit(97)
+    try:
+        exported = perform_vcd_export(args.cloud_host,
+                                      args.cloud_org,
+                                      args.cloud_catalog,
+                                      args.vapp_template_name,
+                                      args.repository,
+                                      creds,
+                                      args.machine_output)
+    finally:
+        ledger.release(reservation_id)
+    if not exported:
+        exit(1)
+    save_source_fingerprint(args.repository, args.vapp_template_name, fingerprint)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import os
+import json
+from time import ctime
+from prettytable import PrettyTable
+from hol.xfer import read_hol_xfer_config, read_hol_xfer_auth
+from hol.jobs import JobDaemon, JOB_KINDS, DEFAULT_SOCKET_PATH, DEFAULT_MAX_ATTEMPTS, send_request
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def print_jobs(jobs):
+    table = PrettyTable(['Id', 'Kind', 'Template', 'State', 'Attempts', 'Submitted', 'Last Error'])
+    table.align = 'l'
+    for job in jobs:
+        table.add_row([job['id'], job['kind'], job['template'], job['state'],
+                       f"{job['attempts']}/{job['max_attempts']}", ctime(job['submitted_at']),
+                       job['last_error'] or ''])
+    print(table)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='hol-xfer daemon: a persistent queue of export/pull/validate/scrub/'
+                                        'bubble/import jobs')
+    parser.add_argument("command", choices=('serve', 'submit', 'list', 'get', 'cancel'),
+                        help="serve: run the daemon; the others talk to it")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default=None,
+                        help="path to the local repository (default: Library path from the config)")
+    parser.add_argument("--kind", required=False,
+                        dest="kind", choices=list(JOB_KINDS),
+                        help="submit: what to do")
+    parser.add_argument("--vapp_template_name", required=False,
+                        dest="vapp_template_name",
+                        help="submit: name of the vApp template (OVF base name)")
+    parser.add_argument("--param", required=False, action="append", default=[],
+                        dest="params",
+                        help="submit: NAME=VALUE passed to the job's script as --NAME VALUE "
+                             "(e.g. cloud_host=..., source_catalog=...); may be repeated")
+    parser.add_argument("--max_attempts", required=False, type=int,
+                        dest="max_attempts", default=DEFAULT_MAX_ATTEMPTS,
+                        help="submit: give up after this many failed attempts")
+    parser.add_argument("--id", required=False, type=int,
+                        dest="job_id",
+                        help="get/cancel: the job id")
+    parser.add_argument("--state", required=False, action="append",
+                        dest="states",
+                        help="list: only jobs in this state (may be repeated)")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the response as JSON")
+    args = parser.parse_args()
+
+    config = read_hol_xfer_config(args.yaml_config_path)
+    socket_path = (config.get('Daemon') or {}).get('socket', DEFAULT_SOCKET_PATH)
+
+    if args.command == 'serve':
+        repository = args.repository or config['Library']['path']
+        if not os.path.isdir(repository):
+            logging.error(f'Repository "{repository}" is not a directory!')
+            exit(1)
+        creds = read_hol_xfer_auth(config['Tools']['credentials'])
+        JobDaemon(config, args.yaml_config_path, repository, creds).serve_forever()
+        exit(0)
+
+    if args.command == 'submit':
+        if not (args.kind and args.vapp_template_name):
+            parser.error('submit needs --kind and --vapp_template_name')
+        params = dict(p.split('=', 1) for p in args.params)
+        request = {'op': 'submit', 'kind': args.kind, 'template': args.vapp_template_name, 'params': params,
+                   'max_attempts': args.max_attempts}
+    elif args.command == 'list':
+        request = {'op': 'list', 'states': args.states}
+    else:
+        if args.job_id is None:
+            parser.error(f'{args.command} needs --id')
+        request = {'op': args.command, 'id': args.job_id}
+
+    try:
+        response = send_request(socket_path, request)
+    except OSError as e:
+        logging.error(f'unable to reach the hol-xfer daemon at {socket_path}: {e}')
+        exit(1)
+    if args.json_output:
+        print(json.dumps(response, indent=2))
+    elif not response.get('ok'):
+        logging.error(response.get('error', f'{args.command} failed'))
+    elif args.command == 'submit':
+        print(f"queued job {response['id']}")
+    elif args.command == 'list':
+        print_jobs(response['jobs'])
+    elif args.command == 'get':
+        print_jobs([response['job']])
+    else:
+        print(f'cancelled job {args.job_id}')
+    exit(0 if response.get('ok') else 1)
@@ -2,6 +2,7 @@
 
 import os
 from hol.xfer import read_hol_xfer_config, read_hol_xfer_auth, get_cloud_creds
+from hol.library import record_library_event, EVENT_IMPORTED
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -36,7 +37,12 @@ def perform_vcd_import(cloud_host,
     if machine_output:
         options = f'--machineOutput {options}'
     cmd = f'{ovftool_path} {options} {full_source} {target}'
-    os.system(cmd)
+    if os.system(cmd) != 0:
+        logging.error(f'ovftool failed to import {vapp_template_name}')
+        return False
+    record_library_event(repository, vapp_template_name, EVENT_IMPORTED,
+                         detail=f'{cloud_host}/{cloud_org}/{cloud_catalog}')
+    return True
 
 
 if __name__ == '__main__':
@@ -75,10 +81,11 @@ if __name__ == '__main__':
 
     creds = read_hol_xfer_auth(config['Tools']['credentials'])
 
-    perform_vcd_import(args.cloud_host,
-                       args.cloud_org,
-                       args.cloud_catalog,
-                       args.vapp_template_name,
-                       args.repository,
-                       creds,
-                       args.machine_output)
+    if not perform_vcd_import(args.cloud_host,
+                              args.cloud_org,
+                              args.cloud_catalog,
+                              args.vapp_template_name,
+                              args.repository,
+                              creds,
+                              args.machine_output):
+        exit(1)
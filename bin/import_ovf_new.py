@@ -9,6 +9,7 @@ from pyvcloud.vcd.org import Org
 from pyvcloud.vcd.client import BasicLoginCredentials
 from pyvcloud.vcd.client import Client
 from hol.ovf import BYTES_PER_GB
+from hol.library import record_library_event, EVENT_IMPORTED
 import logging
 from tqdm import tqdm
 
@@ -78,6 +79,8 @@ def perform_vcd_import(cloud_host, cloud_org, cloud_catalog, vapp_template_name,
                        item_name=vapp_template_name, chunk_size=DSB_CHUNK_SIZE,
                        callback=better_progress_reporter)
         print("OVF uploaded successfully.")
+        record_library_event(repository, vapp_template_name, EVENT_IMPORTED,
+                             detail=f'{cloud_host}/{cloud_org}/{cloud_catalog}')
     except Exception as e:
         print(f"Error uploading OVF: {e}")
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+from time import ctime
+from prettytable import PrettyTable
+from hol.library import LibraryIndex, LIFECYCLE_EVENTS
+from hol.ovf import BYTES_PER_GB, VALIDATION_LEVELS
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+QUERIES = ('list', 'show', 'validated', 'differs', 'safe_to_delete')
+
+
+def print_templates(templates):
+    table = PrettyTable(['Template', 'State', 'Size (GB)', 'Files', 'Validated', 'Source', 'Updated'])
+    table.align = 'l'
+    for t in templates:
+        last_event = max((t[f'{event}_at'] or 0) for event in LIFECYCLE_EVENTS)
+        validated = f"{t['validated_level']} {'ok' if t['validated_ok'] else 'FAILED'}" \
+            if t['validated_level'] else ''
+        source = '/'.join(part for part in (t['source_cloud'], t['source_org'], t['source_catalog']) if part)
+        table.add_row([t['name'], t['state'], round(t['size_bytes'] / BYTES_PER_GB, 2), t['file_count'],
+                       validated, source, ctime(last_event) if last_event else ''])
+    print(table)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("query", choices=QUERIES, nargs='?', default='list',
+                        help="what to show (default: list)")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--vapp_template_name", required=False,
+                        dest="vapp_template_name",
+                        help="template for 'show'")
+    parser.add_argument("--pattern", required=False,
+                        dest="pattern", default='',
+                        help="only templates containing this (safe_to_delete)")
+    parser.add_argument("--level", required=False,
+                        dest="level", default=VALIDATION_LEVELS[0], choices=VALIDATION_LEVELS,
+                        help="minimum validation level (validated)")
+    parser.add_argument("--no_reconcile", required=False, action="store_true",
+                        dest="no_reconcile", default=False,
+                        help="only re-check the templates with events since they were last reconciled, not the whole "
+                             "library")
+    parser.add_argument("--full", required=False, action="store_true",
+                        dest="full", default=False,
+                        help="re-read every OVF and manifest while reconciling")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the result as JSON")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    with LibraryIndex(args.repository) as index:
+        if not args.no_reconcile:
+            start = time.monotonic()
+            counts = index.reconcile(full=args.full)
+            logging.info(f"reconciled {counts['templates']} template(s) in {time.monotonic() - start:.2f}s: "
+                         f"{counts['changed']} changed, {counts['parsed']} re-parsed, {counts['removed']} removed")
+        if args.query == 'show':
+            if not args.vapp_template_name:
+                parser.error("'show' needs --vapp_template_name")
+            result = {'template': index.template(args.vapp_template_name),
+                      'files': index.files(args.vapp_template_name),
+                      'history': index.history(args.vapp_template_name)}
+        elif args.query == 'validated':
+            result = index.validated(args.level)
+        elif args.query == 'differs':
+            result = index.differs_from_source()
+        elif args.query == 'safe_to_delete':
+            result = index.safe_to_delete(args.pattern)
+        else:
+            result = index.templates()
+
+    if args.json_output:
+        print(json.dumps(result, indent=2))
+    elif args.query == 'show':
+        if result['template'] is None:
+            logging.error(f'{args.vapp_template_name} is not in the index')
+            exit(1)
+        print_templates([result['template']])
+        table = PrettyTable(['File', 'Size', 'Expected', 'Manifest digest', 'Cached digest'])
+        table.align = 'l'
+        for f in result['files']:
+            table.add_row([f['name'], f['size'] if f['present'] else 'MISSING', f['expected_size'] or '',
+                           (f['manifest_digest'] or '')[:16], (f['cached_digest'] or '')[:16]])
+        print(table)
+        for event, at, detail in result['history']:
+            print(f"{ctime(at)}  {event}  {detail or ''}")
+    elif args.query == 'differs':
+        for template, problems in result.items():
+            for file_name, problem in problems:
+                print(f'{template}/{file_name}: {problem}')
+    else:
+        print_templates(result)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# EXAMPLE: prep_ovf.py --repository /hol/lib --vapp_template_name 2vm_blank --rtc_start_time 1702666800 --report -
+
+import os
+import json
+from hol.ovf import prep_the_ovf, DigestCache
+from hol.library import record_library_event, EVENT_SCRUBBED, EVENT_BUBBLED
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def perform_ovf_prep(vapp_template_name, repository, scrub, rtc_start_time, report_file):
+    ovf_file_name = f'{vapp_template_name}.ovf'
+    full_file_target = os.path.join(
+        repository, vapp_template_name, ovf_file_name)
+    backup_file_path = full_file_target.replace('.ovf', '.ovf.backup')
+    if os.path.isfile(full_file_target):
+        try:
+            report = prep_the_ovf(
+                ovf_file=full_file_target,
+                scrub=scrub,
+                rtc_start_time=rtc_start_time,
+                backup_file=backup_file_path,
+                report_file=None if report_file == '-' else report_file,
+                verbose=report_file != '-',
+                digest_cache=DigestCache.for_library(repository))
+        except PermissionError as err:
+            logging.error(f'unable to write backup file? {err}')
+            return 99
+        if scrub:
+            record_library_event(repository, vapp_template_name, EVENT_SCRUBBED,
+                                 detail=f"{report['change_count']} change(s)")
+        if rtc_start_time:
+            record_library_event(repository, vapp_template_name, EVENT_BUBBLED,
+                                 detail=f'rtc start {rtc_start_time}')
+        if report_file == '-':
+            print(json.dumps(report, indent=2))
+        else:
+            logging.info(f"{report['change_count']} change(s): {report['changes_by_rule']}")
+        return 0
+    logging.error(
+        f'Unable to locate OVF file in library: {full_file_target}')
+    return 99
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--vapp_template_name", required=True,
+                        dest="vapp_template_name",
+                        help="name of the vApp template (OVF base name)")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--rtc_start_time", required=False,
+                        dest="rtc_start_time", type=int, default=None,
+                        help="epoch value for time bubble start (0 removes an existing bubble)")
+    parser.add_argument("--no_scrub", required=False, action="store_true",
+                        dest="no_scrub", default=False,
+                        help="skip the scrub rules (time bubble/manifest only)")
+    parser.add_argument("--report", required=False,
+                        dest="report_file", default=None,
+                        help='write the JSON change report to this file ("-" for stdout)')
+    args = parser.parse_args()
+
+    ret = perform_ovf_prep(args.vapp_template_name, args.repository,
+                           not args.no_scrub, args.rtc_start_time, args.report_file)
+    exit(ret)
@@ -1,46 +1,225 @@
 #!/usr/bin/env python3
 
-# NOTE: requires rsync, lftp
+# NOTE: requires key-based ssh to the source catalog node (and lftp for --engine lftp, paramiko for native)
 
 import os
+import json
+import shlex
 import time
 from hol.xfer import read_hol_xfer_config
+from hol.ovf import inspect_template_vmdks, parse_manifest, verify_against_digests, DigestCache
+from hol.library import record_library_event, EVENT_PULLED
+from hol.pull import PullEngine, SftpTransport, sftp_transport_factory
+from hol.pull.swarm import SwarmEngine
+from hol.pull.fanout import relay_transport_factory
 import logging
 import subprocess
 
 logging.basicConfig(level=logging.INFO)
 
 dry_run = ''  # '--dry-run'
+# verify / re-transfer rounds before giving up on a file
+VERIFY_MAX_ROUNDS = 3
+PULL_ENGINES = ('native', 'lftp')
+
+
+def get_pull_engine(configuration):
+    return configuration['Infrastructure'].get('pull_engine', 'native')
 
 
 def check_requirements(configuration):
     try:
-        rsync_path = configuration['Tools']['rsync']
+        if get_pull_engine(configuration) == 'native':
+            return True
         lftp_path = configuration['Tools']['lftp']
-        if os.path.exists(rsync_path) and os.path.exists(lftp_path):
+        if os.path.exists(lftp_path):
             return True
         else:
             logging.error(
-                f"Failed to locate rsync or lftp at specified locations.")
+                f"Failed to locate lftp at specified location.")
             return False
     except KeyError as e:
         logging.error(f'Prerequisites not met in config file: {e}')
         return False
 
 
-def pull_and_verify(configuration, vapp_template_name, repository,
-                    source_catalog, source_path):
-    rsync_path = configuration['Tools']['rsync']
+def run_remote(ssh_user, source_catalog, command):
+    """
+    run a command on the source catalog node (key-based ssh)
+    :return: stdout, or None on failure
+    """
+    result = subprocess.run(['ssh', '-o', 'BatchMode=yes', f'{ssh_user}@{source_catalog}', command],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.error(f'{source_catalog}: "{command}" failed: {result.stderr.strip()}')
+        return None
+    return result.stdout
+
+
+def get_source_digests(ssh_user, source_catalog, source_template_path, vapp_template_name):
+    """
+    what the source has, with a digest for every file: the template's .mf, plus sha256sum on the source node
+    for whatever the manifest does not cover (the .mf itself, backups, extra files)
+    :return: (dict of file name => (algorithm, hex digest), dict of file name => size) or (None, None)
+    """
+    quoted_path = shlex.quote(source_template_path)
+    listing = run_remote(ssh_user, source_catalog, f'cd {quoted_path} && find . -type f -printf "%P\\t%s\\n"')
+    if listing is None:
+        return None, None
+    sizes = {}
+    for line in listing.splitlines():
+        file_name, size = line.rsplit('\t', 1)
+        sizes[file_name] = int(size)
+    mf_name = f'{vapp_template_name}.mf'
+    expected = {}
+    if mf_name in sizes:
+        mf_text = run_remote(ssh_user, source_catalog, f'cat {shlex.quote(os.path.join(source_template_path, mf_name))}')
+        if mf_text is not None:
+            expected = {name: digest for name, digest in parse_manifest(mf_text.splitlines(), mf_name).items()
+                        if name in sizes}
+    uncovered = [name for name in sizes if name not in expected]
+    if uncovered:
+        logging.info(f'{len(uncovered)} file(s) not in the manifest, hashing them on {source_catalog}')
+        output = run_remote(ssh_user, source_catalog,
+                            f"cd {quoted_path} && sha256sum -- {' '.join(shlex.quote(n) for n in uncovered)}")
+        if output is None:
+            return None, None
+        for line in output.splitlines():
+            digest, file_name = line.split(None, 1)
+            expected[file_name.lstrip('*')] = ('sha256', digest.lower())
+    return expected, sizes
+
+
+def select_matching_peers(configuration, vapp_template_name, source_catalog, peers, source_template_path):
+    """
+    keep the peers that hold exactly what the source holds (same files, sizes and digests)
+    :return: list of peer names
+    """
+    ssh_user = configuration['Infrastructure']['ssh_username']
+    reference = get_source_digests(ssh_user, source_catalog, source_template_path, vapp_template_name)
+    if reference[0] is None:
+        return []
+    matching = []
+    for peer in peers:
+        if get_source_digests(ssh_user, peer, source_template_path, vapp_template_name) == reference:
+            matching.append(peer)
+        else:
+            logging.warning(f'{peer}: {vapp_template_name} differs from {source_catalog} (or is missing), '
+                            f'not pulling from it')
+    return matching
+
+
+def native_pull(configuration, source_catalog, source_template_path, target, only=None, force=False,
+                progress_callback=None, peers=(), relay_from=None, relay_template_path=None):
+    """
+    pull with the built-in engine (SFTP, parallel files and segments, resumable); with peers, spread the byte
+    ranges over the source and every peer; with relay_from, read the bytes from that node (which may still be
+    pulling them) and only the file list from the source
+    :return: PullResult
+    """
+    infrastructure = configuration['Infrastructure']
+    ssh_user, ssh_key = infrastructure['ssh_username'], infrastructure.get('ssh_key') or None
+    if relay_from:
+        origin = SftpTransport(source_catalog, ssh_user, key_filename=ssh_key)
+        try:
+            files = origin.list_files(source_template_path)
+        finally:
+            origin.close()
+        engine = PullEngine(relay_transport_factory(sftp_transport_factory(relay_from, ssh_user, ssh_key),
+                                                    relay_template_path, files),
+                            parallel_files=infrastructure['parallel_files'],
+                            parallel_segments=infrastructure['parallel_segments'],
+                            progress_callback=progress_callback)
+        try:
+            return engine.pull(relay_template_path, target, only=only, force=force, delete=only is None)
+        finally:
+            engine.close()
+    if peers:
+        engine = SwarmEngine({host: sftp_transport_factory(host, ssh_user, ssh_key)
+                              for host in [source_catalog] + list(peers)},
+                             connections_per_source=infrastructure['parallel_segments'],
+                             progress_callback=progress_callback)
+    else:
+        engine = PullEngine(sftp_transport_factory(source_catalog, ssh_user, ssh_key),
+                            parallel_files=infrastructure['parallel_files'],
+                            parallel_segments=infrastructure['parallel_segments'],
+                            progress_callback=progress_callback)
+    try:
+        return engine.pull(source_template_path, target, only=only, force=force, delete=only is None)
+    finally:
+        engine.close()
+
+
+def retransfer_files(configuration, file_names, source_catalog, source_template_path, target, peers=(),
+                     relay=None):
+    """
+    fetch individual files again (segmented), replacing the local copies
+    :param relay: (node, template path) to fetch from instead of the source
+    """
+    if get_pull_engine(configuration) == 'native':
+        relay_from, relay_template_path = relay or (None, None)
+        native_pull(configuration, source_catalog, source_template_path, target, only=file_names, force=True,
+                    peers=peers, relay_from=relay_from, relay_template_path=relay_template_path)
+        return
     lftp_path = configuration['Tools']['lftp']
     ssh_user = configuration['Infrastructure']['ssh_username']
     parallel_segments = configuration['Infrastructure']['parallel_segments']
-    parallel_files = configuration['Infrastructure']['parallel_files']
+    for file_name in file_names:
+        local_path = os.path.join(target, file_name)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        remote_path = os.path.join(source_template_path, file_name)
+        os.system(f'{lftp_path} -c "pget -n {parallel_segments} '
+                  f'sftp://{ssh_user}:xxx@{source_catalog}:{shlex.quote(remote_path)} -o {shlex.quote(local_path)}"')
 
-    source_template_path = os.path.join(source_path, vapp_template_name)
 
-    # Any preflight checks needed?
+def verify_the_pull(configuration, vapp_template_name, repository, source_catalog, source_template_path,
+                    peers=(), relay=None):
+    """
+    compare the local copy with the source's digests (parallel local hashing, digests cached) and re-transfer
+    only the files that do not match
+    :return: True if every file matches
+    """
+    ssh_user = configuration['Infrastructure']['ssh_username']
+    target = os.path.join(repository, vapp_template_name)
+    expected, sizes = get_source_digests(ssh_user, source_catalog, source_template_path, vapp_template_name)
+    if expected is None:
+        logging.error(f'unable to get digests for {vapp_template_name} from {source_catalog}')
+        return False
+    digest_cache = DigestCache.for_library(repository)
+    for verify_round in range(1, VERIFY_MAX_ROUNDS + 1):
+        # a file of the wrong size is wrong: no need to hash it first
+        problems = {}
+        for file_name, size in sizes.items():
+            local_path = os.path.join(target, file_name)
+            if not os.path.isfile(local_path):
+                problems[file_name] = 'missing'
+            elif os.path.getsize(local_path) != size:
+                problems[file_name] = f'size {os.path.getsize(local_path)} != {size}'
+        problems.update(verify_against_digests(
+            target, {name: digest for name, digest in expected.items() if name not in problems},
+            digest_cache=digest_cache))
+        if not problems:
+            logging.info(f'all {len(expected)} file(s) match the source')
+            return True
+        for file_name, problem in sorted(problems.items()):
+            logging.warning(f'{file_name}: {problem}')
+        if verify_round == VERIFY_MAX_ROUNDS:
+            break
+        logging.info(f're-transferring {len(problems)} file(s) (round {verify_round})')
+        # the last round goes back to the source, in case the relaying node has bad copies itself
+        retransfer_files(configuration, sorted(problems), source_catalog, source_template_path, target, peers,
+                         relay if verify_round < VERIFY_MAX_ROUNDS - 1 else None)
+    logging.error(f'{len(problems)} file(s) still differ from the source after {VERIFY_MAX_ROUNDS} round(s)')
+    return False
+
 
-    transfer_start = time.time()
+def lftp_pull(configuration, repository, source_catalog, source_template_path):
+    lftp_path = configuration['Tools']['lftp']
+    ssh_user = configuration['Infrastructure']['ssh_username']
+    parallel_segments = configuration['Infrastructure']['parallel_segments']
+    parallel_files = configuration['Infrastructure']['parallel_files']
     # run the lftp -- uses key-based SSH (passwords not supported)
     fast_download_command = f'{lftp_path} -c "mirror --use-pget-n={parallel_segments} ' \
                             f'--no-perms --parallel={parallel_files} --delete-first {dry_run} ' \
@@ -48,24 +227,64 @@ def pull_and_verify(configuration, vapp_template_name, repository,
                             f'{repository}/"'
     logging.debug(f'LFTP command: {fast_download_command}')
     # TODO: what is the best way to call this?  this one does not like subprocess.run()
-    transfer_start = time.time()
     os.system(fast_download_command)
-    transfer_end = time.time() - transfer_start
-    logging.info("=== LFTP complete, running RSYNC to validate ===")
-    # using subprocess.run here... is this "better" ?
-    source = f'{ssh_user}@{source_catalog}:{source_template_path}/'
+
+
+def print_progress_event(event):
+    print(json.dumps(event), flush=True)
+
+
+def pull_and_verify(configuration, vapp_template_name, repository,
+                    source_catalog, source_path, progress_callback=None, peers=(), relay_from=None,
+                    relay_path=None):
+    source_template_path = os.path.join(source_path, vapp_template_name)
     target = f'{repository}/{vapp_template_name}/'
-    verify_command_list = [rsync_path, '--times', '--ignore-times', '--recursive',
-                           '--human-readable', '--stats', source, target]
-    rsync_start = time.time()
-    verify_result = subprocess.run(
-        verify_command_list, capture_output=True, text=True)
-    rsync_end = time.time() - rsync_start
-    # print statistics at the end of the rsync
-    print(verify_result.stdout)
+    relay = (relay_from, os.path.join(relay_path or source_path, vapp_template_name)) if relay_from else None
+
+    if (peers or relay) and get_pull_engine(configuration) != 'native':
+        logging.warning('--peer and --relay_from need the native engine, pulling from the source only')
+        peers, relay = (), None
+    if relay and peers:
+        logging.warning('--relay_from is given, ignoring --peer')
+        peers = ()
+    if peers:
+        peers = select_matching_peers(configuration, vapp_template_name, source_catalog, peers,
+                                      source_template_path)
+        logging.info(f"pulling from {', '.join([source_catalog] + peers)}")
+
+    transfer_start = time.time()
+    if get_pull_engine(configuration) == 'native':
+        relay_from, relay_template_path = relay or (None, None)
+        if relay_from:
+            logging.info(f'relaying from {relay_from}:{relay_template_path}')
+        result = native_pull(configuration, source_catalog, source_template_path, target,
+                             progress_callback=progress_callback, peers=peers, relay_from=relay_from,
+                             relay_template_path=relay_template_path)
+        for file_name, problem in result.failed().items():
+            logging.error(f'{file_name}: {problem}')
+    else:
+        lftp_pull(configuration, repository, source_catalog, source_template_path)
+    transfer_end = time.time() - transfer_start
+    logging.info("=== transfer complete, verifying against the source manifest ===")
+    verify_start = time.time()
+    all_good = verify_the_pull(configuration, vapp_template_name, repository, source_catalog, source_template_path,
+                               peers, relay)
+    verify_end = time.time() - verify_start
 
     logging.info(f'Copy complete, {str(round(transfer_end,2))} seconds to copy and '
-                 f'{str(round(rsync_end,2))} to verify the copy.')
+                 f'{str(round(verify_end,2))} to verify the copy.')
+
+    # quick structural check of the disks (catches sparse holes/zeroed tails from an aborted pget)
+    for file_name, inspection in inspect_template_vmdks(target).items():
+        if inspection.ok:
+            logging.info(f'{file_name}: {inspection.kind} OK ({inspection.grains_checked} grain(s) sampled)')
+        else:
+            all_good = False
+            logging.error(f"{file_name}: {'; '.join(inspection.problems)}")
+    if all_good:
+        record_library_event(repository, vapp_template_name, EVENT_PULLED, source_catalog=source_catalog,
+                             detail=f'{source_catalog}:{source_template_path}', duration=transfer_end)
+    return all_good
 
 
 if __name__ == '__main__':
@@ -80,24 +299,47 @@ if __name__ == '__main__':
     parser.add_argument("--source_catalog", required=True,
                         dest="source_catalog",
                         help="name or IP of the source catalog node")
+    parser.add_argument("--peer", required=False, action="append", default=[],
+                        dest="peers",
+                        help="another catalog node holding the same template to pull from at the same time "
+                             "(may be repeated; native engine)")
+    parser.add_argument("--relay_from", required=False,
+                        dest="relay_from",
+                        help="read the files from this node, which may still be pulling them, instead of the source "
+                             "catalog (file list and digests still come from the source; native engine)")
+    parser.add_argument("--relay_path", required=False,
+                        dest="relay_path",
+                        help="repository root path on the relay node (default: --source_path)")
     parser.add_argument("--source_path", required=False,
                         dest="source_path", default='/hol/lib',
                         help="repository root path on source catalog node")
     parser.add_argument("--config", required=False, default='../config.yaml',
                         dest="yaml_config_path",
                         help='path to the config file (YAML)')
+    parser.add_argument("--engine", required=False, choices=PULL_ENGINES,
+                        dest="engine",
+                        help="transfer engine (default: Infrastructure pull_engine in the config, else native)")
+    parser.add_argument("--progress_json", required=False, action="store_true",
+                        dest="progress_json", default=False,
+                        help="print native engine progress events as JSON lines on stdout")
 
     args = parser.parse_args()
 
     # Read the configuration / environment settings
     config = read_hol_xfer_config(args.yaml_config_path)
-    ssh_username = config['Infrastructure']['ssh_username']
+    if args.engine:
+        config['Infrastructure']['pull_engine'] = args.engine
     if check_requirements(config):
-        pull_and_verify(
-            config,
-            args.vapp_template_name,
-            args.repository,
-            args.source_catalog,
-            args.source_path)
+        if not pull_and_verify(
+                config,
+                args.vapp_template_name,
+                args.repository,
+                args.source_catalog,
+                args.source_path,
+                progress_callback=print_progress_event if args.progress_json else None,
+                peers=args.peers,
+                relay_from=args.relay_from,
+                relay_path=args.relay_path):
+            exit(98)
     else:
         exit(99)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import os
+from hol.xfer import reap_trash, get_trash_bytes, REAP_BYTES_PER_SECOND
+from hol.ovf import BYTES_PER_GB, BYTES_PER_MB
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--max_mb_per_second", required=False, type=int,
+                        dest="max_mb_per_second", default=REAP_BYTES_PER_SECOND // BYTES_PER_MB,
+                        help="upper bound on the rate at which trash is deleted (0 = unbounded)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+    pending_gb = get_trash_bytes(args.repository) / BYTES_PER_GB
+    logging.info(f'{pending_gb:.2f} GB waiting in the trash')
+    released = reap_trash(args.repository, args.max_mb_per_second * BYTES_PER_MB)
+    if released is None:
+        logging.info('another reaper is already running')
+    else:
+        logging.info(f'released {released / BYTES_PER_GB:.2f} GB')
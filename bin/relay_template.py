@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# stream a vApp template from one cloud to another through this node, without staging it on disk first
+# NOTE: requires the patched pyvcloud org.py (create_ovf_upload, upload_stream) from pyvcloud-patches
+
+import os
+import time
+from hol.xfer import read_hol_xfer_config, read_hol_xfer_auth, get_cloud_creds, \
+    SpaceReservationLedger, RESERVATION_MARGIN
+from hol.xfer.vcd import VcdSession, VcdRestError, estimate_vcd_template_size
+from hol.xfer.relay import relay_template, RELAY_BUFFER_SIZE, RELAY_FRAGMENT_SIZE
+from hol.xfer.export import SourceFingerprint, record_source_fingerprint, export_staging_path
+from hol.ovf import BYTES_PER_MB, BYTES_PER_GB, DigestCache
+from hol.library import record_library_event, EVENT_EXPORTED, EVENT_IMPORTED
+from pyvcloud.vcd.org import Org
+from pyvcloud.vcd.client import BasicLoginCredentials
+from pyvcloud.vcd.client import Client
+from pyvcloud.vcd.exceptions import VcdException
+from tqdm import tqdm
+import requests
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def connect_target_org(cloud_host, cloud_org, credentials):
+    """
+    :return: (pyvcloud Client, Org) logged in to the target cloud
+    """
+    user_name, vcd_password = get_cloud_creds(credentials, cloud_host, cloud_org)
+    client = Client(cloud_host, verify_ssl_certs=True)
+    client.set_highest_supported_version()
+    client.set_credentials(BasicLoginCredentials(user=user_name, org=cloud_org, password=vcd_password))
+    return client, Org(client, resource=client.get_org_by_name(cloud_org))
+
+
+def reserve_tee_space(session, ledger, cloud_catalog, vapp_template_name, repository, wait_minutes):
+    """
+    the tee copy is assembled in the staging directory: what is already there counts against the reservation
+    :return: reservation id, or None if the library has no room for the tee copy
+    """
+    estimated_bytes, source = estimate_vcd_template_size(session, cloud_catalog, vapp_template_name)
+    if not estimated_bytes:
+        logging.warning(f'unable to size {vapp_template_name} ({source}), the tee copy is not reserved')
+        estimated_bytes = 0
+    return ledger.wait_and_reserve(vapp_template_name, int(estimated_bytes * (1 + RESERVATION_MARGIN)),
+                                   path=export_staging_path(repository, vapp_template_name),
+                                   timeout=wait_minutes * 60)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='relay a vApp template from a source cloud to a target cloud: the files '
+                                        'are streamed from the source transfer URIs into upload ranges on the '
+                                        'target through a bounded memory buffer')
+    parser.add_argument("--cloud_host", required=True,
+                        dest="cloud_host",
+                        help="the hostname of the source cloud")
+    parser.add_argument("--cloud_org", required=True,
+                        dest="cloud_org",
+                        help="the org name within the source cloud")
+    parser.add_argument("--cloud_catalog", required=True,
+                        dest="cloud_catalog",
+                        help="name of the source VCD catalog containing the vApp template")
+    parser.add_argument("--target_cloud_host", required=True,
+                        dest="target_cloud_host",
+                        help="the hostname of the target cloud")
+    parser.add_argument("--target_cloud_org", required=True,
+                        dest="target_cloud_org",
+                        help="the org name within the target cloud")
+    parser.add_argument("--target_cloud_catalog", required=True,
+                        dest="target_cloud_catalog",
+                        help="name of the target VCD catalog")
+    parser.add_argument("--vapp_template_name", required=True,
+                        dest="vapp_template_name",
+                        help="name of the vApp template (catalog item)")
+    parser.add_argument("--target_name", required=False,
+                        dest="target_name", default=None,
+                        help="name of the new catalog item on the target (default: the same)")
+    parser.add_argument("--buffer_mb", required=False, type=int,
+                        dest="buffer_mb", default=RELAY_BUFFER_SIZE // BYTES_PER_MB,
+                        help="memory between the download and the upload of each file, in MB")
+    parser.add_argument("--fragment_mb", required=False, type=int,
+                        dest="fragment_mb", default=RELAY_FRAGMENT_SIZE // BYTES_PER_MB,
+                        help="size of each upload range, in MB")
+    parser.add_argument("--no_scrub", required=False, action="store_false",
+                        dest="scrub", default=True,
+                        help="upload the source descriptor as it is")
+    parser.add_argument("--tee", required=False, action="store_true",
+                        dest="tee", default=False,
+                        help="also write the template to the repository as it streams through")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository (--tee)")
+    parser.add_argument("--wait_minutes", required=False, type=int,
+                        dest="wait_minutes", default=0,
+                        help="--tee: wait up to this long for space in the repository")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    args = parser.parse_args()
+
+    # Read the configuration / environment settings
+    config = read_hol_xfer_config(args.yaml_config_path)
+    creds = read_hol_xfer_auth(config['Tools']['credentials'])
+    if args.tee and os.path.isfile(os.path.join(args.repository, args.vapp_template_name,
+                                                f'{args.vapp_template_name}.ovf')):
+        logging.info(f'{args.vapp_template_name} is already in {args.repository}, it will be replaced')
+
+    source_user, source_password = get_cloud_creds(creds, args.cloud_host, args.cloud_org)
+    client, target_org = connect_target_org(args.target_cloud_host, args.target_cloud_org, creds)
+    ledger = SpaceReservationLedger(args.repository) if args.tee else None
+    digest_cache = DigestCache.for_library(args.repository) if args.tee else None
+    reservation_id = None
+    progress_bar = tqdm(desc='Relay', unit='B', unit_scale=True)
+    relay_start = time.time()
+    try:
+        with VcdSession(args.cloud_host, args.cloud_org, source_user, source_password) as session:
+            record = session.find_catalog_item(args.cloud_catalog, args.vapp_template_name)
+            if record is None:
+                logging.error(f'{args.vapp_template_name} is not in '
+                              f'{args.cloud_host}/{args.cloud_org}/{args.cloud_catalog}')
+                exit(1)
+            if args.tee:
+                reservation_id = reserve_tee_space(session, ledger, args.cloud_catalog, args.vapp_template_name,
+                                                   args.repository, args.wait_minutes)
+                if reservation_id is None:
+                    logging.error(f'no room for a copy of {args.vapp_template_name} in {args.repository}: '
+                                  f'{ledger.available_bytes() / BYTES_PER_GB:.2f} GB unreserved')
+                    exit(97)
+            result = relay_template(session, args.cloud_catalog, args.vapp_template_name, target_org,
+                                    args.target_cloud_catalog, item_name=args.target_name, scrub=args.scrub,
+                                    buffer_size=args.buffer_mb * BYTES_PER_MB,
+                                    fragment_size=args.fragment_mb * BYTES_PER_MB,
+                                    tee_repository=args.repository if args.tee else None,
+                                    digest_cache=digest_cache, progress_callback=progress_bar.update)
+    except (VcdRestError, VcdException, requests.RequestException, OSError) as e:
+        logging.error(f'relay of {args.vapp_template_name} failed: {e}')
+        exit(1)
+    finally:
+        progress_bar.close()
+        if reservation_id is not None:
+            ledger.release(reservation_id)
+        if digest_cache is not None:
+            digest_cache.close()
+        client.logout()
+    if result is None:
+        # removed from the catalog since the lookup above
+        logging.error(f'{args.vapp_template_name} is no longer in {args.cloud_catalog}')
+        exit(1)
+    relays = result[0]
+    relay_seconds = time.time() - relay_start
+    relayed_bytes = sum(r.relayed_bytes for r in relays)
+    logging.info(f'{args.vapp_template_name}: {relayed_bytes / BYTES_PER_GB:.2f} GB relayed in {relay_seconds:.0f} s '
+                 f'({relayed_bytes / BYTES_PER_MB / max(relay_seconds, 1):.1f} MB/s)')
+    if args.tee:
+        target = f'{args.target_cloud_host}/{args.target_cloud_org}/{args.target_cloud_catalog}'
+        record_library_event(args.repository, args.vapp_template_name, EVENT_EXPORTED, detail=f'relayed to {target}',
+                             source_cloud=args.cloud_host, source_org=args.cloud_org,
+                             source_catalog=args.cloud_catalog, duration=relay_seconds)
+        record_library_event(args.repository, args.vapp_template_name, EVENT_IMPORTED, detail=target)
+        try:
+            record_source_fingerprint(args.repository, args.vapp_template_name,
+                                      SourceFingerprint.from_catalog_record(record, args.cloud_host, args.cloud_org,
+                                                                            args.cloud_catalog))
+        except (OSError, ValueError) as e:
+            logging.warning(f'unable to record the source fingerprint of {args.vapp_template_name}: {e}')
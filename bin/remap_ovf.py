@@ -1,21 +1,73 @@
 #!/usr/bin/env python3
 
+# NOTE: requires key-based ssh to the source catalog node (and hol-xfer installed there for the grain signatures)
+
 import os
-from hol.ovf import remap_ovf_for_rsync
+import shlex
+import subprocess
+from hol.ovf import remap_ovf_for_rsync, BYTES_PER_MB
 from hol.xfer import read_hol_xfer_config
+from hol.pull.delta import delta_sync_from_source
 import logging
-import shutil
 
 logging.basicConfig(level=logging.INFO)
 
 
 def obtain_new_ovf(template_name, local_ovf_path, catalog_host, catalog_user, remote_lib_path):
-    return
+    """
+    fetch the new version's descriptor (and manifest, if there is one) from the catalog node
+    :param local_ovf_path: directory to put them in
+    :return: full path of the local OVF, or None
+    """
+    fetched = None
+    for suffix in ('.ovf', '.mf'):
+        remote_file = os.path.join(remote_lib_path, template_name, f'{template_name}{suffix}')
+        result = subprocess.run(['ssh', '-o', 'BatchMode=yes', f'{catalog_user}@{catalog_host}',
+                                 f'cat {shlex.quote(remote_file)}'], capture_output=True)
+        if result.returncode != 0:
+            if suffix == '.ovf':
+                logging.error(f'{catalog_host}: unable to read {remote_file}: {result.stderr.decode().strip()}')
+                return None
+            continue
+        local_file = os.path.join(local_ovf_path, f'{template_name}{suffix}')
+        with open(local_file, 'wb') as f:
+            f.write(result.stdout)
+        if suffix == '.ovf':
+            fetched = local_file
+    return fetched
+
+
+def delta_sync_disks(configuration, clones, template_name, new_ovf_dir, repository, source_catalog, source_path):
+    """
+    bring each cloned disk up to date with the grains that changed; a disk that cannot be delta-synced is removed
+    so that the pull fetches it whole
+    """
+    fetched, total = 0, 0
+    for new_file_name, (old_file_name, method) in clones.items():
+        if not new_file_name.lower().endswith('.vmdk'):
+            continue
+        local_file = os.path.join(new_ovf_dir, new_file_name)
+        remote_file = os.path.join(source_path, template_name, new_file_name)
+        try:
+            stats = delta_sync_from_source(configuration, source_catalog, remote_file, source_path, [local_file],
+                                           local_file, repository=repository)
+        except Exception as e:
+            logging.warning(f'{new_file_name}: delta transfer failed ({e}), it will be pulled whole')
+            os.remove(local_file)
+            continue
+        fetched += stats.fetched_bytes
+        total += stats.total_bytes
+        logging.info(f'{new_file_name}: {stats.fetched_grains} of {stats.grains} grain(s) changed, '
+                     f'{stats.fetched_bytes / BYTES_PER_MB:.1f} of {stats.total_bytes / BYTES_PER_MB:.1f} MB fetched')
+    if total:
+        logging.info(f'delta transfers fetched {fetched / BYTES_PER_MB:.1f} of {total / BYTES_PER_MB:.1f} MB')
 
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
-    parser = ArgumentParser()
+    parser = ArgumentParser(description='seed a new template version from the old one (reflink clones under the '
+                                        'new names), fetch only the grains that changed, then pull and verify '
+                                        'the rest')
     parser.add_argument("--vapp_template_name", required=True,
                         dest="vapp_template_name",
                         help="name of the vApp template (OVF base name)")
@@ -25,9 +77,6 @@ if __name__ == '__main__':
     parser.add_argument("--repository", required=False,
                         dest="repository", default='/hol/lib',
                         help="path to the local repository")
-    parser.add_argument("--seeds", required=False,
-                        dest="seed_dir", default='/hol/seeds',
-                        help="path to the local seeds (temp) directory on the same file system as the repository")
     parser.add_argument("--source_catalog", required=True,
                         dest="source_catalog",
                         help="name or IP of the source catalog node")
@@ -37,46 +86,55 @@ if __name__ == '__main__':
     parser.add_argument("--config", required=False, default='../config.yaml',
                         dest="yaml_config_path",
                         help='path to the config file (YAML)')
+    parser.add_argument("--remap_only", required=False, action="store_true",
+                        dest="remap_only", default=False,
+                        help="only fetch the new OVF and clone the old disks under the new names")
     args = parser.parse_args()
 
     # Read the configuration / environment settings
     config = read_hol_xfer_config(args.yaml_config_path)
     ssh_username = config['Infrastructure']['ssh_username']
 
-    # root path sanity check (don't want to copy hundreds of GB across file systems)
-    if os.path.split(args.repository)[0] != os.path.split(args.seed_dir)[0]:
-        logging.error(
-            f'Not efficient to have lib and seeds on different file systems!')
-        exit(99)
-    else:
-        root_path = os.path.split(args.repository)[0]
-
-    # the location of the "current" version
+    # the location of the "current" version -- it stays where it is, and usable
     old_ovf_dir = os.path.join(args.repository, args.vapp_template_name_old)
-    old_ovf = os.path.join(old_ovf_dir, f'{args.vapp_template_name}.ovf')
+    old_ovf = os.path.join(old_ovf_dir, f'{args.vapp_template_name_old}.ovf')
 
-    # the new version (we only have the OVF)
+    # the new version (we start with only the OVF)
     new_ovf_dir = os.path.join(args.repository, args.vapp_template_name)
     new_ovf = os.path.join(new_ovf_dir, f'{args.vapp_template_name}.ovf')
 
-    # ensure old_ovf exists and new_ovf does not
-    if os.path.isfile(old_ovf) and not os.path.exists(new_ovf):
-        # create the new_ovf_dir in repository
-        try:
-            os.makedirs(new_ovf_dir)
-        except PermissionError as pe:
-            logging.error(pe)
-        else:
-            # obtain the new OVF file (rsync from catalog, remote library to new_ovf_dir)
-            if obtain_new_ovf(args.vapp_template_name, new_ovf_dir,
-                              args.source_catalog, ssh_username, args.source_path):
-                # TODO: check that the seed_dir exists before firing off the move?
-                # move the old_ovf_dir into seed_dir to prep for remapping operation
-                old_ovf_seed_dir = shutil.move(old_ovf_dir, args.seed_dir)
-                old_ovf_seed = os.path.join(
-                    old_ovf_seed_dir, f'{args.vapp_template_name_old}.ovf')
-                remap_ovf_for_rsync(source_file=old_ovf_seed, target_file=new_ovf,
-                                    lib_dir=args.repository, seed_dir=args.seed_dir)
-            else:
-                logging.error(
-                    f'Unable to download new OVF for {args.vapp_template_name} from {args.source_catalog}')
+    if not os.path.isfile(old_ovf):
+        logging.error(f'{old_ovf} does not exist')
+        exit(99)
+    try:
+        # an existing directory is a remap that was interrupted: carry on with it
+        os.makedirs(new_ovf_dir, exist_ok=True)
+    except PermissionError as pe:
+        logging.error(pe)
+        exit(99)
+
+    # obtain the new OVF file (from catalog, remote library to new_ovf_dir)
+    if not obtain_new_ovf(args.vapp_template_name, new_ovf_dir,
+                          args.source_catalog, ssh_username, args.source_path):
+        logging.error(
+            f'Unable to download new OVF for {args.vapp_template_name} from {args.source_catalog}')
+        exit(98)
+
+    # clone the old disks under the new names (reflink where the filesystem can, so both versions stay valid).
+    # The delta transfer and the native pull write beside a file and rename over it, so a hard link is safe with
+    # them; lftp mirror rewrites changed files in place, which would change the old template through the link.
+    pull_engine = config['Infrastructure'].get('pull_engine', 'native')
+    clones = remap_ovf_for_rsync(source_file=old_ovf, target_file=new_ovf, allow_hardlink=pull_engine == 'native')
+    if args.remap_only:
+        exit(0)
+
+    delta_sync_disks(config, clones, args.vapp_template_name, new_ovf_dir, args.repository, args.source_catalog,
+                     args.source_path)
+
+    # everything else (new disks, descriptor, manifest), then verify the whole template against the source
+    pull_command = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pull_template.py'),
+                    '--vapp_template_name', args.vapp_template_name, '--repository', args.repository,
+                    '--source_catalog', args.source_catalog, '--source_path', args.source_path,
+                    '--config', args.yaml_config_path]
+    logging.info(f"running {' '.join(pull_command)}")
+    exit(subprocess.run(pull_command).returncode)
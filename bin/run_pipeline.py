@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+from prettytable import PrettyTable
+from hol.xfer import read_hol_xfer_config, read_hol_xfer_auth
+from hol.jobs.pipeline import Pipeline, DEFAULT_STAGES, PIPELINE_STAGES, DEFAULT_QUEUE_DEPTH, \
+    DEFAULT_STAGE_ATTEMPTS
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def read_template_names(file_name):
+    with open(file_name) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='export, validate, scrub and import a list of templates, with the stages '
+                                        'overlapping (export N+1 while importing N)')
+    parser.add_argument("--vapp_template_name", required=False, action="append", default=[],
+                        dest="templates",
+                        help="name of a vApp template (may be repeated)")
+    parser.add_argument("--templates_file", required=False,
+                        dest="templates_file",
+                        help="file with one template name per line")
+    parser.add_argument("--stages", required=False,
+                        dest="stages", default=','.join(DEFAULT_STAGES),
+                        help=f"comma-separated stages, in order, from {','.join(PIPELINE_STAGES)}")
+    parser.add_argument("--cloud_host", required=False,
+                        dest="cloud_host",
+                        help="the hostname of the source cloud")
+    parser.add_argument("--cloud_org", required=False,
+                        dest="cloud_org",
+                        help="the org name within the source cloud")
+    parser.add_argument("--cloud_catalog", required=False,
+                        dest="cloud_catalog",
+                        help="name of the source VCD catalog")
+    parser.add_argument("--target_cloud_host", required=False,
+                        dest="target_cloud_host",
+                        help="the hostname of the target cloud")
+    parser.add_argument("--target_cloud_org", required=False,
+                        dest="target_cloud_org",
+                        help="the org name within the target cloud")
+    parser.add_argument("--target_cloud_catalog", required=False,
+                        dest="target_cloud_catalog",
+                        help="name of the target VCD catalog")
+    parser.add_argument("--rtc_start_time", required=False, type=int,
+                        dest="rtc_start_time",
+                        help="time bubble start (for the bubble stage)")
+    parser.add_argument("--level", required=False,
+                        dest="level",
+                        help="validation level (for the validate stage)")
+    parser.add_argument("--queue_depth", required=False, type=int,
+                        dest="queue_depth", default=DEFAULT_QUEUE_DEPTH,
+                        help="templates that may wait between two stages")
+    parser.add_argument("--export_workers", required=False, type=int,
+                        dest="export_workers", default=1,
+                        help="concurrent exports")
+    parser.add_argument("--import_workers", required=False, type=int,
+                        dest="import_workers", default=1,
+                        help="concurrent imports")
+    parser.add_argument("--attempts", required=False, type=int,
+                        dest="attempts", default=DEFAULT_STAGE_ATTEMPTS,
+                        help="tries per stage")
+    parser.add_argument("--evict_after_import", required=False, action="store_true",
+                        dest="evict_after_import", default=False,
+                        help="move each template to the library trash once it is imported")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the results as JSON")
+    args = parser.parse_args()
+
+    templates = list(args.templates)
+    if args.templates_file:
+        templates += read_template_names(args.templates_file)
+    if not templates:
+        parser.error('no templates given')
+    if not os.path.isdir(args.repository):
+        logging.error(f'Repository "{args.repository}" is not a directory!')
+        exit(1)
+
+    config = read_hol_xfer_config(args.yaml_config_path)
+    source = {'cloud_host': args.cloud_host, 'cloud_org': args.cloud_org, 'cloud_catalog': args.cloud_catalog} \
+        if args.cloud_host else None
+    target = {'cloud_host': args.target_cloud_host, 'cloud_org': args.target_cloud_org,
+              'cloud_catalog': args.target_cloud_catalog} if args.target_cloud_host else None
+    creds = read_hol_xfer_auth(config['Tools']['credentials']) if source else None
+    try:
+        pipeline = Pipeline(config, args.yaml_config_path, args.repository, stages=args.stages.split(','),
+                            source=source, target=target, rtc_start_time=args.rtc_start_time,
+                            validation_level=args.level, queue_depth=args.queue_depth,
+                            workers={'export': args.export_workers, 'import': args.import_workers},
+                            attempts=args.attempts, evict_after_import=args.evict_after_import, credentials=creds)
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.monotonic()
+    results = pipeline.run(templates)
+    elapsed = time.monotonic() - start
+    if args.json_output:
+        print(json.dumps({'elapsed': round(elapsed, 1), 'results': [r.to_dict() for r in results]}, indent=2))
+    else:
+        table = PrettyTable(['Template', 'Result'] + pipeline.stages)
+        table.align = 'l'
+        for r in results:
+            status = 'OK' if r.ok else f'FAILED ({r.failed_stage})'
+            table.add_row([r.template, status] + [r.durations.get(stage, '') for stage in pipeline.stages])
+        print(table)
+        serial = sum(sum(r.durations.values()) for r in results)
+        print(f'{len(results)} template(s) in {elapsed:.0f}s ({serial:.0f}s of stage time)')
+    exit(0 if all(r.ok for r in results) else 1)
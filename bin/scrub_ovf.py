@@ -3,7 +3,8 @@
 # EXAMPLE: scrub_ovf.py --repository /hol/lib --vapp_template_name 2vm_blank
 
 import os
-from hol.ovf import scrub_the_ovf, update_the_manifest
+from hol.ovf import scrub_the_ovf, update_the_manifest, DigestCache
+from hol.library import record_library_event, EVENT_SCRUBBED
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -19,7 +20,9 @@ def perform_ovf_scrubbing(vapp_template_name, repository):
             scrub_the_ovf(
                 ovf_file=full_file_target,
                 backup_file=backup_file_path)
-            update_the_manifest(ovf_file=full_file_target)
+            update_the_manifest(ovf_file=full_file_target,
+                                digest_cache=DigestCache.for_library(repository))
+            record_library_event(repository, vapp_template_name, EVENT_SCRUBBED)
         except PermissionError as err:
             logging.error(f'unable to write backup file? {err}')
     else:
@@ -3,9 +3,10 @@
 # EXAMPLE: time_bubble.py --repository /hol/lib --vapp_template_name 2vm_blank --rtc_start_time 1702666800
 
 import os
-from hol.ovf import bubble_the_ovf, update_the_manifest, unbubble_the_ovf
+from hol.ovf import bubble_the_ovf, update_the_manifest, unbubble_the_ovf, DigestCache
 from time import ctime
 
+from hol.library import record_library_event, EVENT_BUBBLED, EVENT_UNBUBBLED
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -27,7 +28,13 @@ def time_bubble_ovf(rtc_start_time, vapp_template_name, repository):
                 unbubble_the_ovf(
                     ovf_file=full_file_target,
                     backup_file=backup_file_path)
-            update_the_manifest(ovf_file=full_file_target)
+            update_the_manifest(ovf_file=full_file_target,
+                                digest_cache=DigestCache.for_library(repository))
+            if rtc_start_time > 0:
+                record_library_event(repository, vapp_template_name, EVENT_BUBBLED,
+                                     detail=f'rtc start {rtc_start_time}')
+            else:
+                record_library_event(repository, vapp_template_name, EVENT_UNBUBBLED)
         except PermissionError as err:
             logging.error(f'unable to write backup file? {err}')
     else:
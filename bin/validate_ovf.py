@@ -1,24 +1,43 @@
 #!/usr/bin/env python3
 import os
-from hol.ovf import validate_the_ovf
+import json
+from hol.ovf import get_ovf_validation_report, VALIDATION_LEVELS, VALIDATION_FAST, DigestCache
+from hol.library import record_library_event, EVENT_VALIDATED
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
 
-def perform_ovf_validation(vapp_template_name, repository):
+def perform_ovf_validation(vapp_template_name, repository, level=VALIDATION_FAST, json_output=False):
     ovf_file_name = f'{vapp_template_name}.ovf'
     full_file_target = os.path.join(
         repository, vapp_template_name, ovf_file_name)
     if os.path.isfile(full_file_target):
-        if validate_the_ovf(full_file_target, verbose=True):
+        report = get_ovf_validation_report(full_file_target, level=level,
+                                           digest_cache=DigestCache.for_library(repository))
+        record_library_event(repository, vapp_template_name, EVENT_VALIDATED, level=level, ok=report['ok'])
+        if json_output:
+            print(json.dumps(report, indent=2))
+            return 0 if report['ok'] else 99
+        for entry in report['files']:
+            line = f"{entry['name']}: Expected Size: {entry['expected_size']}, found Size: {entry['found_size']}"
+            if entry['problems']:
+                line += f" => {', '.join(entry['problems'])}"
+            print(line)
+        for error in report['errors']:
+            logging.error(error)
+        if report['ok']:
             print('SUCCESS')
             return 0
         else:
             logging.error(
-                'missing or incorrectly-sized component file(s)')
+                'missing, incorrectly-sized or corrupt component file(s)')
     else:
         logging.error(f'unable to find OVF file: {full_file_target}')
+        if json_output:
+            print(json.dumps({'ovf': full_file_target, 'level': level, 'ok': False, 'files': [],
+                              'errors': ['OVF file not found']}, indent=2))
+            return 99
     print('FAIL')
     return 99
 
@@ -32,9 +51,18 @@ if __name__ == '__main__':
     parser.add_argument("--repository", required=False,
                         dest="repository", default='/hol/lib',
                         help="path to the local repository")
+    parser.add_argument("--level", required=False,
+                        dest="level", default=VALIDATION_FAST, choices=VALIDATION_LEVELS,
+                        help="fast: existence + size, structural: + manifest coverage and header/footer "
+                             "sanity, full: + digests checked against the manifest")
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the validation result as JSON")
     args = parser.parse_args()
 
     ret = perform_ovf_validation(
         args.vapp_template_name,
-        args.repository)
+        args.repository,
+        args.level,
+        args.json_output)
     exit(ret)
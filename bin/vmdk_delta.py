@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# NOTE: "sync" requires key-based ssh to the source catalog node and hol-xfer installed there (for "signature")
+
+import os
+import json
+from hol.xfer import read_hol_xfer_config
+from hol.ovf import BYTES_PER_MB
+from hol.ovf.vmdk import load_grain_signature, GRAIN_SIGNATURE_SUFFIX
+from hol.pull.delta import grain_signature_cache_dir, delta_sync_from_source
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+COMMANDS = ('signature', 'sync')
+
+
+def signature_command(vmdk_file, repository):
+    """
+    make sure the grain signature of a library VMDK is cached
+    :return: path of the cached signature
+    """
+    cache_dir = grain_signature_cache_dir(repository, vmdk_file)
+    if cache_dir is None:
+        raise ValueError(f'{vmdk_file} is not in the repository {repository}')
+    load_grain_signature(vmdk_file, cache_dir)
+    return os.path.join(cache_dir, os.path.basename(vmdk_file) + GRAIN_SIGNATURE_SUFFIX)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='per-grain delta transfer of streamOptimized VMDKs between template versions')
+    parser.add_argument("command", choices=COMMANDS,
+                        help="signature: hash the grains of a local VMDK (run on the source by sync); "
+                             "sync: rebuild a source VMDK here from local seeds plus the grains that changed")
+    parser.add_argument("--file", required=False,
+                        dest="file",
+                        help="the VMDK: local (signature) or on the source catalog node (sync)")
+    parser.add_argument("--repository", required=False,
+                        dest="repository", default='/hol/lib',
+                        help="path to the local repository (signatures are cached in "
+                             "<repository>/.grainsigs)")
+    parser.add_argument("--source_catalog", required=False,
+                        dest="source_catalog",
+                        help="name or IP of the source catalog node (sync)")
+    parser.add_argument("--source_path", required=False,
+                        dest="source_path", default='/hol/lib',
+                        help="repository root path on source catalog node (sync)")
+    parser.add_argument("--seed", required=False, action="append", default=[],
+                        dest="seeds",
+                        help="local VMDK to take unchanged grains from, usually the previous version "
+                             "(may be repeated; sync)")
+    parser.add_argument("--target", required=False,
+                        dest="target",
+                        help="where to write the rebuilt VMDK (sync)")
+    parser.add_argument("--config", required=False, default='../config.yaml',
+                        dest="yaml_config_path",
+                        help='path to the config file (YAML)')
+    parser.add_argument("--json", required=False, action="store_true",
+                        dest="json_output", default=False,
+                        help="print the sync statistics as JSON")
+    args = parser.parse_args()
+
+    if not args.file:
+        parser.error('--file is required')
+    if args.command == 'signature':
+        try:
+            print(signature_command(os.path.abspath(args.file), os.path.abspath(args.repository)))
+        except (OSError, ValueError) as e:
+            logging.error(e)
+            exit(1)
+        exit(0)
+
+    if not args.source_catalog or not args.target or not args.seeds:
+        parser.error('sync needs --source_catalog, --target and at least one --seed')
+    config = read_hol_xfer_config(args.yaml_config_path)
+    try:
+        stats = delta_sync_from_source(config, args.source_catalog, args.file, args.source_path, args.seeds,
+                                       args.target, args.repository)
+    except Exception as e:
+        logging.error(e)
+        exit(1)
+    if args.json_output:
+        print(json.dumps(stats.to_dict(), indent=2))
+    else:
+        print(f'{stats.grains} grain(s): {stats.copied_grains} copied, {stats.recompressed_grains} re-deflated, '
+              f'{stats.fetched_grains} fetched; {stats.fetched_bytes / BYTES_PER_MB:.1f} of '
+              f'{stats.total_bytes / BYTES_PER_MB:.1f} MB over the network in {stats.elapsed}s')
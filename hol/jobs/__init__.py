@@ -0,0 +1,450 @@
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import logging
+import sqlite3
+import threading
+import subprocess
+import socketserver
+from hol.ovf import INDEX_DB_NAME, BYTES_PER_GB
+from hol.xfer.vcd import VcdSessionPool, estimate_vcd_template_size
+
+JOB_EXPORT = 'export'
+JOB_PULL = 'pull'
+JOB_VALIDATE = 'validate'
+JOB_SCRUB = 'scrub'
+JOB_BUBBLE = 'bubble'
+JOB_IMPORT = 'import'
+# job kind => (bin script, required parameters, optional parameters)
+JOB_KINDS = {
+    JOB_EXPORT: ('export_ovf.py', ('cloud_host', 'cloud_org', 'cloud_catalog'),
+                 ('cleanup_pattern', 'wait_minutes', 'estimated_gb', 'freshness')),
+    JOB_PULL: ('pull_template.py', ('source_catalog',), ('source_path',)),
+    JOB_VALIDATE: ('validate_ovf.py', (), ('level',)),
+    JOB_SCRUB: ('scrub_ovf.py', (), ()),
+    JOB_BUBBLE: ('time_bubble.py', ('rtc_start_time',), ()),
+    JOB_IMPORT: ('import_ovf.py', ('cloud_host', 'cloud_org', 'cloud_catalog'), ()),
+}
+# these scripts take --config
+CONFIG_SCRIPTS = ('export_ovf.py', 'pull_template.py', 'import_ovf.py', 'import_ovf_new.py')
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_CANCELLED = 'cancelled'
+
+DEFAULT_SOCKET_PATH = '/tmp/hol-xfer.sock'
+DEFAULT_WORKERS = 4
+DEFAULT_PER_CLOUD = 2
+DEFAULT_PER_DISK = 3
+DEFAULT_MAX_ATTEMPTS = 4
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 3600
+DISPATCH_INTERVAL = 2
+# the library directory (skipped by cleanup and the index) holding one log per job
+JOB_LOG_DIR_NAME = '.jobs'
+
+logging.basicConfig(level=logging.INFO)
+
+
+class JobStore:
+    """
+    the persistent job queue: a jobs table in <library>/.hol-index.sqlite, so queued work survives a restart
+    """
+
+    def __init__(self, repository: str):
+        self.repository = repository
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(repository, INDEX_DB_NAME), timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self._lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                            'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, template TEXT NOT NULL, '
+                            'params TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                            'max_attempts INTEGER NOT NULL, not_before REAL NOT NULL DEFAULT 0, '
+                            'submitted_at REAL, started_at REAL, finished_at REAL, exit_code INTEGER, '
+                            'last_error TEXT)')
+
+    def submit(self, kind: str, template: str, params=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :return: the new job id
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f'unknown job kind {kind}, expected one of {list(JOB_KINDS)}')
+        params = params or {}
+        script, required, optional = JOB_KINDS[kind]
+        missing = [p for p in required if not params.get(p)]
+        if missing:
+            raise ValueError(f'{kind} needs {missing}')
+        unknown = [p for p in params if p not in required + optional]
+        if unknown:
+            raise ValueError(f'{kind} does not take {unknown}')
+        with self._lock, self.db:
+            cursor = self.db.execute('INSERT INTO jobs (kind, template, params, state, max_attempts, submitted_at) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     (kind, template, json.dumps(params), STATE_QUEUED, max_attempts, time.time()))
+        return cursor.lastrowid
+
+    def get(self, job_id):
+        with self._lock:
+            row = self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+
+    def list(self, states=None, limit=100):
+        """
+        :param states: only jobs in these states
+        :return: list of job dicts, newest first
+        """
+        query = 'SELECT * FROM jobs'
+        args = []
+        if states:
+            query += f" WHERE state IN ({', '.join('?' * len(states))})"
+            args.extend(states)
+        query += ' ORDER BY id DESC LIMIT ?'
+        args.append(limit)
+        with self._lock:
+            rows = self.db.execute(query, args).fetchall()
+        return [_job_dict(row) for row in rows]
+
+    def runnable(self, now=None):
+        """
+        :return: queued jobs whose backoff has expired, oldest first
+        """
+        with self._lock:
+            rows = self.db.execute('SELECT * FROM jobs WHERE state = ? AND not_before <= ? ORDER BY id',
+                                   (STATE_QUEUED, now or time.time())).fetchall()
+        return [_job_dict(row) for row in rows]
+
+    def update(self, job_id, **columns):
+        assignments = ', '.join(f'{column} = ?' for column in columns)
+        with self._lock, self.db:
+            self.db.execute(f'UPDATE jobs SET {assignments} WHERE id = ?', (*columns.values(), job_id))
+
+    def claim(self, job_id):
+        """
+        atomically move a queued job to running
+        :return: True if this caller got it
+        """
+        with self._lock, self.db:
+            cursor = self.db.execute('UPDATE jobs SET state = ?, started_at = ?, attempts = attempts + 1 '
+                                     'WHERE id = ? AND state = ?', (STATE_RUNNING, time.time(), job_id, STATE_QUEUED))
+        return cursor.rowcount == 1
+
+    def requeue_interrupted(self):
+        """
+        jobs left running by a daemon that died go back in the queue (the scripts are idempotent: an export
+        that already finished is a "LUCKY DAY", lftp mirror resumes)
+        :return: number of jobs requeued
+        """
+        with self._lock, self.db:
+            cursor = self.db.execute('UPDATE jobs SET state = ?, attempts = MAX(attempts - 1, 0) WHERE state = ?',
+                                     (STATE_QUEUED, STATE_RUNNING))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def _job_dict(row):
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    return job
+
+
+def script_command(scripts_path: str, repository: str, config_path: str, kind: str, template: str, params=None):
+    """
+    :return: the argv running one job kind's bin script for a template
+    """
+    script, required, optional = JOB_KINDS[kind]
+    argv = [sys.executable, os.path.join(scripts_path, script),
+            '--vapp_template_name', template, '--repository', repository]
+    if script in CONFIG_SCRIPTS:
+        argv += ['--config', config_path]
+    for name, value in (params or {}).items():
+        argv += [f'--{name}', str(value)]
+    return argv
+
+
+def retry_delay(attempts: int):
+    """
+    exponential backoff with full jitter
+    :param attempts: attempts made so far
+    :return: seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1)))
+
+
+class ConcurrencyLimits:
+    """
+    non-blocking counting limits per key (e.g. per cloud host and per disk): the dispatcher skips jobs whose
+    limits are full instead of blocking the queue behind them
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._counts = {}
+
+    def available(self, key):
+        return key is None or self._counts.get(key, 0) < self.limit
+
+    def acquire(self, key):
+        if key is not None:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def release(self, key):
+        if key is not None:
+            self._counts[key] -= 1
+
+
+class JobDaemon:
+    """
+    runs queued jobs with the bin scripts, at most `workers` at a time and at most per_cloud / per_disk per
+    cloud host (or source catalog node) and per library filesystem; failed jobs are retried with backoff.
+    Export sizes are looked up through warm VCD sessions (one login per cloud/org for the life of the daemon).
+    """
+
+    def __init__(self, config: dict, config_path: str, repository=None, credentials=None):
+        daemon_config = config.get('Daemon') or {}
+        self.config_path = os.path.abspath(config_path)
+        self.repository = repository or config['Library']['path']
+        self.scripts_path = config['Tools']['scripts']
+        self.socket_path = daemon_config.get('socket', DEFAULT_SOCKET_PATH)
+        self.workers = daemon_config.get('workers', DEFAULT_WORKERS)
+        self.per_cloud = ConcurrencyLimits(daemon_config.get('per_cloud', DEFAULT_PER_CLOUD))
+        self.per_disk = ConcurrencyLimits(daemon_config.get('per_disk', DEFAULT_PER_DISK))
+        self.store = JobStore(self.repository)
+        self.log_dir = os.path.join(self.repository, JOB_LOG_DIR_NAME)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.session_pool = None
+        if credentials is not None:
+            self.session_pool = VcdSessionPool(credentials)
+        self._lock = threading.Lock()
+        self._running = {}
+        self._stopping = threading.Event()
+        self._server = None
+
+    # # # # dispatching # # # #
+
+    def _limit_keys(self, job):
+        params = job['params']
+        cloud = params.get('cloud_host') or params.get('source_catalog')
+        disk = os.stat(self.repository).st_dev
+        return cloud, disk
+
+    def dispatch(self):
+        """
+        start whatever can run now
+        :return: number of jobs started
+        """
+        started = 0
+        for job in self.store.runnable():
+            with self._lock:
+                if len(self._running) >= self.workers:
+                    break
+                cloud, disk = self._limit_keys(job)
+                if not (self.per_cloud.available(cloud) and self.per_disk.available(disk)):
+                    continue
+                if not self.store.claim(job['id']):
+                    continue
+                self.per_cloud.acquire(cloud)
+                self.per_disk.acquire(disk)
+                self._running[job['id']] = None
+            threading.Thread(target=self._run, args=(job, cloud, disk), name=f"job-{job['id']}",
+                             daemon=True).start()
+            started += 1
+        return started
+
+    def command(self, job):
+        """
+        :return: the argv running a job
+        """
+        return script_command(self.scripts_path, self.repository, self.config_path, job['kind'], job['template'],
+                              job['params'])
+
+    def _prepare(self, job):
+        # size exports through the warm session so export_ovf.py does not log in just for that
+        if job['kind'] == JOB_EXPORT and self.session_pool is not None and 'estimated_gb' not in job['params']:
+            params = job['params']
+            try:
+                size_bytes, source = self.session_pool.call(
+                    params['cloud_host'], params['cloud_org'],
+                    lambda session: estimate_vcd_template_size(session, params['cloud_catalog'], job['template']))
+            except Exception as e:
+                logging.warning(f"job {job['id']}: unable to size {job['template']}: {e}")
+                return
+            if size_bytes:
+                job['params'] = dict(params, estimated_gb=round(size_bytes / BYTES_PER_GB, 3))
+
+    def _run(self, job, cloud, disk):
+        log_path = os.path.join(self.log_dir, f"{job['id']}.log")
+        exit_code = None
+        error = None
+        try:
+            self._prepare(job)
+            argv = self.command(job)
+            logging.info(f"job {job['id']}: {job['kind']} {job['template']} (attempt {job['attempts'] + 1})")
+            with open(log_path, 'a') as log_f:
+                log_f.write(f"=== {time.ctime()} attempt {job['attempts'] + 1}: {' '.join(argv)}\n")
+                log_f.flush()
+                process = subprocess.Popen(argv, stdout=log_f, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                           cwd=self.scripts_path, start_new_session=True)
+                with self._lock:
+                    self._running[job['id']] = process
+                # cancelled between being claimed and starting
+                if self.store.get(job['id'])['state'] == STATE_CANCELLED:
+                    os.killpg(process.pid, signal.SIGTERM)
+                exit_code = process.wait()
+        except Exception as e:
+            error = str(e)
+            logging.error(f"job {job['id']}: {e}")
+        finally:
+            with self._lock:
+                self._running.pop(job['id'], None)
+                self.per_cloud.release(cloud)
+                self.per_disk.release(disk)
+        self._finish(job, exit_code, error)
+
+    def _finish(self, job, exit_code, error):
+        now = time.time()
+        current = self.store.get(job['id'])
+        if current['state'] == STATE_CANCELLED:
+            logging.info(f"job {job['id']}: cancelled")
+            return
+        if exit_code == 0:
+            self.store.update(job['id'], state=STATE_DONE, finished_at=now, exit_code=0, last_error=None)
+            logging.info(f"job {job['id']}: done")
+            return
+        error = error or f'exit code {exit_code}'
+        attempts = current['attempts']
+        if attempts < current['max_attempts'] and not self._stopping.is_set():
+            delay = retry_delay(attempts)
+            self.store.update(job['id'], state=STATE_QUEUED, not_before=now + delay, exit_code=exit_code,
+                              last_error=error)
+            logging.warning(f"job {job['id']}: {error}, retrying in {delay:.0f}s "
+                            f"({attempts}/{current['max_attempts']} attempts)")
+        elif self._stopping.is_set():
+            # shutting down: put it back for the next start without using up an attempt
+            self.store.update(job['id'], state=STATE_QUEUED, attempts=max(attempts - 1, 0), last_error=error)
+        else:
+            self.store.update(job['id'], state=STATE_FAILED, finished_at=now, exit_code=exit_code,
+                              last_error=error)
+            logging.error(f"job {job['id']}: failed after {attempts} attempt(s): {error}")
+
+    def cancel(self, job_id):
+        """
+        cancel a queued job, or terminate a running one
+        :return: True if the job was queued or running
+        """
+        job = self.store.get(job_id)
+        if job is None or job['state'] not in (STATE_QUEUED, STATE_RUNNING):
+            return False
+        self.store.update(job_id, state=STATE_CANCELLED, finished_at=time.time())
+        with self._lock:
+            process = self._running.get(job_id)
+        if process is not None:
+            os.killpg(process.pid, signal.SIGTERM)
+        return True
+
+    # # # # control socket # # # #
+
+    def handle(self, request: dict):
+        """
+        one control request: {"op": "submit"|"list"|"get"|"cancel"|"ping", ...}
+        :return: response dict
+        """
+        op = request.get('op')
+        if op == 'submit':
+            job_id = self.store.submit(request['kind'], request['template'], request.get('params'),
+                                       request.get('max_attempts', DEFAULT_MAX_ATTEMPTS))
+            self.dispatch()
+            return {'ok': True, 'id': job_id}
+        if op == 'list':
+            return {'ok': True, 'jobs': self.store.list(request.get('states'), request.get('limit', 100))}
+        if op == 'get':
+            return {'ok': True, 'job': self.store.get(request['id'])}
+        if op == 'cancel':
+            return {'ok': self.cancel(request['id'])}
+        if op == 'ping':
+            with self._lock:
+                running = list(self._running)
+            return {'ok': True, 'running': running}
+        return {'ok': False, 'error': f'unknown op {op}'}
+
+    def serve_forever(self):
+        """
+        listen on the Unix socket and dispatch jobs until SIGTERM/SIGINT
+        """
+        requeued = self.store.requeue_interrupted()
+        if requeued:
+            logging.info(f'requeued {requeued} interrupted job(s)')
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except (ValueError, KeyError) as e:
+                        response = {'ok': False, 'error': str(e)}
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.socket_path, 0o660)
+        threading.Thread(target=self._server.serve_forever, name='control', daemon=True).start()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, lambda signum, frame: self._stopping.set())
+        logging.info(f'hol-xfer daemon listening on {self.socket_path}, library {self.repository}')
+        while not self._stopping.is_set():
+            self.dispatch()
+            self._stopping.wait(DISPATCH_INTERVAL)
+        self.shutdown()
+
+    def shutdown(self):
+        logging.info('shutting down: stopping running jobs')
+        self._stopping.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._lock:
+            processes = [p for p in self._running.values() if p is not None]
+        for process in processes:
+            os.killpg(process.pid, signal.SIGTERM)
+        for process in processes:
+            process.wait()
+        # let the job threads record the interruptions
+        deadline = time.monotonic() + 10
+        while self._running and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self.session_pool is not None:
+            self.session_pool.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self.store.close()
+
+
+def send_request(socket_path: str, request: dict, timeout=30):
+    """
+    talk to a running daemon
+    :return: the response dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_path)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
@@ -0,0 +1,248 @@
+import os
+import time
+import queue
+import logging
+import threading
+import subprocess
+from hol.ovf import BYTES_PER_GB
+from hol.xfer import SpaceReservationLedger, move_to_trash, start_trash_reaper, RESERVATION_MARGIN
+from hol.xfer.vcd import VcdSessionPool, estimate_vcd_template_size
+from hol.jobs import script_command, retry_delay, JOB_EXPORT, JOB_VALIDATE, JOB_SCRUB, JOB_BUBBLE, JOB_IMPORT, \
+    JOB_LOG_DIR_NAME
+
+# a catalog migration: each stage mostly uses a different resource (source WAN, disk, CPU, target WAN)
+DEFAULT_STAGES = (JOB_EXPORT, JOB_VALIDATE, JOB_SCRUB, JOB_IMPORT)
+PIPELINE_STAGES = (JOB_EXPORT, JOB_VALIDATE, JOB_SCRUB, JOB_BUBBLE, JOB_IMPORT)
+DEFAULT_QUEUE_DEPTH = 1
+DEFAULT_STAGE_ATTEMPTS = 2
+SPACE_POLL_SECONDS = 60
+# with evict_after_import: how long an export waits for imports to give space back before export_ovf.py evicts
+SPACE_WAIT_MINUTES = 60
+# how long export_ovf.py itself may wait on the reservation ledger once the pipeline has let it start
+EXPORT_WAIT_MINUTES = 60
+
+logging.basicConfig(level=logging.INFO)
+
+
+class PipelineResult:
+    """
+    how one template went through the pipeline
+    """
+    __slots__ = ('template', 'ok', 'failed_stage', 'error', 'durations', 'started', 'finished')
+
+    def __init__(self, template):
+        self.template = template
+        self.ok = None
+        self.failed_stage = None
+        self.error = None
+        # stage => seconds
+        self.durations = {}
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {'template': self.template, 'ok': self.ok, 'failed_stage': self.failed_stage, 'error': self.error,
+                'durations': self.durations, 'started': self.started, 'finished': self.finished}
+
+
+class Pipeline:
+    """
+    runs a list of templates through stages (export, validate, scrub, [bubble,] import) so that different stages
+    work on different templates at the same time: one pool of workers per stage, joined by bounded queues.
+    A full queue blocks the stage feeding it. With evict_after_import, the export stage also waits (up to
+    SPACE_WAIT_MINUTES) for the library to have room for the next template, as each import gives space back;
+    after that export_ovf.py evicts and waits on the reservation ledger itself, failing the stage if it has to.
+    """
+
+    def __init__(self, config: dict, config_path: str, repository: str, stages=DEFAULT_STAGES, source=None,
+                 target=None, rtc_start_time=None, validation_level=None, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 workers=None, attempts=DEFAULT_STAGE_ATTEMPTS, evict_after_import=False, credentials=None):
+        """
+        :param stages: job kinds, in order (see PIPELINE_STAGES)
+        :param source: dict of cloud_host, cloud_org, cloud_catalog to export from
+        :param target: dict of cloud_host, cloud_org, cloud_catalog to import to
+        :param rtc_start_time: for the bubble stage
+        :param validation_level: for the validate stage (default: the script's default)
+        :param queue_depth: templates that may wait between two stages
+        :param workers: dict of stage => number of workers (default 1 each)
+        :param attempts: tries per stage before the template is dropped from the pipeline
+        :param evict_after_import: move imported templates to the library trash
+        :param credentials: from read_hol_xfer_auth, used to size exports through a warm VCD session
+        """
+        unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+        if unknown:
+            raise ValueError(f'unknown pipeline stage(s) {unknown}, expected {list(PIPELINE_STAGES)}')
+        if JOB_EXPORT in stages and not source:
+            raise ValueError('the export stage needs a source cloud')
+        if JOB_IMPORT in stages and not target:
+            raise ValueError('the import stage needs a target cloud')
+        if JOB_BUBBLE in stages and not rtc_start_time:
+            raise ValueError('the bubble stage needs an rtc_start_time')
+        self.config_path = os.path.abspath(config_path)
+        self.scripts_path = config['Tools']['scripts']
+        self.repository = repository
+        self.min_free_bytes = config['Library']['min_free_gb'] * BYTES_PER_GB
+        self.stages = list(stages)
+        self.source = source or {}
+        self.target = target or {}
+        self.rtc_start_time = rtc_start_time
+        self.validation_level = validation_level
+        self.queue_depth = queue_depth
+        self.workers = dict.fromkeys(self.stages, 1)
+        self.workers.update(workers or {})
+        self.attempts = attempts
+        self.evict_after_import = evict_after_import
+        self.session_pool = VcdSessionPool(credentials) if credentials is not None and source else None
+        self.ledger = SpaceReservationLedger(repository)
+        self.log_dir = os.path.join(repository, JOB_LOG_DIR_NAME)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def stage_params(self, stage, template):
+        if stage == JOB_EXPORT:
+            params = dict(self.source, wait_minutes=EXPORT_WAIT_MINUTES)
+            estimated_bytes = self.estimate(template)
+            if estimated_bytes:
+                params['estimated_gb'] = round(estimated_bytes / BYTES_PER_GB, 3)
+            return params
+        if stage == JOB_VALIDATE:
+            return {'level': self.validation_level} if self.validation_level else {}
+        if stage == JOB_BUBBLE:
+            return {'rtc_start_time': self.rtc_start_time}
+        if stage == JOB_IMPORT:
+            return dict(self.target)
+        return {}
+
+    def estimate(self, template):
+        """
+        :return: estimated export size in bytes, or None
+        """
+        if self.session_pool is None:
+            return None
+        try:
+            size_bytes, source = self.session_pool.call(
+                self.source['cloud_host'], self.source['cloud_org'],
+                lambda session: estimate_vcd_template_size(session, self.source['cloud_catalog'], template))
+            return size_bytes
+        except Exception as e:
+            logging.warning(f'unable to size {template}: {e}')
+            return None
+
+    def wait_for_space(self, template, needed_bytes, timeout):
+        """
+        back-pressure on the export stage: hold the next export until the library can take it with min_free_gb
+        to spare (the SpaceReservationLedger.reserve rule), or until timeout seconds have passed
+        :return: True if the space is there
+        """
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            available = self.ledger.available_bytes()
+            if available - needed_bytes >= self.min_free_bytes:
+                if waited:
+                    logging.info(f'{template}: {available / BYTES_PER_GB:.2f} GB available, starting export')
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            if not waited:
+                logging.info(f'{template}: waiting for {needed_bytes / BYTES_PER_GB:.2f} GB '
+                             f'({available / BYTES_PER_GB:.2f} GB available)')
+                waited = True
+            time.sleep(min(SPACE_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+    def run_stage(self, stage, template):
+        """
+        run one stage's script for a template, with retries
+        :return: (bool ok, str error)
+        """
+        result = self.results[template]
+        params = self.stage_params(stage, template)
+        # only imports give space back on their own: otherwise it is up to export_ovf.py's eviction
+        if stage == JOB_EXPORT and self.evict_after_import:
+            estimated_gb = params.get('estimated_gb')
+            needed = estimated_gb * BYTES_PER_GB * (1 + RESERVATION_MARGIN) if estimated_gb else self.min_free_bytes
+            if not self.wait_for_space(template, needed, SPACE_WAIT_MINUTES * 60):
+                logging.warning(f'{template}: still short of space after {SPACE_WAIT_MINUTES} min, '
+                                f'starting the export to evict')
+        argv = script_command(self.scripts_path, self.repository, self.config_path, stage, template, params)
+        log_path = os.path.join(self.log_dir, f'pipeline-{template}-{stage}.log')
+        start = time.monotonic()
+        exit_code = None
+        for attempt in range(1, self.attempts + 1):
+            with open(log_path, 'a') as log_f:
+                log_f.write(f"=== {time.ctime()} attempt {attempt}: {' '.join(argv)}\n")
+                log_f.flush()
+                exit_code = subprocess.run(argv, stdout=log_f, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                                           cwd=self.scripts_path).returncode
+            if exit_code == 0:
+                break
+            if attempt < self.attempts:
+                delay = retry_delay(attempt)
+                logging.warning(f'{template}: {stage} exit code {exit_code}, retrying in {delay:.0f}s')
+                time.sleep(delay)
+        result.durations[stage] = round(time.monotonic() - start, 1)
+        if exit_code != 0:
+            return False, f'exit code {exit_code} (see {log_path})'
+        if stage == JOB_IMPORT and self.evict_after_import:
+            template_path = os.path.join(self.repository, template)
+            if os.path.isdir(template_path):
+                move_to_trash(self.repository, template_path)
+                start_trash_reaper(self.repository)
+        return True, None
+
+    def _worker(self, index, inbox, outbox):
+        stage = self.stages[index]
+        while True:
+            template = inbox.get()
+            if template is None:
+                return
+            logging.info(f'{template}: {stage} started')
+            try:
+                ok, error = self.run_stage(stage, template)
+            except Exception as e:
+                ok, error = False, str(e)
+            result = self.results[template]
+            if not ok:
+                logging.error(f'{template}: {stage} failed: {error}')
+                with self._lock:
+                    result.ok, result.failed_stage, result.error = False, stage, error
+                    result.finished = time.time()
+                continue
+            logging.info(f'{template}: {stage} done in {result.durations[stage]}s')
+            if outbox is not None:
+                # blocks while the next stage is full
+                outbox.put(template)
+            else:
+                with self._lock:
+                    result.ok = True
+                    result.finished = time.time()
+
+    def run(self, templates):
+        """
+        :param templates: template names, in the order they should go through
+        :return: list of PipelineResult, in the same order
+        """
+        for template in templates:
+            self.results[template] = PipelineResult(template)
+        queues = [queue.Queue(maxsize=self.queue_depth) for _ in self.stages]
+        pools = []
+        for index, stage in enumerate(self.stages):
+            outbox = queues[index + 1] if index + 1 < len(self.stages) else None
+            pool = [threading.Thread(target=self._worker, args=(index, queues[index], outbox),
+                                     name=f'{stage}-{n}', daemon=True) for n in range(self.workers[stage])]
+            for thread in pool:
+                thread.start()
+            pools.append(pool)
+        for template in templates:
+            self.results[template].started = time.time()
+            queues[0].put(template)
+        # drain stage by stage: once a stage's workers are done, nothing more will reach the next one
+        for index, pool in enumerate(pools):
+            for _ in pool:
+                queues[index].put(None)
+            for thread in pool:
+                thread.join()
+        if self.session_pool is not None:
+            self.session_pool.close()
+        return [self.results[template] for template in templates]
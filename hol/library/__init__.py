@@ -0,0 +1,435 @@
+import os
+import time
+import logging
+import sqlite3
+from hol.ovf import INDEX_DB_NAME, load_ovf_envelope, read_the_manifest, VALIDATION_LEVELS
+
+# lifecycle events, in the order a template normally goes through them
+EVENT_EXPORTED = 'exported'
+EVENT_PULLED = 'pulled'
+EVENT_VALIDATED = 'validated'
+EVENT_SCRUBBED = 'scrubbed'
+EVENT_BUBBLED = 'bubbled'
+EVENT_UNBUBBLED = 'unbubbled'
+EVENT_IMPORTED = 'imported'
+LIFECYCLE_EVENTS = (EVENT_EXPORTED, EVENT_PULLED, EVENT_VALIDATED, EVENT_SCRUBBED, EVENT_BUBBLED,
+                    EVENT_UNBUBBLED, EVENT_IMPORTED)
+# events that count as a use of the template for the eviction policies (hol.xfer.plan_eviction)
+ACCESS_EVENTS = (EVENT_EXPORTED, EVENT_PULLED, EVENT_IMPORTED)
+# templates found on disk by reconcile() without any recorded event
+STATE_DISCOVERED = 'discovered'
+
+logging.basicConfig(level=logging.INFO)
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS templates ('
+    'name TEXT PRIMARY KEY, path TEXT NOT NULL, state TEXT NOT NULL, '
+    'ovf_file TEXT, ovf_size INTEGER, ovf_mtime_ns INTEGER, mf_size INTEGER, mf_mtime_ns INTEGER, '
+    'size_bytes INTEGER NOT NULL DEFAULT 0, file_count INTEGER NOT NULL DEFAULT 0, newest_mtime_ns INTEGER, '
+    'source_cloud TEXT, source_org TEXT, source_catalog TEXT, '
+    'validated_level TEXT, validated_ok INTEGER, validated_mtime_ns INTEGER, '
+    'exported_at REAL, pulled_at REAL, validated_at REAL, scrubbed_at REAL, bubbled_at REAL, unbubbled_at REAL, '
+    'imported_at REAL, discovered_at REAL, reconciled_at REAL, '
+    'last_used REAL, use_count INTEGER NOT NULL DEFAULT 0, refetch_seconds REAL, pinned INTEGER NOT NULL DEFAULT 0)',
+    'CREATE TABLE IF NOT EXISTS files ('
+    'template TEXT NOT NULL, name TEXT NOT NULL, present INTEGER NOT NULL, '
+    'size INTEGER, mtime_ns INTEGER, device INTEGER, inode INTEGER, allocated INTEGER, '
+    'expected_size INTEGER, manifest_algorithm TEXT, manifest_digest TEXT, '
+    'PRIMARY KEY (template, name))',
+    'CREATE TABLE IF NOT EXISTS events ('
+    'template TEXT NOT NULL, event TEXT NOT NULL, at REAL NOT NULL, detail TEXT)',
+    'CREATE INDEX IF NOT EXISTS events_template ON events (template, at)',
+    # the digest cache (hol.ovf.DigestCache) owns this table; created here too so the joins below always work
+    'CREATE TABLE IF NOT EXISTS digests ('
+    'device INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, '
+    'mtime_ns INTEGER NOT NULL, algorithm TEXT NOT NULL, digest TEXT NOT NULL, '
+    'path TEXT, updated REAL, '
+    'PRIMARY KEY (device, inode, algorithm))',
+)
+
+
+class LibraryIndex:
+    """
+    What is in the local library (e.g. /hol/lib): templates, their files (size, inode, expected size and
+    manifest digest), where they came from, what has been done to them and how they are used (last use, use
+    count, re-fetch cost, pinned) for the eviction policies. Lives in the same SQLite file as the digest cache
+    (<library>/.hol-index.sqlite) so queries can join the two.
+    Kept in step with the filesystem by reconcile(), which only re-reads what changed; recording an event only
+    marks the template stale, and the queries reconcile stale templates first.
+    """
+
+    def __init__(self, repository: str):
+        self.repository = os.path.abspath(repository)
+        self.db = sqlite3.connect(os.path.join(self.repository, INDEX_DB_NAME), timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in _SCHEMA:
+                self.db.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # # # # reconcile # # # #
+
+    def reconcile(self, full=False):
+        """
+        bring the index in line with the filesystem: a stat of every file, a re-parse only of descriptors and
+        manifests that changed; templates that disappeared are dropped
+        :param full: re-parse every OVF/manifest regardless
+        :return: dict of counts: templates, changed, parsed, removed
+        """
+        counts = {'templates': 0, 'changed': 0, 'parsed': 0, 'removed': 0}
+        on_disk = set()
+        with os.scandir(self.repository) as entries:
+            for entry in entries:
+                # library state (.hol-index.sqlite, .trash ...) and loose files are not templates
+                if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+                    continue
+                on_disk.add(entry.name)
+                changed, parsed = self.reconcile_template(entry.name, full=full)
+                counts['templates'] += 1
+                counts['changed'] += changed
+                counts['parsed'] += parsed
+        with self.db:
+            for row in self.db.execute('SELECT name FROM templates').fetchall():
+                if row['name'] not in on_disk:
+                    self._forget(row['name'])
+                    counts['removed'] += 1
+        return counts
+
+    def reconcile_stale(self):
+        """
+        reconcile only the templates that had an event recorded since they were last reconciled
+        :return: number of templates reconciled
+        """
+        names = [row['name'] for row in
+                 self.db.execute('SELECT name FROM templates WHERE reconciled_at IS NULL').fetchall()]
+        for name in names:
+            self.reconcile_template(name)
+        return len(names)
+
+    def reconcile_template(self, name: str, full=False):
+        """
+        re-stat one template's files, re-reading its OVF and manifest only if they changed
+        :return: (bool -- anything changed, bool -- descriptor/manifest re-parsed)
+        """
+        template_path = os.path.join(self.repository, name)
+        if not os.path.isdir(template_path):
+            with self.db:
+                self._forget(name)
+            return True, False
+        stats = {}
+        for root, dirs, files in os.walk(template_path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                try:
+                    stats[os.path.relpath(file_path, template_path)] = os.lstat(file_path)
+                except FileNotFoundError:
+                    continue
+        row = self.db.execute('SELECT * FROM templates WHERE name = ?', (name,)).fetchone()
+        known = {r['name']: r for r in
+                 self.db.execute('SELECT * FROM files WHERE template = ?', (name,)).fetchall()}
+
+        ovf_name = f'{name}.ovf'
+        if ovf_name not in stats:
+            ovf_name = next((n for n in sorted(stats) if n.endswith('.ovf') and os.sep not in n), None)
+        mf_name = ovf_name[:-4] + '.mf' if ovf_name else None
+        ovf_st = stats.get(ovf_name)
+        mf_st = stats.get(mf_name)
+        reparse = full or row is None or \
+            _stat_key(ovf_st) != (row['ovf_size'], row['ovf_mtime_ns']) or \
+            _stat_key(mf_st) != (row['mf_size'], row['mf_mtime_ns'])
+
+        expected = {}
+        if reparse:
+            expected = self._read_descriptor(template_path, ovf_name, mf_name if mf_st else None)
+        else:
+            # carry over what the last parse found
+            for file_name, f in known.items():
+                if f['expected_size'] is not None or f['manifest_digest'] is not None:
+                    expected[file_name] = (f['expected_size'], f['manifest_algorithm'], f['manifest_digest'])
+
+        changed = reparse
+        file_rows = []
+        for file_name in sorted(set(stats) | set(expected)):
+            st = stats.get(file_name)
+            expected_size, algorithm, digest = expected.get(file_name, (None, None, None))
+            if st is None:
+                file_row = (name, file_name, 0, None, None, None, None, None, expected_size, algorithm, digest)
+            else:
+                file_row = (name, file_name, 1, st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino,
+                            st.st_blocks * 512, expected_size, algorithm, digest)
+            previous = known.get(file_name)
+            if previous is None or tuple(previous)[2:8] != file_row[2:8]:
+                changed = True
+            file_rows.append(file_row)
+        if len(file_rows) != len(known):
+            changed = True
+
+        now = time.time()
+        if changed:
+            with self.db:
+                self.db.execute('DELETE FROM files WHERE template = ?', (name,))
+                self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', file_rows)
+                if row is None:
+                    self.db.execute('INSERT INTO templates (name, path, state, discovered_at) VALUES (?, ?, ?, ?)',
+                                    (name, template_path, STATE_DISCOVERED, now))
+                self.db.execute(
+                    'UPDATE templates SET ovf_file = ?, ovf_size = ?, ovf_mtime_ns = ?, mf_size = ?, '
+                    'mf_mtime_ns = ?, size_bytes = ?, file_count = ?, newest_mtime_ns = ?, reconciled_at = ? '
+                    'WHERE name = ?',
+                    (ovf_name, *_stat_key(ovf_st), *_stat_key(mf_st),
+                     sum(st.st_blocks * 512 for st in stats.values()), len(stats),
+                     max((st.st_mtime_ns for st in stats.values()), default=None), now, name))
+        elif row['reconciled_at'] is None:
+            with self.db:
+                self.db.execute('UPDATE templates SET reconciled_at = ? WHERE name = ?', (now, name))
+        return changed, reparse
+
+    @staticmethod
+    def _read_descriptor(template_path, ovf_name, mf_name):
+        # file name => (expected size, manifest algorithm, manifest digest)
+        expected = {}
+        if ovf_name:
+            try:
+                envelope = load_ovf_envelope(os.path.join(template_path, ovf_name))
+                for ovf_file in envelope.files.values():
+                    expected[ovf_file.href] = (int(ovf_file.size) if ovf_file.size else None, None, None)
+            except Exception as e:
+                logging.warning(f'unable to parse {ovf_name}: {e}')
+        if mf_name:
+            try:
+                for file_name, (algorithm, digest) in read_the_manifest(os.path.join(template_path, mf_name)).items():
+                    size = expected.get(file_name, (None,))[0]
+                    expected[file_name] = (size, algorithm.lower(), digest.lower())
+            except OSError as e:
+                logging.warning(f'unable to read {mf_name}: {e}')
+        return expected
+
+    def _forget(self, name):
+        self.db.execute('DELETE FROM files WHERE template = ?', (name,))
+        self.db.execute('DELETE FROM templates WHERE name = ?', (name,))
+
+    # # # # lifecycle # # # #
+
+    def record_event(self, name: str, event: str, detail=None, source_cloud=None, source_org=None,
+                     source_catalog=None, duration=None):
+        """
+        note that something happened to a template (see LIFECYCLE_EVENTS); its files are re-checked lazily
+        :param name: template name
+        :param event: one of LIFECYCLE_EVENTS (ACCESS_EVENTS also count as a use)
+        :param detail: free text for the event history
+        :param source_cloud: where it was exported/pulled from
+        :param duration: seconds it took to fetch the template (export/pull), i.e. what re-fetching would cost
+        :return: None
+        """
+        if event not in LIFECYCLE_EVENTS:
+            raise ValueError(f'unknown library event {event}')
+        now = time.time()
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO templates (name, path, state) VALUES (?, ?, ?)',
+                            (name, os.path.join(self.repository, name), event))
+            self.db.execute(f'UPDATE templates SET state = ?, {event}_at = ?, reconciled_at = NULL WHERE name = ?',
+                            (event, now, name))
+            for column, value in (('source_cloud', source_cloud), ('source_org', source_org),
+                                  ('source_catalog', source_catalog)):
+                if value is not None:
+                    self.db.execute(f'UPDATE templates SET {column} = ? WHERE name = ?', (value, name))
+            if event in ACCESS_EVENTS:
+                self._touch(name, now, duration)
+            self.db.execute('INSERT INTO events VALUES (?, ?, ?, ?)', (name, event, now, detail))
+
+    def record_access(self, name: str, duration=None):
+        """
+        note that a template was used without anything happening to it (e.g. an export found it already here)
+        :param name: template name
+        :param duration: seconds it took to fetch the template, if it was fetched
+        :return: None
+        """
+        with self.db:
+            self._insert_discovered(name)
+            self._touch(name, time.time(), duration)
+
+    def pin(self, name: str, pinned=True):
+        """
+        pinned templates are never evicted (hol.xfer.cleanup_oldest) nor listed by safe_to_delete()
+        :param name: template name
+        :param pinned: pin (True) or unpin (False)
+        :return: None
+        """
+        with self.db:
+            self._insert_discovered(name)
+            self.db.execute('UPDATE templates SET pinned = ? WHERE name = ?', (int(pinned), name))
+
+    def _insert_discovered(self, name):
+        self.db.execute('INSERT OR IGNORE INTO templates (name, path, state, discovered_at) VALUES (?, ?, ?, ?)',
+                        (name, os.path.join(self.repository, name), STATE_DISCOVERED, time.time()))
+
+    def _touch(self, name, now, duration):
+        self.db.execute('UPDATE templates SET last_used = ?, use_count = use_count + 1, '
+                        'refetch_seconds = coalesce(?, refetch_seconds) WHERE name = ?', (now, duration, name))
+
+    def record_validation(self, name: str, level: str, ok: bool):
+        """
+        a validation result holds for the files as they are now: it stops counting once any of them changes
+        :param name: template name
+        :param level: one of hol.ovf.VALIDATION_LEVELS
+        :param ok: did it pass
+        :return: None
+        """
+        self.record_event(name, EVENT_VALIDATED, detail=f"{level}: {'ok' if ok else 'FAILED'}")
+        # the validation just read these files: this is the state it holds for
+        self.reconcile_template(name)
+        with self.db:
+            self.db.execute('UPDATE templates SET validated_level = ?, validated_ok = ?, '
+                            'validated_mtime_ns = newest_mtime_ns WHERE name = ?', (level, int(ok), name))
+
+    # # # # queries # # # #
+
+    def template(self, name: str):
+        """
+        :return: dict of the template's row, or None
+        """
+        self.reconcile_stale()
+        row = self.db.execute('SELECT * FROM templates WHERE name = ?', (name,)).fetchone()
+        return dict(row) if row else None
+
+    def templates(self, state=None):
+        """
+        :param state: only templates whose last event is this one
+        :return: list of dicts
+        """
+        self.reconcile_stale()
+        if state is None:
+            rows = self.db.execute('SELECT * FROM templates ORDER BY name').fetchall()
+        else:
+            rows = self.db.execute('SELECT * FROM templates WHERE state = ? ORDER BY name', (state,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def files(self, name: str):
+        """
+        :return: list of dicts of a template's files, with the cached digest (if any) alongside the manifest's
+        """
+        self.reconcile_stale()
+        rows = self.db.execute(
+            'SELECT f.*, d.digest AS cached_digest FROM files f LEFT JOIN digests d '
+            'ON d.device = f.device AND d.inode = f.inode AND d.size = f.size AND d.mtime_ns = f.mtime_ns '
+            'AND d.algorithm = f.manifest_algorithm WHERE f.template = ? ORDER BY f.name', (name,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def validated(self, min_level=VALIDATION_LEVELS[0]):
+        """
+        templates whose last validation passed at min_level or above and whose files have not changed since
+        :return: list of dicts
+        """
+        self.reconcile_stale()
+        levels = VALIDATION_LEVELS[VALIDATION_LEVELS.index(min_level):]
+        rows = self.db.execute(
+            f"SELECT * FROM templates WHERE validated_ok = 1 AND validated_mtime_ns IS newest_mtime_ns "
+            f"AND validated_level IN ({', '.join('?' * len(levels))}) ORDER BY name", levels).fetchall()
+        return [dict(row) for row in rows]
+
+    def differs_from_source(self):
+        """
+        templates whose files do not match what the source described: missing files, sizes other than the
+        References ovf:size, or a known digest other than the manifest's
+        :return: dict of template name => list of (file name, problem)
+        """
+        self.reconcile_stale()
+        rows = self.db.execute(
+            'SELECT f.template, f.name, f.present, f.size, f.expected_size, f.manifest_digest, d.digest '
+            'FROM files f LEFT JOIN digests d ON d.device = f.device AND d.inode = f.inode AND d.size = f.size '
+            'AND d.mtime_ns = f.mtime_ns AND d.algorithm = f.manifest_algorithm '
+            'WHERE f.present = 0 OR (f.expected_size IS NOT NULL AND f.size != f.expected_size) '
+            'OR (d.digest IS NOT NULL AND d.digest != f.manifest_digest) '
+            'ORDER BY f.template, f.name').fetchall()
+        differences = {}
+        for template, file_name, present, size, expected_size, manifest_digest, digest in rows:
+            if not present:
+                problem = 'missing'
+            elif expected_size is not None and size != expected_size:
+                problem = f'size {size} != {expected_size}'
+            else:
+                problem = 'digest does not match the manifest'
+            differences.setdefault(template, []).append((file_name, problem))
+        return differences
+
+    def safe_to_delete(self, pattern=''):
+        """
+        templates that can be removed without losing anything: already imported to the target cloud, last
+        validated (and unchanged) or re-obtainable from their recorded source, and not pinned
+        :param pattern: only names containing this substring
+        :return: list of dicts, oldest import first
+        """
+        self.reconcile_stale()
+        rows = self.db.execute(
+            'SELECT t.* FROM templates t WHERE t.imported_at IS NOT NULL AND instr(t.name, ?) > 0 '
+            'AND ((t.validated_ok = 1 AND t.validated_mtime_ns IS t.newest_mtime_ns) '
+            'OR t.source_catalog IS NOT NULL) '
+            'AND t.pinned = 0 ORDER BY t.imported_at', (pattern,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def access_records(self):
+        """
+        what the eviction policies weigh (hol.xfer.plan_eviction)
+        :return: dict of template => dict(last_used, use_count, refetch_seconds, pinned)
+        """
+        return {r['name']: {'last_used': r['last_used'], 'use_count': r['use_count'],
+                            'refetch_seconds': r['refetch_seconds'], 'pinned': bool(r['pinned'])}
+                for r in self.db.execute('SELECT name, last_used, use_count, refetch_seconds, pinned '
+                                         'FROM templates').fetchall()}
+
+    def history(self, name: str):
+        """
+        :return: list of (event, time, detail), oldest first
+        """
+        return [tuple(row) for row in
+                self.db.execute('SELECT event, at, detail FROM events WHERE template = ? ORDER BY at',
+                                (name,)).fetchall()]
+
+
+def _stat_key(st):
+    return (st.st_size, st.st_mtime_ns) if st is not None else (None, None)
+
+
+def record_library_event(repository: str, name: str, event: str, **kwargs):
+    """
+    record_event() for the bin scripts: a library index problem is logged, never fatal to a transfer
+    :return: None
+    """
+    try:
+        with LibraryIndex(repository) as index:
+            if event == EVENT_VALIDATED:
+                index.record_validation(name, kwargs['level'], kwargs['ok'])
+            else:
+                index.record_event(name, event, **kwargs)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning(f'unable to record {event} of {name} in the library index: {e}')
+
+
+def record_library_access(repository: str, name: str, duration=None):
+    """
+    record_access() for the bin scripts: a library index problem is logged, never fatal to a transfer
+    :return: None
+    """
+    try:
+        with LibraryIndex(repository) as index:
+            index.record_access(name, duration)
+    except (sqlite3.Error, OSError) as e:
+        logging.warning(f'unable to record a use of {name} in the library index: {e}')
+
+
+def pin_template(repository: str, name: str, pinned=True):
+    """
+    pin (or unpin) a template in the library index: pinned templates are never evicted
+    :return: None
+    """
+    with LibraryIndex(repository) as index:
+        index.pin(name, pinned)
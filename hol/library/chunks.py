@@ -0,0 +1,419 @@
+import os
+import time
+import zlib
+import fcntl
+import hashlib
+import logging
+import sqlite3
+from hol.ovf import INDEX_DB_NAME, BYTES_PER_MB, read_the_manifest, verify_against_digests, DigestCache
+from hol.ovf.vmdk import load_grain_signature, inspect_vmdk
+from hol.pull import PART_SUFFIX, STATE_SUFFIX
+from hol.pull.delta import grain_signature_cache_dir
+
+# content-addressed chunks live in <library>/.chunks/objects/<2 hex>/<sha256>
+CHUNK_STORE_DIR_NAME = '.chunks'
+# cut points are chosen by content, on block boundaries: disk images and ISOs are block-aligned, so a byte-level
+# rolling hash would find the same cuts at a much higher cost
+CHUNK_BLOCK_SIZE = 4096
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * BYTES_PER_MB
+# a block ends a chunk when the low bits of its crc32 are zero: about 1.25 MB per chunk on average
+CHUNK_BLOCK_MASK = (1 << 8) - 1
+# streamOptimized VMDKs are cut before a grain whose deflated bytes hash to zero low bits (about every 32 grains)
+CHUNK_GRAIN_MASK = (1 << 5) - 1
+CHUNK_READ_SIZE = 8 * BYTES_PER_MB
+# descriptors, manifests and other small files are left as they are
+CHUNK_MIN_FILE_SIZE = CHUNK_MIN_SIZE
+# held by ingest, pack and gc, so gc never deletes a chunk an ingest is about to refer to
+CHUNK_LOCK_NAME = 'lock'
+
+logging.basicConfig(level=logging.INFO)
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY, size INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS chunk_files ('
+    'template TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+    'chunk_count INTEGER NOT NULL, packed INTEGER NOT NULL DEFAULT 0, ingested_at REAL, '
+    'PRIMARY KEY (template, name))',
+    'CREATE TABLE IF NOT EXISTS chunk_refs ('
+    'template TEXT NOT NULL, name TEXT NOT NULL, seq INTEGER NOT NULL, offset INTEGER NOT NULL, '
+    'hash TEXT NOT NULL, PRIMARY KEY (template, name, seq))',
+    'CREATE INDEX IF NOT EXISTS chunk_refs_hash ON chunk_refs (hash)',
+)
+
+
+def iter_block_chunks(f, start=0, end=None):
+    """
+    content-defined chunks of a file, cut on CHUNK_BLOCK_SIZE boundaries
+    :param f: open binary file
+    :return: generator of (offset, bytes)
+    """
+    f.seek(start)
+    chunk = bytearray()
+    offset = start
+    remaining = None if end is None else end - start
+    while True:
+        data = f.read(CHUNK_READ_SIZE if remaining is None else min(CHUNK_READ_SIZE, remaining))
+        if not data:
+            break
+        if remaining is not None:
+            remaining -= len(data)
+        view = memoryview(data)
+        position = 0
+        while position < len(data):
+            block = view[position:position + CHUNK_BLOCK_SIZE]
+            chunk += block
+            position += len(block)
+            if len(chunk) >= CHUNK_MAX_SIZE or \
+                    (len(chunk) >= CHUNK_MIN_SIZE and not zlib.crc32(block) & CHUNK_BLOCK_MASK):
+                yield offset, bytes(chunk)
+                offset += len(chunk)
+                chunk = bytearray()
+    if chunk:
+        yield offset, bytes(chunk)
+
+
+def iter_grain_chunks(f, signature):
+    """
+    chunks of a streamOptimized VMDK that start on grain records, so the same run of grains is the same chunk
+    in every template that has it (wherever the metadata around it differs)
+    :param f: open binary file
+    :param signature: its GrainSignature
+    :return: generator of (offset, bytes)
+    """
+    cuts = [0]
+    for grain in signature.grains:
+        size = grain.offset - cuts[-1]
+        if size >= CHUNK_MAX_SIZE or \
+                (size >= CHUNK_MIN_SIZE and not int.from_bytes(grain.compressed_hash[:4], 'little') & CHUNK_GRAIN_MASK):
+            cuts.append(grain.offset)
+    cuts.append(signature.file_size)
+    for start, end in zip(cuts, cuts[1:]):
+        while start < end:
+            # a stretch without grains (grain tables, directory) is cut like any other file
+            length = min(end - start, CHUNK_MAX_SIZE)
+            f.seek(start)
+            yield start, f.read(length)
+            start += length
+
+
+def iter_file_chunks(file_path, signature_cache_dir=None):
+    """
+    :param signature_cache_dir: where grain signatures are cached (shared with the delta transfers)
+    :return: generator of (offset, bytes) covering the whole file
+    """
+    signature = None
+    if file_path.lower().endswith('.vmdk'):
+        inspection = inspect_vmdk(file_path, sample_grains=1)
+        if inspection.kind == 'streamOptimized' and inspection.ok:
+            signature = load_grain_signature(file_path, signature_cache_dir)
+    with open(file_path, 'rb') as f:
+        if signature is not None:
+            yield from iter_grain_chunks(f, signature)
+        else:
+            yield from iter_block_chunks(f)
+
+
+class ChunkStore:
+    """
+    An optional content-addressed store for the library: large template files are split into content-defined
+    chunks, each kept once under <library>/.chunks by its sha256, so templates built on the same base disks share
+    their storage. A template can be packed (its chunked files removed, leaving the descriptor and manifest) and
+    materialised again (reassembled, then checked against its manifest). The chunk lists live in the library
+    index (.hol-index.sqlite), where a peer's list can be compared with what is held here.
+    """
+
+    def __init__(self, repository: str):
+        self.repository = os.path.abspath(repository)
+        self.store_path = os.path.join(self.repository, CHUNK_STORE_DIR_NAME)
+        self.lock_path = os.path.join(self.store_path, CHUNK_LOCK_NAME)
+        self.db = sqlite3.connect(os.path.join(self.repository, INDEX_DB_NAME), timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            for statement in _SCHEMA:
+                self.db.execute(statement)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.store_path, 'objects', chunk_hash[:2], chunk_hash)
+
+    def _locked(self):
+        os.makedirs(self.store_path, exist_ok=True)
+        lock_f = open(self.lock_path, 'a')
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        return lock_f
+
+    def _store_chunk(self, chunk_hash, data):
+        """
+        write a chunk unless it is already there, and make sure the chunks table knows it either way (an object
+        can be on disk without its row after a crash between the write and the commit)
+        :return: bytes written to the store (0 if the chunk was already there)
+        """
+        path = self.chunk_path(chunk_hash)
+        written = 0
+        try:
+            present = os.path.getsize(path) == len(data)
+        except FileNotFoundError:
+            present = False
+        if not present:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            written = len(data)
+        self.db.execute('INSERT OR IGNORE INTO chunks (hash, size) VALUES (?, ?)', (chunk_hash, len(data)))
+        return written
+
+    def template_files(self, template):
+        """
+        :return: dict of relative name => os.stat_result for the files of a template worth chunking
+        """
+        template_path = os.path.join(self.repository, template)
+        files = {}
+        for root, dirs, names in os.walk(template_path):
+            for name in names:
+                if name.endswith(PART_SUFFIX) or name.endswith(STATE_SUFFIX) or \
+                        name.lower().endswith(('.ovf', '.mf')):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                if st.st_size >= CHUNK_MIN_FILE_SIZE:
+                    files[os.path.relpath(os.path.join(root, name), template_path)] = st
+        return files
+
+    def ingest(self, template):
+        """
+        chunk a template's large files into the store (files unchanged since the last ingest are skipped)
+        :return: dict of files, chunks, new_chunks, new_bytes
+        """
+        counts = {'files': 0, 'chunks': 0, 'new_chunks': 0, 'new_bytes': 0}
+        for name, st in sorted(self.template_files(template).items()):
+            row = self.db.execute('SELECT size, mtime_ns FROM chunk_files WHERE template = ? AND name = ?',
+                                  (template, name)).fetchone()
+            if row is not None and (row['size'], row['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+                continue
+            start = time.monotonic()
+            refs = []
+            file_path = os.path.join(self.repository, template, name)
+            with self._locked(), self.db:
+                for offset, data in iter_file_chunks(file_path, grain_signature_cache_dir(self.repository, file_path)):
+                    chunk_hash = hashlib.sha256(data).hexdigest()
+                    written = self._store_chunk(chunk_hash, data)
+                    counts['new_chunks'] += bool(written)
+                    counts['new_bytes'] += written
+                    refs.append((template, name, len(refs), offset, chunk_hash))
+                self.db.execute('DELETE FROM chunk_refs WHERE template = ? AND name = ?', (template, name))
+                self.db.executemany('INSERT INTO chunk_refs (template, name, seq, offset, hash) VALUES (?, ?, ?, ?, ?)',
+                                    refs)
+                self.db.execute('INSERT OR REPLACE INTO chunk_files (template, name, size, mtime_ns, chunk_count, '
+                                'packed, ingested_at) VALUES (?, ?, ?, ?, ?, 0, ?)',
+                                (template, name, st.st_size, st.st_mtime_ns, len(refs), time.time()))
+            counts['files'] += 1
+            counts['chunks'] += len(refs)
+            logging.info(f'{template}/{name}: {len(refs)} chunk(s) in {time.monotonic() - start:.1f}s')
+        return counts
+
+    def pack(self, template, verify=True):
+        """
+        remove a template's files that are held in the store (ingested and unchanged since, with every chunk
+        present); the descriptor and manifest stay, so the template can be materialised again
+        :param verify: also re-hash each chunk before the file it belongs to is removed
+        :return: bytes freed
+        """
+        freed = 0
+        files = self.template_files(template)
+        for row in self.db.execute('SELECT * FROM chunk_files WHERE template = ? AND packed = 0',
+                                   (template,)).fetchall():
+            st = files.get(row['name'])
+            if st is None or (row['size'], row['mtime_ns']) != (st.st_size, st.st_mtime_ns):
+                logging.warning(f"{template}/{row['name']} changed since it was ingested, not packing it")
+                continue
+            with self._locked():
+                problem = self._check_chunks(template, row['name'], row['size'], row['chunk_count'], verify)
+                if problem is not None:
+                    logging.error(f"{template}/{row['name']}: {problem}, not packing it")
+                    continue
+                os.remove(os.path.join(self.repository, template, row['name']))
+                with self.db:
+                    self.db.execute('UPDATE chunk_files SET packed = 1 WHERE template = ? AND name = ?',
+                                    (template, row['name']))
+            freed += st.st_blocks * 512
+        return freed
+
+    def _check_chunks(self, template, name, size, chunk_count, verify):
+        """
+        :return: why the store cannot give a file back, or None if every chunk it needs is there
+        """
+        refs = self.db.execute('SELECT r.offset, r.hash, c.size FROM chunk_refs r LEFT JOIN chunks c '
+                               'ON c.hash = r.hash WHERE r.template = ? AND r.name = ? ORDER BY r.seq',
+                               (template, name)).fetchall()
+        if len(refs) != chunk_count:
+            return f'{len(refs)} of {chunk_count} chunk(s) listed'
+        position = 0
+        for ref in refs:
+            if ref['offset'] != position:
+                return f'chunk list has a gap at {position}'
+            if ref['size'] is None:
+                return f"chunk {ref['hash']} is not in the store"
+            path = self.chunk_path(ref['hash'])
+            try:
+                if os.path.getsize(path) != ref['size']:
+                    return f"chunk {ref['hash']} is {os.path.getsize(path)} bytes, not {ref['size']}"
+                if verify:
+                    with open(path, 'rb') as f:
+                        if hashlib.sha256(f.read()).hexdigest() != ref['hash']:
+                            return f"chunk {ref['hash']} is corrupt"
+            except FileNotFoundError:
+                return f"chunk {ref['hash']} is missing"
+            position += ref['size']
+        if position != size:
+            return f'chunks add up to {position} of {size} bytes'
+        return None
+
+    def materialize(self, template, verify=True):
+        """
+        reassemble a packed template's files from the store (kernel-side copies, which share extents on
+        filesystems that can) and check them against the template's manifest
+        :return: dict of file name => problem (empty when everything is back and matches)
+        """
+        problems = {}
+        template_path = os.path.join(self.repository, template)
+        restored = []
+        for row in self.db.execute('SELECT * FROM chunk_files WHERE template = ? AND packed = 1',
+                                   (template,)).fetchall():
+            target = os.path.join(template_path, row['name'])
+            refs = self.db.execute('SELECT offset, hash FROM chunk_refs WHERE template = ? AND name = ? '
+                                   'ORDER BY seq', (template, row['name'])).fetchall()
+            try:
+                self._reassemble(target, refs, row['size'])
+            except OSError as e:
+                problems[row['name']] = f'unable to reassemble: {e}'
+                continue
+            # back to the mtime it had, so pulls and the library index see the same file as before
+            os.utime(target, ns=(row['mtime_ns'], row['mtime_ns']))
+            with self.db:
+                self.db.execute('UPDATE chunk_files SET packed = 0 WHERE template = ? AND name = ?',
+                                (template, row['name']))
+            restored.append(row['name'])
+        manifest = os.path.join(template_path, f'{template}.mf')
+        if verify and restored and os.path.isfile(manifest):
+            expected = {name: digest for name, digest in read_the_manifest(manifest).items() if name in restored}
+            problems.update(verify_against_digests(template_path, expected,
+                                                   digest_cache=DigestCache.for_library(self.repository)))
+        return problems
+
+    def _reassemble(self, target, refs, size):
+        part_path = target + PART_SUFFIX
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        target_fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            position = 0
+            for ref in refs:
+                if ref['offset'] != position:
+                    raise OSError(f'chunk list has a gap at {position}')
+                source_fd = os.open(self.chunk_path(ref['hash']), os.O_RDONLY)
+                try:
+                    length = os.fstat(source_fd).st_size
+                    copied = 0
+                    while copied < length:
+                        n = os.copy_file_range(source_fd, target_fd, length - copied, copied, position + copied)
+                        if n == 0:
+                            raise OSError(f"chunk {ref['hash']} is short")
+                        copied += n
+                finally:
+                    os.close(source_fd)
+                position += length
+            if position != size:
+                raise OSError(f'reassembled {position} of {size} bytes')
+            os.fsync(target_fd)
+        except OSError:
+            os.close(target_fd)
+            os.remove(part_path)
+            raise
+        os.close(target_fd)
+        os.replace(part_path, target)
+
+    def report(self):
+        """
+        :return: list of dicts per template: logical_bytes (what its chunked files add up to), stored_bytes
+            (its distinct chunks), unique_bytes (chunks no other template uses), shared_bytes, effective_bytes (each
+            shared chunk split evenly between the templates using it) and ratio (logical over effective bytes)
+        """
+        rows = self.db.execute(
+            'SELECT template, SUM(size) AS logical_bytes, SUM(packed) AS packed, COUNT(*) AS files '
+            'FROM chunk_files GROUP BY template ORDER BY template').fetchall()
+        result = []
+        for row in rows:
+            stored, unique, effective = self.db.execute(
+                'SELECT COALESCE(SUM(c.size), 0), COALESCE(SUM(CASE WHEN u.users = 1 THEN c.size ELSE 0 END), 0), '
+                'COALESCE(SUM(CAST(c.size AS REAL) / u.users), 0) FROM chunks c JOIN '
+                '(SELECT hash, COUNT(DISTINCT template) AS users FROM chunk_refs WHERE hash IN '
+                '(SELECT hash FROM chunk_refs WHERE template = ?) GROUP BY hash) u ON u.hash = c.hash',
+                (row['template'],)).fetchone()
+            result.append({'template': row['template'], 'files': row['files'], 'packed': row['packed'],
+                           'logical_bytes': row['logical_bytes'], 'stored_bytes': stored, 'unique_bytes': unique,
+                           'shared_bytes': stored - unique, 'effective_bytes': int(effective),
+                           'ratio': round(row['logical_bytes'] / effective, 2) if effective else None})
+        return result
+
+    def store_bytes(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM chunks').fetchone()[0]
+
+    def forget(self, template):
+        with self.db:
+            self.db.execute('DELETE FROM chunk_refs WHERE template = ?', (template,))
+            self.db.execute('DELETE FROM chunk_files WHERE template = ?', (template,))
+
+    def gc(self):
+        """
+        drop templates that are gone from the library, then delete chunks nothing refers to
+        :return: (chunks removed, bytes freed)
+        """
+        for row in self.db.execute('SELECT DISTINCT template FROM chunk_files').fetchall():
+            if not os.path.isdir(os.path.join(self.repository, row['template'])):
+                logging.info(f"{row['template']} is no longer in the library, dropping its chunks")
+                self.forget(row['template'])
+        with self._locked():
+            # the rows go first, in one transaction: a crash before the files are removed only leaves objects
+            # that the next ingest of the same content re-registers
+            with self.db:
+                orphans = self.db.execute('SELECT hash, size FROM chunks WHERE hash NOT IN '
+                                          '(SELECT DISTINCT hash FROM chunk_refs)').fetchall()
+                self.db.executemany('DELETE FROM chunks WHERE hash = ?', [(row['hash'],) for row in orphans])
+            for row in orphans:
+                try:
+                    os.remove(self.chunk_path(row['hash']))
+                except FileNotFoundError:
+                    pass
+        return len(orphans), sum(row['size'] for row in orphans)
+
+    def chunk_list(self, template):
+        """
+        :return: dict of file name => list of (offset, sha256) -- what a peer needs to tell which chunks it lacks
+        """
+        chunks = {}
+        for row in self.db.execute('SELECT name, offset, hash FROM chunk_refs WHERE template = ? ORDER BY name, seq',
+                                   (template,)):
+            chunks.setdefault(row['name'], []).append((row['offset'], row['hash']))
+        return chunks
+
+    def missing(self, chunk_hashes):
+        """
+        :return: the hashes (of a peer's chunk list) that are not held here
+        """
+        held = set()
+        hashes = list(set(chunk_hashes))
+        for start in range(0, len(hashes), 500):
+            batch = hashes[start:start + 500]
+            held.update(row[0] for row in self.db.execute(
+                f"SELECT hash FROM chunks WHERE hash IN ({','.join('?' * len(batch))})", batch))
+        return [chunk_hash for chunk_hash in hashes if chunk_hash not in held]
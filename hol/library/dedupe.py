@@ -0,0 +1,189 @@
+import os
+import stat
+import hashlib
+import logging
+from hol.ovf import hash_files, clone_file, DigestCache, CLONE_COPY, CLONE_HARDLINK
+from hol.library import LibraryIndex
+from hol.pull import PART_SUFFIX, STATE_SUFFIX
+
+# small files are not worth the bother (NVRAM files are a few hundred KB and do repeat across templates)
+DEDUPE_MIN_SIZE = 64 * 1024
+# blocks read per file by the sampled hash: the first, the last and evenly spaced ones in between
+DEDUPE_SAMPLE_BLOCKS = 16
+DEDUPE_SAMPLE_SIZE = 64 * 1024
+DEDUPE_TMP_SUFFIX = '.dedupe.tmp'
+# rewritten in place (scrub, update_the_manifest), so a hard link would change every copy at once
+IN_PLACE_SUFFIXES = ('.ovf', '.mf')
+
+logging.basicConfig(level=logging.INFO)
+
+
+class DuplicateGroup:
+    """
+    files with the same content: the one that is kept and those that become clones of it
+    """
+    __slots__ = ('digest', 'size', 'keep', 'duplicates')
+
+    def __init__(self, digest, size, keep, duplicates):
+        self.digest = digest
+        self.size = size
+        self.keep = keep
+        self.duplicates = duplicates
+
+    def to_dict(self):
+        return {'digest': self.digest, 'size': self.size, 'keep': self.keep, 'duplicates': self.duplicates}
+
+
+def find_candidate_files(paths, min_size=DEDUPE_MIN_SIZE):
+    """
+    regular files worth deduplicating under the given trees, one path per inode (existing hard links are already
+    shared); library state (dot-names) and transfers in progress are skipped
+    :return: dict of path => os.stat_result
+    """
+    files = {}
+    inodes = set()
+    for top in paths:
+        for root, dirs, names in os.walk(top):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in names:
+                if name.startswith('.') or name.endswith((PART_SUFFIX, STATE_SUFFIX, DEDUPE_TMP_SUFFIX)):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    st = os.lstat(file_path)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISREG(st.st_mode) or st.st_size < min_size or (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+                files[file_path] = st
+    return files
+
+
+def sampled_hash(file_path, size):
+    """
+    hash of a few blocks spread over the file: cheap, and different for almost all files that are not identical
+    """
+    sample_hash = hashlib.blake2b(str(size).encode(), digest_size=16)
+    positions = {min(size - DEDUPE_SAMPLE_SIZE, size * i // (DEDUPE_SAMPLE_BLOCKS - 1)) for i in
+                 range(DEDUPE_SAMPLE_BLOCKS)}
+    with open(file_path, 'rb') as f:
+        for position in sorted(max(p, 0) for p in positions):
+            sample_hash.update(os.pread(f.fileno(), DEDUPE_SAMPLE_SIZE, position))
+    return sample_hash.hexdigest()
+
+
+def _regroup(groups, key_function):
+    result = []
+    for group in groups:
+        by_key = {}
+        for file_path in group:
+            try:
+                key = key_function(file_path)
+            except OSError as e:
+                logging.warning(f'skipping {file_path}: {e}')
+                continue
+            if key is not None:
+                by_key.setdefault(key, []).append(file_path)
+        result.extend(paths for paths in by_key.values() if len(paths) > 1)
+    return result
+
+
+def find_duplicates(paths, min_size=DEDUPE_MIN_SIZE, digest_cache=None, max_workers=None):
+    """
+    byte-identical files under the given trees: grouped by filesystem and size, then by a sampled hash, then
+    confirmed by their sha256 (from the digest cache where it has them)
+    :param digest_cache: DigestCache (the library's, so that digests are shared with validation and pulls)
+    :return: list of DuplicateGroup
+    """
+    files = find_candidate_files(paths, min_size)
+    by_size = {}
+    for file_path, st in files.items():
+        by_size.setdefault((st.st_dev, st.st_size), []).append(file_path)
+    groups = [group for group in by_size.values() if len(group) > 1]
+    logging.info(f'{len(files)} file(s), {sum(len(g) for g in groups)} share a size with another')
+    groups = _regroup(groups, lambda file_path: sampled_hash(file_path, files[file_path].st_size))
+    to_hash = [file_path for group in groups for file_path in group]
+    logging.info(f'{len(to_hash)} file(s) left after sampling, confirming with sha256')
+    digests = hash_files(to_hash, 'sha256', max_workers, digest_cache=digest_cache)
+    groups = _regroup(groups, lambda file_path: digests[file_path])
+
+    duplicates = []
+    for group in groups:
+        # keep the oldest copy: it is the one most likely to be linked or cloned already
+        group.sort(key=lambda file_path: (files[file_path].st_mtime_ns, file_path))
+        duplicates.append(DuplicateGroup(digests[group[0]], files[group[0]].st_size, group[0], group[1:]))
+    return duplicates
+
+
+def replace_with_clone(keep, duplicate):
+    """
+    swap a file for a clone of an identical one: a reflink (keeps its own inode, mode and mtime), else a hard link
+    where that is safe; never a plain copy, which would save nothing
+    :return: clone method, or None if the file was left as it is
+    """
+    st = os.stat(duplicate)
+    tmp_path = duplicate + DEDUPE_TMP_SUFFIX
+    allow_hardlink = not duplicate.lower().endswith(IN_PLACE_SUFFIXES) and \
+        not keep.lower().endswith(IN_PLACE_SUFFIXES)
+    method = clone_file(keep, tmp_path, allow_hardlink=allow_hardlink)
+    if method == CLONE_COPY:
+        os.remove(tmp_path)
+        return None
+    after = os.stat(duplicate)
+    if (after.st_ino, after.st_size, after.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        # written to since it was hashed
+        os.remove(tmp_path)
+        return None
+    if method != CLONE_HARDLINK:
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, duplicate)
+    return method
+
+
+def dedupe_library(repository, extra_paths=(), min_size=DEDUPE_MIN_SIZE, apply=False, max_workers=None):
+    """
+    find byte-identical files in the library (and e.g. /hol/lib/ISO elsewhere) and replace the duplicates with
+    reflinks or hard links to one copy; the library index is reconciled for every template that changed
+    :param apply: replace the files (default: only report what would be done)
+    :return: (list of DuplicateGroup, dict of counts: files, bytes (allocated bytes given back), and per method)
+    """
+    repository = os.path.abspath(repository)
+    digest_cache = DigestCache.for_library(repository)
+    groups = find_duplicates([repository, *extra_paths], min_size, digest_cache, max_workers)
+    counts = {'files': 0, 'bytes': 0}
+    touched = set()
+    for group in groups:
+        for duplicate in group.duplicates:
+            st = os.stat(duplicate)
+            if not apply:
+                counts['files'] += 1
+                counts['bytes'] += st.st_blocks * 512 if st.st_nlink == 1 else 0
+                continue
+            try:
+                method = replace_with_clone(group.keep, duplicate)
+            except OSError as e:
+                logging.error(f'unable to dedupe {duplicate}: {e}')
+                continue
+            if method is None:
+                logging.info(f'{duplicate}: left as it is')
+                continue
+            logging.info(f'{duplicate}: {method} of {group.keep}')
+            if digest_cache is not None:
+                # a reflink is a new inode: carry the digest over so validation does not read it again
+                digest_cache.store(duplicate, group.digest)
+            counts['files'] += 1
+            counts[method] = counts.get(method, 0) + 1
+            counts['bytes'] += st.st_blocks * 512 if st.st_nlink == 1 else 0
+            relative = os.path.relpath(duplicate, repository)
+            if not relative.startswith('..') and os.sep in relative:
+                touched.add(relative.split(os.sep)[0])
+    if touched:
+        # inodes and allocated sizes changed: keep the index's space accounting right
+        with LibraryIndex(repository) as index:
+            for template in sorted(touched):
+                index.reconcile_template(template)
+    if digest_cache is not None:
+        digest_cache.close()
+    return groups, counts
@@ -1,37 +1,567 @@
 import xml.etree.ElementTree as ET
+import io
+import fcntl
+import json
 import math
 import os
+import hashlib
 from hashlib import sha256
 import re
 import logging
 import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import ctime
 from prettytable import PrettyTable
+from hol.ovf.vmdk import inspect_vmdk
 
 BYTES_PER_MB = 2 ** 20
 BYTES_PER_GB = 2 ** 30
 BYTES_PER_TB = 2 ** 40
 EZT_BUG_TRIGGER_PERCENTAGE = 60
+HASH_BLOCK_SIZE = 8 * BYTES_PER_MB
+HASH_MAX_WORKERS = 8
+# SQLite file at the root of a library holding the digest cache (and other library state)
+INDEX_DB_NAME = '.hol-index.sqlite'
+# ioctl(dest_fd, FICLONE, src_fd): copy-on-write clone of a whole file (XFS with reflink=1, Btrfs)
+FICLONE = 0x40049409
+CLONE_REFLINK = 'reflink'
+CLONE_HARDLINK = 'hardlink'
+CLONE_COPY = 'copy'
+VALIDATION_FAST = 'fast'
+VALIDATION_STRUCTURAL = 'structural'
+VALIDATION_FULL = 'full'
+VALIDATION_LEVELS = (VALIDATION_FAST, VALIDATION_STRUCTURAL, VALIDATION_FULL)
+MANIFEST_LINE_PATTERN = re.compile(r'^(\w+)\((.+)\)\s*=\s*([0-9a-fA-F]+)$')
 
 logging.basicConfig(level=logging.INFO)
 
 
+OVF_NS = 'http://schemas.dmtf.org/ovf/envelope/1'
+VCLOUD_NS = 'http://www.vmware.com/vcloud/v1.5'
+VMW_NS = 'http://www.vmware.com/schema/ovf'
+RASD_NS = 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData'
+
+# parsed descriptors, keyed by absolute path -> ((mtime_ns, size), OvfEnvelope)
+_ENVELOPE_CACHE = OrderedDict()
+_ENVELOPE_CACHE_MAX = 16
+
+
 class OvfDisk:
-    vm_name = ''
-    file_name = ''
-    disk_id = ''
-    file_ref = ''
-    vm_disk_id = ''
+    """
+    A disk from the DiskSection, joined with its References file and the VM/hard disk that uses it
+    """
+    __slots__ = ('vm_name', 'file_name', 'disk_id', 'file_ref', 'vm_disk_id',
+                 'capacity', 'capacity_units', 'populated_size', 'element')
+
+    def __init__(self):
+        self.vm_name = ''
+        self.file_name = ''
+        self.disk_id = ''
+        self.file_ref = ''
+        self.vm_disk_id = ''
+        self.capacity = None
+        self.capacity_units = ''
+        self.populated_size = None
+        self.element = None
+
+
+class OvfFile:
+    """
+    An ovf:File from the References section
+    """
+    __slots__ = ('file_id', 'href', 'size', 'element')
+
+    def __init__(self, file_id, href, size, element):
+        self.file_id = file_id
+        self.href = href
+        self.size = size
+        self.element = element
+
+
+class OvfNetwork:
+    """
+    An ovf:Network from the NetworkSection
+    """
+    __slots__ = ('name', 'element')
+
+    def __init__(self, name, element):
+        self.name = name
+        self.element = element
+
+
+class OvfHardDisk:
+    """
+    A "Hard Disk" Item from a VM's VirtualHardwareSection
+    """
+    __slots__ = ('element_name', 'host_resource', 'item', 'config')
+
+    def __init__(self, element_name, host_resource, item, config):
+        self.element_name = element_name
+        self.host_resource = host_resource
+        self.item = item
+        self.config = config
+
+
+class OvfVirtualSystem:
+    """
+    An ovf:VirtualSystem (VM) from the VirtualSystemCollection
+    """
+    __slots__ = ('vm_name', 'element', 'hardware_sections', 'items',
+                 'hard_disks', 'product_properties', 'network_connections')
+
+    def __init__(self, vm_name, element):
+        self.vm_name = vm_name
+        self.element = element
+        self.hardware_sections = []
+        # (VirtualHardwareSection, Item) pairs, in document order
+        self.items = []
+        self.hard_disks = []
+        self.product_properties = []
+        self.network_connections = []
+
+
+class OvfEnvelope:
+    """
+    A parsed OVF descriptor: the ElementTree plus typed indexes of the parts the hol.ovf operations work on.
+    The indexes hold references into the tree, so changes made through them are written by write()
+    """
+    __slots__ = ('path', 'tree', 'root', 'namespaces', 'files', 'disks', 'networks',
+                 'network_config_sections', 'customize_elements', 'virtual_systems')
+
+    def __init__(self, path, tree, namespaces):
+        self.path = path
+        self.tree = tree
+        self.root = tree.getroot()
+        self.namespaces = namespaces
+        # ovf:id => OvfFile / ovf:diskId => OvfDisk, both in document order
+        self.files = {}
+        self.disks = {}
+        self.networks = []
+        self.network_config_sections = []
+        self.customize_elements = []
+        self.virtual_systems = []
+        self._index()
+
+    def _index(self):
+        root = self.root
+        for child in root:
+            tag = child.tag
+            if tag == f'{{{OVF_NS}}}References':
+                for f in child.iter(f'{{{OVF_NS}}}File'):
+                    file_id = f.get(f'{{{OVF_NS}}}id')
+                    self.files[file_id] = OvfFile(file_id, f.get(f'{{{OVF_NS}}}href'),
+                                                  f.get(f'{{{OVF_NS}}}size'), f)
+            elif tag == f'{{{OVF_NS}}}DiskSection':
+                for d in child.iter(f'{{{OVF_NS}}}Disk'):
+                    disk = OvfDisk()
+                    disk.disk_id = d.get(f'{{{OVF_NS}}}diskId')
+                    disk.file_ref = d.get(f'{{{OVF_NS}}}fileRef')
+                    disk.capacity = d.get(f'{{{OVF_NS}}}capacity')
+                    disk.capacity_units = d.get(f'{{{OVF_NS}}}capacityAllocationUnits') or ''
+                    disk.populated_size = d.get(f'{{{OVF_NS}}}populatedSize')
+                    disk.element = d
+                    ovf_file = self.files.get(disk.file_ref)
+                    if ovf_file is not None:
+                        disk.file_name = ovf_file.href
+                    self.disks[disk.disk_id] = disk
+            elif tag == f'{{{OVF_NS}}}NetworkSection':
+                for n in child.iter(f'{{{OVF_NS}}}Network'):
+                    self.networks.append(OvfNetwork(n.get(f'{{{OVF_NS}}}name'), n))
+            elif tag == f'{{{VCLOUD_NS}}}NetworkConfigSection':
+                self.network_config_sections.append(child)
+            elif tag == f'{{{OVF_NS}}}VirtualSystemCollection':
+                for vs in child.findall(f'{{{OVF_NS}}}VirtualSystem'):
+                    self.virtual_systems.append(self._index_virtual_system(vs))
+            for grandchild in child.findall(f'{{{VCLOUD_NS}}}CustomizeOnInstantiate'):
+                self.customize_elements.append(grandchild)
+
+    @staticmethod
+    def _index_virtual_system(vs):
+        ovf_vs = OvfVirtualSystem(vs.get(f'{{{OVF_NS}}}id'), vs)
+        for section in vs:
+            tag = section.tag
+            if tag == f'{{{OVF_NS}}}VirtualHardwareSection':
+                ovf_vs.hardware_sections.append(section)
+                for item in section.findall(f'{{{OVF_NS}}}Item'):
+                    ovf_vs.items.append((section, item))
+                    description = item.find(f'{{{RASD_NS}}}Description')
+                    if description is not None and description.text \
+                            and description.text.upper() == 'HARD DISK':
+                        element_name = item.find(f'{{{RASD_NS}}}ElementName')
+                        host_resource = item.find(f'{{{RASD_NS}}}HostResource')
+                        ovf_vs.hard_disks.append(OvfHardDisk(
+                            element_name.text if element_name is not None else '',
+                            host_resource.text if host_resource is not None else '',
+                            item,
+                            item.find(f'{{{VMW_NS}}}Config')))
+            elif tag == f'{{{OVF_NS}}}ProductSection':
+                ovf_vs.product_properties.extend(section.findall(f'{{{OVF_NS}}}Property'))
+            elif tag == f'{{{VCLOUD_NS}}}NetworkConnectionSection':
+                ovf_vs.network_connections.extend(section.findall(f'{{{VCLOUD_NS}}}NetworkConnection'))
+        return ovf_vs
+
+    def disk_files(self):
+        """
+        the References entries for disks (ovf:id contains "file"), as returned by ovftool/VCD
+        :return: list of OvfFile
+        """
+        return [f for f in self.files.values() if 'file' in f.file_id]
+
+    def serialize(self):
+        """
+        serialize the tree the same way the OVF is written to disk
+        :return: bytes
+        """
+        for prefix, uri in self.namespaces.items():
+            ET.register_namespace(prefix, uri)
+        buffer = io.BytesIO()
+        self.tree.write(buffer, encoding='utf-8', xml_declaration=True, method='xml')
+        return buffer.getvalue()
+
+    def write(self, file_path=None):
+        """
+        serialize the tree
+        :param file_path: destination (default: the file this envelope was read from)
+        :return: the bytes written
+        """
+        if file_path is None:
+            file_path = self.path
+        data = self.serialize()
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        if os.path.abspath(file_path) == os.path.abspath(self.path):
+            _cache_envelope(self)
+        return data
+
+
+def _envelope_cache_key(file_path):
+    st = os.stat(file_path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _cache_envelope(envelope, key=None):
+    path = os.path.abspath(envelope.path)
+    if key is None:
+        key = _envelope_cache_key(path)
+    _ENVELOPE_CACHE[path] = (key, envelope)
+    _ENVELOPE_CACHE.move_to_end(path)
+    while len(_ENVELOPE_CACHE) > _ENVELOPE_CACHE_MAX:
+        _ENVELOPE_CACHE.popitem(last=False)
+
+
+def forget_ovf_envelope(ovf_file):
+    """
+    drop a descriptor from the parse cache (e.g. after a failed in-place edit)
+    :param ovf_file: full path to the OVF
+    :return: None
+    """
+    _ENVELOPE_CACHE.pop(os.path.abspath(ovf_file), None)
+
+
+def load_ovf_envelope(ovf_file, use_cache=True):
+    """
+    Parse an OVF in a single pass (namespaces are collected while the tree is built) and index it.
+    Results are cached by (path, mtime, size) so repeated operations on the same descriptor parse it once.
+    :param ovf_file: full path to the OVF
+    :param use_cache: return a cached envelope if the file has not changed
+    :return: OvfEnvelope
+    """
+    path = os.path.abspath(ovf_file)
+    key = _envelope_cache_key(path)
+    if use_cache:
+        cached = _ENVELOPE_CACHE.get(path)
+        if cached is not None and cached[0] == key:
+            _ENVELOPE_CACHE.move_to_end(path)
+            return cached[1]
+    envelope = _parse_envelope(path, path)
+    _cache_envelope(envelope, key)
+    return envelope
+
+
+def _parse_envelope(source, path):
+    namespaces = {}
+    parser = ET.iterparse(source, events=('start-ns',))
+    for _, (prefix, uri) in parser:
+        namespaces[prefix] = uri
+    for prefix, uri in namespaces.items():
+        ET.register_namespace(prefix, uri)
+    return OvfEnvelope(path, ET.ElementTree(parser.root), namespaces)
+
+
+def parse_ovf_envelope(data, path=None):
+    """
+    Parse an OVF descriptor that is not (yet) on disk, e.g. one fetched from VCD. Not cached.
+    :param data: the descriptor, bytes
+    :param path: where it will be written by write() (optional)
+    :return: OvfEnvelope
+    """
+    return _parse_envelope(io.BytesIO(data), path)
+
+
+def _capacity_bytes(disk):
+    # ovf:capacityAllocationUnits is "byte" or "byte * 2^N"; VCD uses 2^20, 2^30 or (rarely) plain bytes
+    match = re.search(r'2\^(\d+)', disk.capacity_units)
+    return int(disk.capacity) * (2 ** int(match.group(1)) if match else 1)
+
+
+def get_ovf_size_estimate(envelope):
+    """
+    how many bytes the files referenced by a descriptor will take up: the sum of the References ovf:size values,
+    falling back to the disk capacities (an upper bound) for any disk file without a size
+    :param envelope: OvfEnvelope
+    :return: (int bytes, bool exact -- False if any capacity had to be used)
+    """
+    total = 0
+    exact = True
+    capacity_by_file = {disk.file_ref: disk for disk in envelope.disks.values() if disk.capacity}
+    for ovf_file in envelope.files.values():
+        if ovf_file.size:
+            total += int(ovf_file.size)
+        elif ovf_file.file_id in capacity_by_file:
+            total += _capacity_bytes(capacity_by_file[ovf_file.file_id])
+            exact = False
+    return total, exact
+
+
+class HashProgress:
+    """
+    thread-safe byte counter for hash_files(): calls back with (bytes_hashed, total_bytes)
+    and logs throughput every log_interval seconds
+    """
+
+    def __init__(self, total_bytes, callback=None, log_interval=30):
+        self.total_bytes = total_bytes
+        self.hashed_bytes = 0
+        self.callback = callback
+        self.log_interval = log_interval
+        self.start_time = time.monotonic()
+        self._last_log = self.start_time
+        self._lock = threading.Lock()
+
+    def update(self, byte_count):
+        with self._lock:
+            self.hashed_bytes += byte_count
+            hashed = self.hashed_bytes
+            now = time.monotonic()
+            log_now = now - self._last_log >= self.log_interval
+            if log_now:
+                self._last_log = now
+        if self.callback is not None:
+            self.callback(hashed, self.total_bytes)
+        if log_now:
+            logging.info(f'hashed {hashed / BYTES_PER_GB:.2f} of {self.total_bytes / BYTES_PER_GB:.2f} GB '
+                         f'({self.throughput() / BYTES_PER_MB:.1f} MB/s)')
+
+    def throughput(self):
+        """
+        :return: bytes per second since start
+        """
+        elapsed = time.monotonic() - self.start_time
+        return self.hashed_bytes / elapsed if elapsed > 0 else 0.0
+
+
+class DigestCache:
+    """
+    persistent file digests in a SQLite database (by default <library>/.hol-index.sqlite), keyed by
+    (device, inode, size, mtime_ns): a file is only hashed again when it has actually changed
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS digests ('
+                             'device INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, '
+                             'mtime_ns INTEGER NOT NULL, algorithm TEXT NOT NULL, digest TEXT NOT NULL, '
+                             'path TEXT, updated REAL, '
+                             'PRIMARY KEY (device, inode, algorithm))')
+
+    @classmethod
+    def for_library(cls, library_path):
+        """
+        :param library_path: the repository root, e.g. /hol/lib
+        :return: DigestCache, or None if the library is not writable
+        """
+        try:
+            return cls(os.path.join(library_path, INDEX_DB_NAME))
+        except sqlite3.Error as e:
+            logging.warning(f'digest cache unavailable in {library_path}: {e}')
+            return None
+
+    def lookup(self, file_path, algorithm='sha256', st=None):
+        """
+        :param file_path: full path to the file
+        :param algorithm: hashlib algorithm name
+        :param st: os.stat_result of the file, if the caller already has it
+        :return: the cached hex digest, or None if unknown or the file changed since it was hashed
+        """
+        if st is None:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, digest FROM digests '
+                                   'WHERE device = ? AND inode = ? AND algorithm = ?',
+                                   (st.st_dev, st.st_ino, algorithm)).fetchone()
+        if row is not None and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        return None
+
+    def store(self, file_path, digest, algorithm='sha256', st=None):
+        """
+        remember a digest for the file as it is now (or as it was when st was taken)
+        :return: None
+        """
+        if st is None:
+            st = os.stat(file_path)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO digests '
+                             '(device, inode, size, mtime_ns, algorithm, digest, path, updated) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm, digest,
+                              os.path.abspath(file_path), time.time()))
+
+    def prune(self):
+        """
+        forget digests of files that were deleted or replaced
+        :return: number of entries removed
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT device, inode, size, mtime_ns, path FROM digests').fetchall()
+        stale = []
+        for device, inode, size, mtime_ns, path in rows:
+            try:
+                st = os.stat(path)
+                if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (device, inode, size, mtime_ns):
+                    stale.append((device, inode))
+            except (OSError, TypeError):
+                stale.append((device, inode))
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM digests WHERE device = ? AND inode = ?', stale)
+        return len(stale)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
 
+def _same_file_state(st_before, st_after):
+    return (st_before.st_dev, st_before.st_ino, st_before.st_size, st_before.st_mtime_ns) == \
+        (st_after.st_dev, st_after.st_ino, st_after.st_size, st_after.st_mtime_ns)
 
-def get_sha256_hash(file_path):
-    sha256_hash = sha256()
-    block_size = 4096
+
+def _hash_file_cached(file_path, algorithm, block_size, progress, digest_cache):
+    """
+    consult the cache, otherwise hash and store the result if the file did not change while it was read
+    """
+    st = os.stat(file_path)
+    digest = digest_cache.lookup(file_path, algorithm, st)
+    if digest is not None:
+        if progress is not None:
+            progress.update(st.st_size)
+        return digest
+    digest = _hash_file(file_path, algorithm, block_size, progress)
+    if _same_file_state(st, os.stat(file_path)):
+        digest_cache.store(file_path, digest, algorithm, st)
+    return digest
+
+
+def _hash_file(file_path, algorithm='sha256', block_size=HASH_BLOCK_SIZE, progress=None):
+    """
+    hash one file with a single reusable buffer (hashlib releases the GIL while hashing large blocks)
+    :return: hex digest
+    """
+    file_hash = hashlib.new(algorithm)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            file_hash.update(view[:n])
+            if progress is not None:
+                progress.update(n)
+    return file_hash.hexdigest()
+
+
+def get_sha256_hash(file_path, block_size=HASH_BLOCK_SIZE, digest_cache=None):
+    """
+    SHA256 of a file
+    :param file_path: full path to the file
+    :param block_size: read size in bytes
+    :param digest_cache: DigestCache to consult/update
+    :return: hex digest, or None if file_path is not a file
+    """
     if os.path.isfile(file_path):
-        with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(block_size), b""):
-                sha256_hash.update(byte_block)
-            return sha256_hash.hexdigest()
+        if digest_cache is not None:
+            return _hash_file_cached(file_path, 'sha256', block_size, None, digest_cache)
+        return _hash_file(file_path, 'sha256', block_size)
+
+
+def hash_files(file_paths, algorithm='sha256', max_workers=None, progress_callback=None,
+               block_size=HASH_BLOCK_SIZE, digest_cache=None):
+    """
+    hash several files in parallel threads, e.g. all the files of a template
+    :param file_paths: iterable of full paths
+    :param algorithm: any hashlib algorithm name ('sha256', 'sha1', ...)
+    :param max_workers: number of hashing threads (default: one per file, up to HASH_MAX_WORKERS)
+    :param progress_callback: function(bytes_hashed, total_bytes)
+    :param block_size: read size in bytes
+    :param digest_cache: DigestCache to consult/update (unchanged files are not read at all)
+    :return: dict of path => hex digest (None for missing/unreadable files)
+    """
+    file_paths = list(dict.fromkeys(file_paths))
+    results = {p: None for p in file_paths}
+    sizes = {}
+    for file_path in file_paths:
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            continue
+        if digest_cache is not None:
+            results[file_path] = digest_cache.lookup(file_path, algorithm, st)
+            if results[file_path] is not None:
+                continue
+        sizes[file_path] = st.st_size
+    if digest_cache is not None:
+        cached = sum(1 for digest in results.values() if digest is not None)
+        if cached:
+            logging.info(f'{cached} of {len(file_paths)} digest(s) found in cache')
+    # largest first so one huge disk does not start last
+    to_hash = sorted(sizes, key=lambda p: sizes[p], reverse=True)
+    total_bytes = sum(sizes.values())
+    progress = HashProgress(total_bytes, progress_callback)
+    if max_workers is None:
+        max_workers = min(max(len(to_hash), 1), HASH_MAX_WORKERS)
+
+    def hash_one(file_path):
+        if digest_cache is not None:
+            return _hash_file_cached(file_path, algorithm, block_size, progress, digest_cache)
+        return _hash_file(file_path, algorithm, block_size, progress)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(hash_one, p): p for p in to_hash}
+        for future in as_completed(futures):
+            file_path = futures[future]
+            try:
+                results[file_path] = future.result()
+            except OSError as e:
+                logging.error(f'unable to hash {file_path}: {e}')
+    if to_hash:
+        elapsed = time.monotonic() - progress.start_time
+        logging.info(f'hashed {len(to_hash)} file(s), {total_bytes / BYTES_PER_GB:.2f} GB in {elapsed:.1f} s '
+                     f'({progress.throughput() / BYTES_PER_MB:.1f} MB/s)')
+    return results
 
 
 def register_all_namespaces(filename):
@@ -48,51 +578,230 @@ def register_all_namespaces(filename):
     return namespaces
 
 
-def validate_the_ovf(ovf_file, verbose=False):
+def read_the_manifest(manifest_file):
+    """
+    parse an OVF manifest ("SHA256(file.vmdk)= abc123...")
+    :param manifest_file: full path to the MF
+    :return: dict of file name => (algorithm, hex digest), empty if the file is missing
+    """
+    try:
+        with open(manifest_file, 'r') as f:
+            return parse_manifest(f, manifest_file)
+    except FileNotFoundError:
+        return {}
+
+
+def parse_manifest(lines, source='manifest'):
+    """
+    :param lines: iterable of manifest lines (an open file, or text.splitlines())
+    :param source: name for the warnings
+    :return: dict of file name => (algorithm, hex digest)
+    """
+    entries = {}
+    for line in lines:
+        match = MANIFEST_LINE_PATTERN.match(line.strip())
+        if match:
+            algorithm, file_name, digest = match.groups()
+            entries[file_name] = (algorithm.lower(), digest.lower())
+        elif line.strip():
+            logging.warning(f'unexpected manifest line in {source}: {line.strip()}')
+    return entries
+
+
+def verify_against_digests(base_dir, expected, max_workers=None, digest_cache=None, progress_callback=None):
+    """
+    hash local files in parallel and compare them with known-good digests (a source template's .mf, or digests
+    computed on the source node)
+    :param base_dir: directory the names in expected are relative to
+    :param expected: dict of file name => (algorithm, hex digest)
+    :param max_workers: hashing threads
+    :param digest_cache: DigestCache for the local files
+    :param progress_callback: function(bytes_hashed, total_bytes) per algorithm group
+    :return: dict of file name => 'missing' or 'mismatch' for every file that does not match
+    """
+    by_algorithm = {}
+    for file_name, (algorithm, digest) in expected.items():
+        by_algorithm.setdefault(algorithm, {})[os.path.join(base_dir, file_name)] = (file_name, digest)
+    problems = {}
+    for algorithm, files in by_algorithm.items():
+        digests = hash_files(files, algorithm, max_workers, progress_callback, digest_cache=digest_cache)
+        for file_path, (file_name, digest) in files.items():
+            if digests[file_path] is None:
+                problems[file_name] = 'missing'
+            elif digests[file_path] != digest.lower():
+                problems[file_name] = 'mismatch'
+    return problems
+
+
+def _expected_file_parts(parent_dir, ovf_file_ref):
+    """
+    the on-disk file(s) behind a References entry: chunked files (ovf:chunkSize) are split into NAME.000000000...
+    """
+    if ovf_file_ref.element.get(f'{{{OVF_NS}}}chunkSize') and ovf_file_ref.size:
+        part_count = math.ceil(int(ovf_file_ref.size) / int(ovf_file_ref.element.get(f'{{{OVF_NS}}}chunkSize')))
+        return [os.path.join(parent_dir, f'{ovf_file_ref.href}.{i:09d}') for i in range(part_count)]
+    return [os.path.join(parent_dir, ovf_file_ref.href)]
+
+
+def _check_file_structure(file_path):
+    """
+    cheap header/footer sanity check of a component file (reads a few KB, see inspect_vmdk)
+    :return: None if OK, otherwise a description of the problem
+    """
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return 'empty file'
+    if not file_path.lower().endswith('.vmdk'):
+        return None
+    inspection = inspect_vmdk(file_path)
+    if inspection.ok:
+        return None
+    return '; '.join(inspection.problems)
+
+
+def inspect_template_vmdks(template_dir):
+    """
+    run inspect_vmdk on every VMDK in a template directory
+    :param template_dir: full path to the template directory
+    :return: dict of file name => VmdkInspection
+    """
+    results = {}
+    for entry in sorted(os.scandir(template_dir), key=lambda e: e.name):
+        if entry.is_file() and entry.name.lower().endswith('.vmdk'):
+            results[entry.name] = inspect_vmdk(entry.path)
+    return results
+
+
+def get_ovf_validation_report(ovf_file, level=VALIDATION_FAST, max_workers=None, digest_cache=None):
+    """
+    Check the files listed in the OVF at the requested level:
+        fast - present on disk and of the indicated ovf:size
+        structural - fast, plus a manifest that covers every file and a structural check of each VMDK
+                     (header, footer, grain directory and sampled grains -- see inspect_vmdk)
+        full - structural, plus SHA256 (or the manifest's algorithm) of every file compared with the manifest
+    :param ovf_file: full path to the OVF file
+    :param level: one of VALIDATION_LEVELS
+    :param max_workers: hashing threads for the full level
+    :param digest_cache: DigestCache so files unchanged since they were last hashed are not read again
+    :return: dict - {'ovf', 'level', 'ok', 'files': [...], 'errors': [...]}
+    """
+    if level not in VALIDATION_LEVELS:
+        raise ValueError(f'unknown validation level {level}, expected one of {VALIDATION_LEVELS}')
+    parent_dir = os.path.dirname(ovf_file)
+    envelope = load_ovf_envelope(ovf_file)
+    report = {'ovf': ovf_file, 'level': level, 'ok': True, 'files': [], 'errors': []}
+
+    def fail(entry, problem):
+        entry['status'] = 'FAIL'
+        entry['problems'].append(problem)
+        report['ok'] = False
+
+    entries = {}
+    for ovf_file_ref in envelope.files.values():
+        entry = {'name': ovf_file_ref.href, 'expected_size': ovf_file_ref.size, 'found_size': None,
+                 'status': 'OK', 'problems': []}
+        entries[ovf_file_ref.href] = entry
+        report['files'].append(entry)
+        found_size = 0
+        for part in _expected_file_parts(parent_dir, ovf_file_ref):
+            try:
+                found_size += os.path.getsize(part)
+            except FileNotFoundError:
+                found_size = 'NOT_FOUND'
+                break
+            except PermissionError:
+                found_size = 'UNABLE_TO_READ'
+                break
+        entry['found_size'] = found_size
+        if isinstance(found_size, str):
+            fail(entry, found_size)
+        elif ovf_file_ref.size is not None and int(ovf_file_ref.size) != found_size:
+            fail(entry, 'SIZE_MISMATCH')
+
+    if level == VALIDATION_FAST:
+        return report
+
+    manifest_file = os.path.splitext(ovf_file)[0] + '.mf'
+    manifest = read_the_manifest(manifest_file)
+    if not manifest:
+        report['errors'].append(f'manifest missing or empty: {manifest_file}')
+        report['ok'] = False
+    elif os.path.basename(ovf_file) not in manifest:
+        report['errors'].append(f'manifest does not list {os.path.basename(ovf_file)}')
+        report['ok'] = False
+    for name, entry in entries.items():
+        if manifest and name not in manifest:
+            fail(entry, 'NOT_IN_MANIFEST')
+        if entry['status'] == 'OK':
+            file_path = os.path.join(parent_dir, name)
+            if os.path.isfile(file_path):
+                problem = _check_file_structure(file_path)
+                if problem is not None:
+                    fail(entry, f'STRUCTURE: {problem}')
+
+    if level == VALIDATION_FULL and manifest:
+        by_algorithm = {}
+        for name, (algorithm, digest) in manifest.items():
+            by_algorithm.setdefault(algorithm, []).append(os.path.join(parent_dir, name))
+        found = {}
+        for algorithm, paths in by_algorithm.items():
+            found.update(hash_files(paths, algorithm=algorithm, max_workers=max_workers,
+                                    digest_cache=digest_cache))
+        ovf_entry = {'name': os.path.basename(ovf_file), 'expected_size': None,
+                     'found_size': os.path.getsize(ovf_file), 'status': 'OK', 'problems': []}
+        entries[ovf_entry['name']] = ovf_entry
+        report['files'].insert(0, ovf_entry)
+        for name, (algorithm, digest) in manifest.items():
+            entry = entries.get(name)
+            if entry is None:
+                report['errors'].append(f'manifest lists {name}, which is not referenced by the OVF')
+                report['ok'] = False
+                continue
+            actual = found.get(os.path.join(parent_dir, name))
+            entry['digest'] = actual
+            if actual is None:
+                if entry['status'] == 'OK':
+                    fail(entry, 'UNABLE_TO_HASH')
+            elif actual != digest:
+                fail(entry, f'{algorithm.upper()}_MISMATCH')
+    return report
+
+
+def validate_the_ovf(ovf_file, verbose=False, level=VALIDATION_FAST, digest_cache=None):
     """
     Ensure that the files listed in the OVF are present on disk and are of the indicated size
     :param ovf_file: full path to the OVF file
     :param verbose: boolean - verbose output?
+    :param level: VALIDATION_FAST, VALIDATION_STRUCTURAL or VALIDATION_FULL (see get_ovf_validation_report)
+    :param digest_cache: DigestCache to consult/update
     :return: boolean - is the OVF OK?
     """
-    all_good = True
-    parent_dir = os.path.dirname(ovf_file)
-    # the_files = os.listdir(parent_dir)
-    namespaces = register_all_namespaces(ovf_file)
-    tree = ET.parse(ovf_file)
-    root = tree.getroot()
-    # TODO: get the disk files and their expected sizes
-    disks = {}
-    for files in root.findall('ovf:References', namespaces=namespaces):
-        for f in files.findall('ovf:File', namespaces=namespaces):
-            if 'file' in f.get('{http://schemas.dmtf.org/ovf/envelope/1}id'):
-                disks[f.get('{http://schemas.dmtf.org/ovf/envelope/1}href')] = \
-                    f.get('{http://schemas.dmtf.org/ovf/envelope/1}size')
-    for disk_name in disks.keys():
-        try:
-            found_size = os.path.getsize(os.path.join(parent_dir, disk_name))
-        except FileNotFoundError:
-            found_size = 'NOT_FOUND'
-            all_good = False
-        except PermissionError:
-            found_size = 'UNABLE_TO_READ'
-            all_good = False
-        finally:
-            if verbose:
-                print(
-                    f"Expected Size: {disks[disk_name]}, found Size: {found_size}")
-    return all_good
+    report = get_ovf_validation_report(ovf_file, level=level, digest_cache=digest_cache)
+    if verbose:
+        for entry in report['files']:
+            line = f"{entry['name']}: Expected Size: {entry['expected_size']}, found Size: {entry['found_size']}"
+            if entry['problems']:
+                line += f" => {', '.join(entry['problems'])}"
+            print(line)
+        for error in report['errors']:
+            print(error)
+    return report['ok']
 
 
-def update_the_manifest(ovf_file, manifest_file=None):
+def update_the_manifest(ovf_file, manifest_file=None, new_hash=None, digest_cache=None):
     """
     Update the SHA256 sum for the OVF file in the MF file
     :param ovf_file: full path to the OVF
     :param manifest_file: full path to the MF
+    :param new_hash: SHA256 of the OVF if the caller already has it (default: hash the file)
+    :param digest_cache: DigestCache to consult/update
     :return: None
     """
     if os.path.isfile(ovf_file):
-        new_hash = get_sha256_hash(file_path=ovf_file)
+        if new_hash is None:
+            new_hash = get_sha256_hash(file_path=ovf_file, digest_cache=digest_cache)
+        elif digest_cache is not None:
+            digest_cache.store(ovf_file, new_hash)
         ovf_file_name = os.path.basename(ovf_file)
         if manifest_file is None:
             manifest_file = ovf_file.replace('.ovf', '.mf')
@@ -107,256 +816,410 @@ def update_the_manifest(ovf_file, manifest_file=None):
                 f.truncate()
 
 
-def scrub_the_ovf(ovf_file, backup_file=None):
+class ScrubReport:
     """
-    perform various 'cleanup' operations on an OVF file
-    :param ovf_file: full path to OVF file
-    :param backup_file: full path to backup file (default replaces ".ovf" with ".ovf.backup")
-    :return:
+    machine-readable record of the changes made by the scrub rules
     """
-    fixed_network_name = False
-    network_names = {'none': 'none'}
+    __slots__ = ('ovf_file', 'changes', 'verbose')
 
-    if backup_file is None:
-        backup_file_path = ovf_file.replace('.ovf', '.ovf.backup')
-    else:
-        backup_file_path = backup_file
+    def __init__(self, ovf_file, verbose=True):
+        self.ovf_file = ovf_file
+        self.changes = []
+        self.verbose = verbose
 
-    namespaces = register_all_namespaces(ovf_file)
-    tree = ET.parse(ovf_file)
-    root = tree.getroot()
-
-    # create the backup
-    tree.write(
-        backup_file_path,
-        encoding='utf-8',
-        xml_declaration=True,
-        method='xml')
-
-    # No CustomizeOnInstantiate!
-    print(f'=== CustomizeOnInstantiate ===')
-    for elem in root:
-        for sub in elem.findall('vcloud:CustomizeOnInstantiate', namespaces=namespaces):
+    def record(self, rule, target, old, new, vm_name=None):
+        """
+        note one change
+        :param rule: name of the rule making the change
+        :param target: what was changed (element/attribute description)
+        :param old: previous value
+        :param new: new value
+        :param vm_name: the VM the change applies to, if any
+        :return: None
+        """
+        self.changes.append({'rule': rule, 'vm': vm_name, 'target': target, 'old': old, 'new': new})
+        if self.verbose:
+            where = f'{vm_name}: ' if vm_name else ''
+            print(f'[{rule}] {where}{target}: {old} => {new}')
+
+    def to_dict(self):
+        counts = {}
+        for change in self.changes:
+            counts[change['rule']] = counts.get(change['rule'], 0) + 1
+        return {'ovf': self.ovf_file, 'change_count': len(self.changes),
+                'changes_by_rule': counts, 'changes': self.changes}
+
+
+class ScrubContext:
+    """
+    state shared by the rules during one traversal
+    """
+    __slots__ = ('envelope', 'report', 'network_names')
+
+    def __init__(self, envelope, report):
+        self.envelope = envelope
+        self.report = report
+        # old vApp network name => new name, filled by NetworkNameRule
+        self.network_names = {'none': 'none'}
+
+
+class ScrubRule:
+    """
+    base class for scrub visitors: override the visit_* hooks the rule needs.
+    visit_envelope is called first for every rule, then each VM, its hardware items and hard disks
+    are visited once, then the DiskSection disks.
+    """
+    name = 'rule'
+
+    def visit_envelope(self, ctx):
+        pass
+
+    def visit_virtual_system(self, ctx, vs):
+        pass
+
+    def visit_item(self, ctx, vs, vhs, item):
+        pass
+
+    def visit_hard_disk(self, ctx, vs, hard_disk):
+        pass
+
+    def visit_disk(self, ctx, disk):
+        pass
+
+
+class CustomizeOnInstantiateRule(ScrubRule):
+    """
+    No CustomizeOnInstantiate!
+    """
+    name = 'customize_on_instantiate'
+
+    def visit_envelope(self, ctx):
+        for sub in ctx.envelope.customize_elements:
             if sub.text != 'false':
-                print(
-                    f'CustomizeOnInstantiate... Current: {sub.tag} => {sub.text}')
+                ctx.report.record(self.name, 'CustomizeOnInstantiate', sub.text, 'false')
                 sub.text = 'false'
-                set_no_customize = True
-            else:
-                print('OK')
-
-    # I know we're going through this repeatedly, but it is more modular this way
-
-    # Passwords
-    print(f'\n=== Passwords ===')
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name}')
-            for prod_sec in vs.findall('ovf:ProductSection', namespaces=namespaces):
-                for prop in prod_sec.findall('ovf:Property', namespaces=namespaces):
-                    if prop.get('{http://schemas.dmtf.org/ovf/envelope/1}password') == 'true' \
-                            and prop.get('{http://schemas.dmtf.org/ovf/envelope/1}value') != '':
-                        # TODO: deal with 'ovf:qualifiers="MinLen(##)"' ?
-                        print(
-                            f"\tSetting password in ProductSection for "
-                            f"{prop.get('{http://schemas.dmtf.org/ovf/envelope/1}key')}")
-                        prop.set(
-                            '{http://schemas.dmtf.org/ovf/envelope/1}value', 'VMware1!VMware1!')
-                        set_ovf_password = True
-
-    # GuestInfo
-    print(f'\n=== GuestInfo ===')
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name} - GuestInfo')
-            for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                if vhs.get('{http://schemas.dmtf.org/ovf/envelope/1}transport') != 'com.vmware.guestInfo':
-                    vhs.set(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}transport', 'com.vmware.guestInfo')
-                    print("\tSetting OVF transport")
-                    set_ovf_transport = True
-
-    print(f'\n=== Network isolation and vApp Network Name ===')
-    # fixing the network name is a giant pain!
-    for ncs in root.findall('vcloud:NetworkConfigSection', namespaces=namespaces):
-        for net_cfg in ncs.findall('vcloud:NetworkConfig', namespaces=namespaces):
-            net_name = net_cfg.get('networkName')
-            if net_name != 'none':
-                print(f'{net_name}')
+
+
+class PasswordRule(ScrubRule):
+    """
+    set a known value for ProductSection password properties
+    """
+    name = 'password'
+
+    def __init__(self, password='VMware1!VMware1!'):
+        self.password = password
+
+    def visit_virtual_system(self, ctx, vs):
+        for prop in vs.product_properties:
+            if prop.get(f'{{{OVF_NS}}}password') == 'true' \
+                    and prop.get(f'{{{OVF_NS}}}value') != '':
+                # TODO: deal with 'ovf:qualifiers="MinLen(##)"' ?
+                ctx.report.record(self.name, f"ProductSection property {prop.get(f'{{{OVF_NS}}}key')}",
+                                  '********', '********', vs.vm_name)
+                prop.set(f'{{{OVF_NS}}}value', self.password)
+
+
+class GuestInfoRule(ScrubRule):
+    """
+    use the guestInfo OVF environment transport
+    """
+    name = 'guest_info'
+
+    def visit_virtual_system(self, ctx, vs):
+        for vhs in vs.hardware_sections:
+            transport = vhs.get(f'{{{OVF_NS}}}transport')
+            if transport != 'com.vmware.guestInfo':
+                vhs.set(f'{{{OVF_NS}}}transport', 'com.vmware.guestInfo')
+                ctx.report.record(self.name, 'ovf:transport', transport, 'com.vmware.guestInfo', vs.vm_name)
+
+
+class NetworkIsolationRule(ScrubRule):
+    """
+    isolate the vApp networks: fence mode, parent network attachment and NAT rules
+    """
+    name = 'network_isolation'
+
+    def visit_envelope(self, ctx):
+        namespaces = ctx.envelope.namespaces
+        for ncs in ctx.envelope.network_config_sections:
+            for net_cfg in ncs.findall('vcloud:NetworkConfig', namespaces=namespaces):
+                net_name = net_cfg.get('networkName')
+                if net_name == 'none':
+                    continue
                 for net_configuration in net_cfg.findall('vcloud:Configuration', namespaces=namespaces):
                     for fence_mode in net_configuration.findall('vcloud:FenceMode', namespaces=namespaces):
                         if fence_mode.text != 'isolated':
-                            print('\tSetting isolated mode')
+                            ctx.report.record(self.name, f'{net_name} FenceMode', fence_mode.text, 'isolated')
                             fence_mode.text = 'isolated'
-                            set_fence_mode = True
                     # Unwire the pod
                     for parent_network in net_configuration.findall('vcloud:ParentNetwork', namespaces=namespaces):
-                        print('\tRemoving parent network attachment')
+                        ctx.report.record(self.name, f'{net_name} ParentNetwork', parent_network.get('name'), None)
                         net_configuration.remove(parent_network)
-                        unwired_the_pod = True
                     for features in net_configuration.findall('vcloud:Features', namespaces=namespaces):
                         for nat_service_feature in features.findall('vcloud:NatService', namespaces=namespaces):
-                            print('\tRemoving configured NAT rules')
+                            ctx.report.record(self.name, f'{net_name} NatService', 'present', None)
                             features.remove(nat_service_feature)
-                            removed_stuck_nat_rules = True
-                # clean up the VCD netName bug by removing duplicate "vAppNet-" parts
+
+
+class NetworkNameRule(ScrubRule):
+    """
+    clean up the VCD netName bug by removing duplicate "vAppNet-" parts, everywhere the name is used
+    """
+    name = 'network_name'
+
+    def visit_envelope(self, ctx):
+        namespaces = ctx.envelope.namespaces
+        for ncs in ctx.envelope.network_config_sections:
+            for net_cfg in ncs.findall('vcloud:NetworkConfig', namespaces=namespaces):
+                net_name = net_cfg.get('networkName')
+                if net_name == 'none':
+                    continue
                 new_net_name = '-'.join(list(dict.fromkeys((net_name.split('-')))))
+                ctx.network_names[net_name] = new_net_name
                 if net_name != new_net_name:
-                    print(f"\tfixing network name: {new_net_name}")
+                    ctx.report.record(self.name, 'NetworkConfig networkName', net_name, new_net_name)
                     net_cfg.set('networkName', new_net_name)
-                    for net_section in root.findall('ovf:NetworkSection', namespaces=namespaces):
-                        for network in net_section.findall('ovf:Network', namespaces=namespaces):
-                            if network.get('{http://schemas.dmtf.org/ovf/envelope/1}name') != 'none':
-                                network.set(
-                                    '{http://schemas.dmtf.org/ovf/envelope/1}name', new_net_name)
-                    fixed_network_name = True
-                network_names[net_name] = new_net_name
-
-    print(f'\n=== Network Connections ===')
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name}')
-            for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                for item in vhs.findall('ovf:Item', namespaces=namespaces):
-                    for connection in item.findall('rasd:Connection', namespaces=namespaces):
-                        if connection.get('{http://www.vmware.com/vcloud/v1.5}ipAddressingMode') == 'POOL':
-                            connection.set(
-                                '{http://www.vmware.com/vcloud/v1.5}ipAddressingMode', 'DHCP')
-                        print("\tSetting network connection to DHCP")
-                        set_connection_to_dhcp = True
-                        old_net_name = connection.text
-                        if fixed_network_name:
-                            connection.text = network_names[connection.text]
-                    # if fixed_network_name and old_net_name != 'none':
-                    # actually need to do this because of VCD's issue with quotation marks in the Description
-                    for description in item.findall('rasd:Description', namespaces=namespaces):
-                        if "ethernet adapter" in description.text:
-                            if old_net_name != 'none' and fixed_network_name:
-                                print("\tupdating description")
-                                description.text = description.text.replace(
-                                    old_net_name, network_names[old_net_name])
-                        # handle the STUPID quoting that VCD adds (I refuse to replace with '&quot;')
-                        description.text = description.text.replace('"', '')
-    if fixed_network_name:
-        print(f'\n=== vcloud:NetworkConnectionSection ===')
-        for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-            for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-                vm_name = vs.attrib.get(
-                    '{http://schemas.dmtf.org/ovf/envelope/1}id')
-                print(f'=== {vm_name} - Network Name ===')
-                for ncs in vs.findall('vcloud:NetworkConnectionSection', namespaces=namespaces):
-                    for net_connection in ncs.findall('vcloud:NetworkConnection', namespaces=namespaces):
-                        if net_connection.get('network') != 'none':
-                            net_connection.set(
-                                'network', network_names[net_connection.get('network')])
-                            print(
-                                f"\tUpdating network name to {net_connection.get('network')}")
-
-    print(f'\n=== Hard Disks ===')
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name}')
-            for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                for item in vhs.findall('ovf:Item', namespaces=namespaces):
-                    for resource in item.findall('rasd:Description', namespaces=namespaces):
-                        if resource.text.upper() == 'HARD DISK':
-                            cfg = item.find(
-                                'vmw:Config', namespaces=namespaces)
-                            if cfg.get('{http://www.vmware.com/schema/ovf}key') != 'backing.writeThrough':
-                                cfg.set(
-                                    '{http://www.vmware.com/schema/ovf}key', 'backing.writeThrough')
-                                cfg.set(
-                                    '{http://www.vmware.com/schema/ovf}value', 'false')
-                                print("\tSetting hard disks to writeThrough")
-                                set_disk_to_persistent = True
-
-    # If disk capacities are present ... what do we do if they're not? The bug is still there and WILL cause problems.
-    disks = {}
-    for files in root.findall('ovf:References', namespaces=namespaces):
-        for f in files.findall('ovf:File', namespaces=namespaces):
-            if 'file' in f.get('{http://schemas.dmtf.org/ovf/envelope/1}id'):
-                disks[f.get('{http://schemas.dmtf.org/ovf/envelope/1}id')] = f.get(
-                    '{http://schemas.dmtf.org/ovf/envelope/1}size')
-    for disk in root.findall('ovf:DiskSection', namespaces=namespaces):
-        for d in disk.findall('ovf:Disk', namespaces=namespaces):
-            specified_capacity = int(
-                d.get('{http://schemas.dmtf.org/ovf/envelope/1}capacity'))
-            # TODO: find out why this is not always present in the OVF!
-            populated_size_bytes = 0
-            populated_size = d.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}populatedSize')
-            try:
-                populated_size_bytes = int(populated_size)
-            except TypeError:
-                logging.warning(
-                    'populatedSize is not present in this OVF. No EZT mitigations performed. ')
-            file_size_bytes = int(
-                disks[d.get('{http://schemas.dmtf.org/ovf/envelope/1}fileRef')])
+                    for network in ctx.envelope.networks:
+                        if network.name != 'none':
+                            ctx.report.record(self.name, 'NetworkSection Network', network.name, new_net_name)
+                            network.element.set(f'{{{OVF_NS}}}name', new_net_name)
+                            network.name = new_net_name
+
+    @staticmethod
+    def _renamed(ctx):
+        return any(old != new for old, new in ctx.network_names.items())
+
+    def visit_virtual_system(self, ctx, vs):
+        if not self._renamed(ctx):
+            return
+        for net_connection in vs.network_connections:
+            old_name = net_connection.get('network')
+            new_name = ctx.network_names.get(old_name, old_name)
+            if old_name != new_name:
+                net_connection.set('network', new_name)
+                ctx.report.record(self.name, 'NetworkConnection network', old_name, new_name, vs.vm_name)
+
+    def visit_item(self, ctx, vs, vhs, item):
+        if not self._renamed(ctx):
+            return
+        connection = item.find(f'{{{RASD_NS}}}Connection')
+        if connection is None:
+            return
+        old_name = connection.text
+        new_name = ctx.network_names.get(old_name, old_name)
+        if old_name == new_name:
+            return
+        connection.text = new_name
+        ctx.report.record(self.name, 'rasd:Connection', old_name, new_name, vs.vm_name)
+        for description in item.findall(f'{{{RASD_NS}}}Description'):
+            if description.text and "ethernet adapter" in description.text:
+                description.text = description.text.replace(old_name, new_name)
+
+
+class DescriptionQuotesRule(ScrubRule):
+    """
+    handle the STUPID quoting that VCD adds to item descriptions (I refuse to replace with '&quot;')
+    """
+    name = 'description_quotes'
+
+    def visit_item(self, ctx, vs, vhs, item):
+        for description in item.findall(f'{{{RASD_NS}}}Description'):
+            if description.text and '"' in description.text:
+                new_text = description.text.replace('"', '')
+                ctx.report.record(self.name, 'rasd:Description', description.text, new_text, vs.vm_name)
+                description.text = new_text
+
+
+class DhcpRule(ScrubRule):
+    """
+    switch POOL addressing on network connections to DHCP
+    """
+    name = 'dhcp'
+
+    def visit_item(self, ctx, vs, vhs, item):
+        for connection in item.findall(f'{{{RASD_NS}}}Connection'):
+            if connection.get(f'{{{VCLOUD_NS}}}ipAddressingMode') == 'POOL':
+                connection.set(f'{{{VCLOUD_NS}}}ipAddressingMode', 'DHCP')
+                ctx.report.record(self.name, f'{connection.text} ipAddressingMode', 'POOL', 'DHCP', vs.vm_name)
+
 
+class WriteThroughRule(ScrubRule):
+    """
+    set hard disks to writeThrough
+    """
+    name = 'write_through'
+
+    def visit_hard_disk(self, ctx, vs, hard_disk):
+        cfg = hard_disk.config
+        if cfg is not None and cfg.get(f'{{{VMW_NS}}}key') != 'backing.writeThrough':
+            ctx.report.record(self.name, f'{hard_disk.element_name} vmw:Config',
+                              cfg.get(f'{{{VMW_NS}}}key'), 'backing.writeThrough', vs.vm_name)
+            cfg.set(f'{{{VMW_NS}}}key', 'backing.writeThrough')
+            cfg.set(f'{{{VMW_NS}}}value', 'false')
+
+
+class DiskCapacityRule(ScrubRule):
+    """
+    fix disk capacities: KB 2094271 rounding errors (MB units) and the "60% full means EZT" issue (GB units)
+    """
+    name = 'disk_capacity'
+
+    def visit_disk(self, ctx, disk):
+        # If disk capacities are present ... what do we do if they're not? The bug is still there and WILL cause
+        # problems.
+        specified_capacity = int(disk.capacity)
+        # TODO: find out why this is not always present in the OVF!
+        populated_size_bytes = 0
+        try:
+            populated_size_bytes = int(disk.populated_size)
+        except TypeError:
+            logging.warning(
+                'populatedSize is not present in this OVF. No EZT mitigations performed. ')
+        file_size_bytes = int(ctx.envelope.files[disk.file_ref].size)
+
+        new_capacity = None
+        if 'byte * 2^20' in disk.capacity_units:
             # check for KB 2094271 rounding errors (data on disk exceeds size of disk specified in OVF)
-            if 'byte * 2^20' in d.get('{http://schemas.dmtf.org/ovf/envelope/1}capacityAllocationUnits'):
-                specified_capacity_bytes = int(
-                    specified_capacity * BYTES_PER_MB)
-                disk_size_difference = file_size_bytes - specified_capacity_bytes
-                if disk_size_difference > 0:
-                    increase_mb = math.ceil(
-                        disk_size_difference / BYTES_PER_MB)
-                    new_capacity_size_mb = specified_capacity + increase_mb
-                    print(
-                        f'Disk is {disk_size_difference} bytes too small for contents, increasing from '
-                        f'{specified_capacity} to {new_capacity_size_mb} MB')
-                    d.set(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}capacity',
-                        str(new_capacity_size_mb))
-            elif 'byte * 2^30' in d.get('{http://schemas.dmtf.org/ovf/envelope/1}capacityAllocationUnits'):
-                # work around "60% full means EZT" issue
-                specified_capacity_bytes = int(
-                    specified_capacity * BYTES_PER_GB)
-                new_size = math.ceil(
-                    populated_size_bytes / (EZT_BUG_TRIGGER_PERCENTAGE/100) / BYTES_PER_GB)
-                if new_size < 1 and populated_size_bytes != 0:
-                    print(
-                        f"WARNING: MINIMALLY USED DISK!! {d.get('{http://schemas.dmtf.org/ovf/envelope/1}fileRef')}")
-                    new_size = 1
-                if new_size > 0:
-                    new_full_percent = 100 * populated_size_bytes / \
-                        (new_size * BYTES_PER_GB)
-                else:
-                    # not the cleanest, but do something when we have no data to act upon
-                    new_full_percent = EZT_BUG_TRIGGER_PERCENTAGE + 10
-                percent_full = 100 * populated_size_bytes / specified_capacity_bytes
-                print(
-                    f'Populated data is {populated_size_bytes} / {specified_capacity_bytes} = '
-                    f'{percent_full:.2f}% ')
-                if percent_full > EZT_BUG_TRIGGER_PERCENTAGE:
-                    print(
-                        f'Disk is too small for thin. Increased from {specified_capacity} '
-                        f'to {new_size} GB ({new_full_percent:.2f}%) full')
-                    d.set(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}capacity',
-                        str(new_size))
-
-            elif 'byte * 2^40' in d.get('{http://schemas.dmtf.org/ovf/envelope/1}capacityAllocationUnits'):
-                specified_capacity_bytes = int(
-                    specified_capacity * BYTES_PER_TB)
-                # TODO: not sure what else to do here: future?
-            else:
-                print("ERROR: Unable to get disk size")
-                specified_capacity_bytes = '0'
-
-    tree.write(
-        ovf_file,
-        encoding='utf-8',
-        xml_declaration=True,
-        method='xml')
+            disk_size_difference = file_size_bytes - specified_capacity * BYTES_PER_MB
+            if disk_size_difference > 0:
+                new_capacity = specified_capacity + math.ceil(disk_size_difference / BYTES_PER_MB)
+        elif 'byte * 2^30' in disk.capacity_units:
+            # work around "60% full means EZT" issue
+            specified_capacity_bytes = specified_capacity * BYTES_PER_GB
+            new_size = math.ceil(
+                populated_size_bytes / (EZT_BUG_TRIGGER_PERCENTAGE/100) / BYTES_PER_GB)
+            if new_size < 1 and populated_size_bytes != 0:
+                logging.warning(f'MINIMALLY USED DISK!! {disk.file_ref}')
+                new_size = 1
+            percent_full = 100 * populated_size_bytes / specified_capacity_bytes
+            if percent_full > EZT_BUG_TRIGGER_PERCENTAGE:
+                new_capacity = new_size
+        elif 'byte * 2^40' not in disk.capacity_units:
+            # TODO: TB units -- not sure what else to do here: future?
+            logging.error(f'Unable to get disk size for {disk.disk_id}')
+        if new_capacity is not None:
+            ctx.report.record(self.name, f'{disk.disk_id} capacity ({disk.capacity_units})',
+                              disk.capacity, str(new_capacity))
+            disk.element.set(f'{{{OVF_NS}}}capacity', str(new_capacity))
+            disk.capacity = str(new_capacity)
+
+
+class TimeBubbleRule(ScrubRule):
+    """
+    stuff all VMs into a "time bubble": the clock is set to the specified time at each boot
+    """
+    name = 'time_bubble'
+
+    def __init__(self, rtc_start_time: int):
+        self.rtc_start_time = rtc_start_time
+
+    def visit_virtual_system(self, ctx, vs):
+        for vhs in vs.hardware_sections:
+            existing = None
+            for item in vhs.findall(f'{{{VMW_NS}}}ExtraConfig'):
+                if item.get(f'{{{VMW_NS}}}key') == 'rtc.startTime':
+                    existing = item.get(f'{{{VMW_NS}}}value')
+            if existing is not None:
+                logging.info(f'{vs.vm_name}: found existing bubble config: {existing} => '
+                             f'Date: {ctime(int(existing))}')
+                continue
+            # add the bubble properties
+            vhs.append(build_extra_config_item('true', 'time.synchronize.tools.enable', '0'))
+            vhs.append(build_extra_config_item('true', 'time.synchronize.tools.startup', '0'))
+            vhs.append(build_extra_config_item('true', 'rtc.startTime', str(self.rtc_start_time)))
+            ctx.report.record(self.name, 'rtc.startTime', None, str(self.rtc_start_time), vs.vm_name)
+
+
+class UnbubbleRule(ScrubRule):
+    """
+    undo a "time bubble"
+    """
+    name = 'unbubble'
+    bubble_keys = ('rtc.startTime', 'time.synchronize.tools.enable',
+                   'time.synchronize.tools.startup')
+
+    def visit_virtual_system(self, ctx, vs):
+        for vhs in vs.hardware_sections:
+            for item in vhs.findall(f'{{{VMW_NS}}}ExtraConfig'):
+                item_key = item.get(f'{{{VMW_NS}}}key')
+                if item_key in self.bubble_keys:
+                    ctx.report.record(self.name, item_key, item.get(f'{{{VMW_NS}}}value'), None, vs.vm_name)
+                    vhs.remove(item)
+
+
+def default_scrub_rules():
+    """
+    the HOL scrub rules, in the order they are applied to each node
+    :return: list of ScrubRule
+    """
+    return [CustomizeOnInstantiateRule(), PasswordRule(), GuestInfoRule(), NetworkIsolationRule(),
+            NetworkNameRule(), DhcpRule(), DescriptionQuotesRule(), WriteThroughRule(), DiskCapacityRule()]
+
+
+def apply_scrub_rules(envelope, rules, report=None):
+    """
+    run the rules over the envelope in a single traversal (the tree is changed in memory only)
+    :param envelope: OvfEnvelope
+    :param rules: list of ScrubRule
+    :param report: ScrubReport to add to (default: a new one)
+    :return: ScrubReport
+    """
+    if report is None:
+        report = ScrubReport(envelope.path)
+    ctx = ScrubContext(envelope, report)
+    try:
+        for rule in rules:
+            rule.visit_envelope(ctx)
+        for vs in envelope.virtual_systems:
+            for rule in rules:
+                rule.visit_virtual_system(ctx, vs)
+            for vhs, item in vs.items:
+                for rule in rules:
+                    rule.visit_item(ctx, vs, vhs, item)
+            for hard_disk in vs.hard_disks:
+                for rule in rules:
+                    rule.visit_hard_disk(ctx, vs, hard_disk)
+        for disk in envelope.disks.values():
+            for rule in rules:
+                rule.visit_disk(ctx, disk)
+    except Exception:
+        # the cached tree is half-edited: make the next caller parse the file again
+        forget_ovf_envelope(envelope.path)
+        raise
+    return report
+
+
+def _rewrite_the_ovf(ovf_file, rules, backup_file=None, verbose=True):
+    """
+    back up, apply rules and write the OVF once
+    :return: (ScrubReport, bytes written)
+    """
+    if backup_file is None:
+        backup_file_path = ovf_file.replace('.ovf', '.ovf.backup')
+    else:
+        backup_file_path = backup_file
+
+    envelope = load_ovf_envelope(ovf_file)
+    # create the backup: a plain copy of the original bytes, no need to serialize the tree for that
+    shutil.copyfile(ovf_file, backup_file_path)
+
+    report = apply_scrub_rules(envelope, rules, ScrubReport(ovf_file, verbose=verbose))
+    data = envelope.write()
+    return report, data
+
+
+def scrub_the_ovf(ovf_file, backup_file=None, rules=None):
+    """
+    perform various 'cleanup' operations on an OVF file
+    :param ovf_file: full path to OVF file
+    :param backup_file: full path to backup file (default replaces ".ovf" with ".ovf.backup")
+    :param rules: list of ScrubRule to apply (default: default_scrub_rules())
+    :return: ScrubReport
+    """
+    if rules is None:
+        rules = default_scrub_rules()
+    report, data = _rewrite_the_ovf(ovf_file, rules, backup_file)
+    return report
 
 
 def get_disk_map_from_ovf(the_ovf):
@@ -366,137 +1229,156 @@ def get_disk_map_from_ovf(the_ovf):
     :return: list of OvfDisk objects
     """
     if os.path.isfile(the_ovf):
-        namespaces = register_all_namespaces(the_ovf)
-        tree = ET.parse(the_ovf)
-        root = tree.getroot()
-
-        # Read the disks from the References section
-        disks = {}
-        for files in root.findall('ovf:References', namespaces=namespaces):
-            for f in files.findall('ovf:File', namespaces=namespaces):
-                if 'file' in f.get('{http://schemas.dmtf.org/ovf/envelope/1}id'):
-                    new_disk = OvfDisk()
-                    new_disk.file_ref = f.get(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}id')
-                    new_disk.file_name = f.get(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}href')
-                    disks[f.get(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}id')] = new_disk
+        return get_disk_map_from_envelope(load_ovf_envelope(the_ovf))
 
-        logging.debug(
-            '*** VMDK file IDs ("file-") and Local File Names from References Section')
-        for disk_key in disks.keys():
-            disk_obj = disks[disk_key]
-            logging.debug(f'{disk_obj.file_name} => {disk_obj.file_ref}')
-
-        # a table of OvfDisks, indexed by a different key to facilitate lookups in the next section
-        disks_by_vmdisk = {}
-        for disk in root.findall('ovf:DiskSection', namespaces=namespaces):
-            for d in disk.findall('ovf:Disk', namespaces=namespaces):
-                ref = d.get('{http://schemas.dmtf.org/ovf/envelope/1}fileRef')
-                try:
-                    disks[ref].disk_id = d.get(
-                        '{http://schemas.dmtf.org/ovf/envelope/1}diskId')
-                    disks_by_vmdisk[disks[ref].disk_id] = disks[ref]
-                except KeyError as e:
-                    logging.error(
-                        f'BAD OVF? This should not be happening: {e}')
-
-        logging.debug('*** Disk ID ("vmdisk-") from DiskSection')
-        for disk_key in disks.keys():
-            disk_obj = disks[disk_key]
-            logging.debug(f'{disk_obj.file_name} => {disk_obj.disk_id}')
-
-        for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-            for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-                vm_name = vs.attrib.get(
-                    '{http://schemas.dmtf.org/ovf/envelope/1}id')
-                logging.debug(f'{vm_name}')
-                for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                    for item in vhs.findall('ovf:Item', namespaces=namespaces):
-                        for resource in item.findall('rasd:Description', namespaces=namespaces):
-                            if resource.text.upper() == 'HARD DISK':
-                                hard_disk_name = (item.findall(
-                                    'rasd:ElementName', namespaces=namespaces))[0].text
-                                hard_disk_file = (item.findall(
-                                    'rasd:HostResource', namespaces=namespaces))[0].text[10:]
-                                logging.debug(
-                                    f"\t{hard_disk_name} => {hard_disk_file}")
-                                disks[disks_by_vmdisk[hard_disk_file].file_ref].vm_name = vm_name
-                                disks[disks_by_vmdisk[hard_disk_file].file_ref].vm_disk_id = \
-                                    hard_disk_name
-        # print an intermediate disk map
-        for key in disks.keys():
-            disk_obj = disks[key]
+
+def get_disk_map_from_envelope(envelope):
+    """
+    the mapping of get_disk_map_from_ovf for a parsed descriptor (e.g. one fetched from VCD)
+    :param envelope: OvfEnvelope
+    :return: dict of "vm_name:disk_id" => file name
+    """
+    # Read the disks from the References section
+    disks = {}
+    for f in envelope.disk_files():
+        new_disk = OvfDisk()
+        new_disk.file_ref = f.file_id
+        new_disk.file_name = f.href
+        disks[f.file_id] = new_disk
+
+    logging.debug(
+        '*** VMDK file IDs ("file-") and Local File Names from References Section')
+    for disk_obj in disks.values():
+        logging.debug(f'{disk_obj.file_name} => {disk_obj.file_ref}')
+
+    # a table of OvfDisks, indexed by a different key to facilitate lookups in the next section
+    disks_by_vmdisk = {}
+    for d in envelope.disks.values():
+        try:
+            disks[d.file_ref].disk_id = d.disk_id
+            disks_by_vmdisk[d.disk_id] = disks[d.file_ref]
+        except KeyError as e:
+            logging.error(
+                f'BAD OVF? This should not be happening: {e}')
+
+    logging.debug('*** Disk ID ("vmdisk-") from DiskSection')
+    for disk_obj in disks.values():
+        logging.debug(f'{disk_obj.file_name} => {disk_obj.disk_id}')
+
+    for vs in envelope.virtual_systems:
+        logging.debug(f'{vs.vm_name}')
+        for hard_disk in vs.hard_disks:
+            hard_disk_file = hard_disk.host_resource[10:]
             logging.debug(
-                f'{disk_obj.file_name} => {disk_obj.vm_name} : {disk_obj.vm_disk_id}')
+                f"\t{hard_disk.element_name} => {hard_disk_file}")
+            disk_obj = disks_by_vmdisk[hard_disk_file]
+            disk_obj.vm_name = vs.vm_name
+            disk_obj.vm_disk_id = hard_disk.element_name
+    # print an intermediate disk map
+    for disk_obj in disks.values():
+        logging.debug(
+            f'{disk_obj.file_name} => {disk_obj.vm_name} : {disk_obj.vm_disk_id}')
 
-        # Create a map that uses "vm_name:disk_id" as the key and the filename as the value
-        vm_hd_file_map = {}
-        for key in disks.keys():
-            disk_obj = disks[key]
-            new_key = f"{disk_obj.vm_name}:{disk_obj.vm_disk_id}"
-            vm_hd_file_map[new_key] = disk_obj.file_name
-        return vm_hd_file_map
+    # Create a map that uses "vm_name:disk_id" as the key and the filename as the value
+    vm_hd_file_map = {}
+    for disk_obj in disks.values():
+        new_key = f"{disk_obj.vm_name}:{disk_obj.vm_disk_id}"
+        vm_hd_file_map[new_key] = disk_obj.file_name
+    return vm_hd_file_map
+
+
+def clone_file(source_file, target_file, allow_hardlink=True):
+    """
+    make target_file a copy of source_file as cheaply as the filesystem allows: a reflink (shares extents until
+    either side is written), else a hard link, else a real copy. A hard link is the same inode, so only use it
+    for files that are replaced (written elsewhere and renamed over) rather than rewritten in place.
+    :param source_file: existing file
+    :param target_file: new file (must not exist)
+    :param allow_hardlink: fall back to a copy instead of a hard link
+    :return: CLONE_REFLINK, CLONE_HARDLINK or CLONE_COPY
+    """
+    source_fd = os.open(source_file, os.O_RDONLY)
+    try:
+        target_fd = os.open(target_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(target_fd, FICLONE, source_fd)
+            cloned = True
+        except OSError:
+            # EOPNOTSUPP/ENOTTY (no reflink support), EXDEV (another filesystem), EINVAL
+            cloned = False
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    if cloned:
+        shutil.copystat(source_file, target_file)
+        return CLONE_REFLINK
+    os.unlink(target_file)
+    if allow_hardlink:
+        try:
+            os.link(source_file, target_file)
+            return CLONE_HARDLINK
+        except OSError:
+            pass
+    shutil.copy2(source_file, target_file)
+    return CLONE_COPY
 
 
 def remap_ovf_for_rsync(source_file,
                         target_file,
-                        lib_dir,
-                        seed_dir):
+                        lib_dir=None,
+                        seed_dir=None,
+                        allow_hardlink=True):
     """
-    Read target OVF to obtain file names and disk-to-VM mappings, read source OVF for the same and map files on disk
-    from the original to the matching target names to facilitate efficient delta rsyncing
+    Read target OVF to obtain file names and disk-to-VM mappings, read source OVF for the same and clone the files
+    on disk from the original to the matching target names (reflink, else hard link, else copy) so that a delta
+    transfer only has to fetch what changed. The old template is left as it is, and stays usable.
     :param source_file: OVF describing existing/old file mappings (full path)
     :param target_file: OVF describing target/new file mappings (full path)
-    :param lib_dir: the path containing the existing OVF library
-    :param seed_dir: the temporary path used for remapping
-    :return: ??
+    :param lib_dir: the directory to create the new files in (default: the target OVF's directory)
+    :param seed_dir: the directory holding the old files (default: the source OVF's directory)
+    :param allow_hardlink: fall back to hard links where there are no reflinks -- only when everything that writes
+        the new files afterwards replaces them rather than rewriting them in place (not lftp mirror)
+    :return: dict of new file name => (old file name, clone method)
     """
-
-    # TODO - Set the stage:
-    #  Old OVF is in full_path_lib/TEMPLATE/TEMPLATE.OVF
-    #  New OVF is in full_path_seed/TEMPLATE2/TEMPLATE2.OVF
-    #  The process involves renaming/moving the LIB to the SEED while renaming files
-    #  DROPPING the RENAMED_INVALID flag so that the rsync process can be run (not deleting any files from SEED)
-    #  REMOVING the full_path_lib/TEMPLATE directory upon successful move of SEED files
-    #  Once rsync is done (not part of this function), the RENAMED_INVALID flag is removed
-
+    lib_dir = lib_dir or os.path.dirname(target_file)
+    seed_dir = seed_dir or os.path.dirname(source_file)
     print('=============  READING OVFs ==============')
     old_vm_disk_file_map = get_disk_map_from_ovf(source_file)
     new_vm_disk_file_map = get_disk_map_from_ovf(target_file)
     print('=============  REMAPPING ==============')
-    # compare the maps and build a "work list: rename file X to file Y"
-    t = PrettyTable(['VM', 'Disk', 'Old File Name', 'New File Name'])
-    old_file_name = ''
-    new_file_name = ''
-    for vm_disk in old_vm_disk_file_map.keys():
+    # compare the maps and build a "work list: clone file X as file Y"
+    t = PrettyTable(['VM', 'Disk', 'Old File Name', 'New File Name', 'Clone'])
+    clones = {}
+    for vm_disk, old_file_name in old_vm_disk_file_map.items():
+        new_file_name = new_vm_disk_file_map.get(vm_disk)
+        if new_file_name is None:
+            logging.info(f'*** {vm_disk} in OLD {old_file_name} is not present in NEW')
+            continue
+        (vm, disk) = vm_disk.split(':')
+        new_file = os.path.join(lib_dir, new_file_name)
+        if os.path.exists(new_file):
+            t.add_row([vm, disk, old_file_name, new_file_name, 'exists'])
+            continue
         try:
-            old_file_name = old_vm_disk_file_map[vm_disk]
-            new_file_name = new_vm_disk_file_map[vm_disk]
-            (vm, disk) = vm_disk.split(':')
-            table_line = [vm, disk, old_file_name, new_file_name]
-            t.add_row(table_line)
-            # TODO: I think this works (rename during move?)
-            shutil.move(os.path.join(seed_dir, old_file_name),
-                        os.path.join(lib_dir, new_file_name))
-        except KeyError:
-            logging.error(
-                f'*** {vm_disk} in OLD {old_file_name} is not present in NEW')
-            # TODO: remove the excess file?
-        except OSError:
-            logging.error(
-                f'error renaming {old_file_name} to {new_file_name} in {lib_dir}')
+            method = clone_file(os.path.join(seed_dir, old_file_name), new_file, allow_hardlink=allow_hardlink)
+        except OSError as e:
+            logging.error(f'error cloning {old_file_name} to {new_file_name} in {lib_dir}: {e}')
+            continue
+        clones[new_file_name] = (old_file_name, method)
+        t.add_row([vm, disk, old_file_name, new_file_name, method])
     print(t)
+    return clones
 
 
 def build_extra_config_item(required: str, key: str, value: str):
-    extra = ET.Element('vmw:ExtraConfig')
+    # qualified names so a cached OvfEnvelope finds the new items, serialized with the registered prefixes
+    extra = ET.Element(f'{{{VMW_NS}}}ExtraConfig')
     # this controls the newline and spacing after the element... it is suboptimal
     extra.tail = '\n                '
-    extra.set('ovf:required', required)
-    extra.set('vmw:key', key)
-    extra.set('vmw:value', value)
+    extra.set(f'{{{OVF_NS}}}required', required)
+    extra.set(f'{{{VMW_NS}}}key', key)
+    extra.set(f'{{{VMW_NS}}}value', value)
     return extra
 
 
@@ -506,49 +1388,13 @@ def bubble_the_ovf(rtc_start_time: int, ovf_file: str, backup_file=None):
     :param ovf_file: full path to OVF file
     :param backup_file: full path to backup file (default replaces ".ovf" with ".ovf.backup")
     :param rtc_start_time: epoch time for Time Bubble start
-    :return:
+    :return: ScrubReport
     """
-    if backup_file is None:
-        backup_file_path = ovf_file.replace('.ovf', '.ovf.backup')
-    else:
-        backup_file_path = backup_file
-
-    namespaces = register_all_namespaces(ovf_file)
-    tree = ET.parse(ovf_file)
-    root = tree.getroot()
-
-    # create the backup
-    tree.write(backup_file_path, encoding='utf-8',
-               xml_declaration=True, method='xml')
-
-    # Time Bubble
     print(
         f'\n=== Time Bubble: {rtc_start_time} => {ctime(rtc_start_time)} ===')
-    found_existing_rtc = False
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name}')
-            for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                for item in vhs.findall('vmw:ExtraConfig', namespaces=namespaces):
-                    if item.get('{http://www.vmware.com/schema/ovf}key') == 'rtc.startTime':
-                        found_existing_rtc = True
-                        epoch = item.get(
-                            '{http://www.vmware.com/schema/ovf}value')
-                        print(
-                            f'Found existing bubble config: {epoch} => Date: {ctime(int(epoch))}')
-                # add the bubble properties
-                if not found_existing_rtc:
-                    vhs.append(build_extra_config_item(
-                        'true', 'time.synchronize.tools.enable', '0'))
-                    vhs.append(build_extra_config_item(
-                        'true', 'time.synchronize.tools.startup', '0'))
-                    vhs.append(build_extra_config_item(
-                        'true', 'rtc.startTime', str(rtc_start_time)))
-                # TODO: why do these append without a newline? Does it matter aside from aesthetics?
-                # TODO: future - if rtc_start_time is 0, remove the bubble?
-    tree.write(ovf_file, encoding='utf-8', xml_declaration=True, method='xml')
+    # TODO: why do these append without a newline? Does it matter aside from aesthetics?
+    report, data = _rewrite_the_ovf(ovf_file, [TimeBubbleRule(rtc_start_time)], backup_file)
+    return report
 
 
 def unbubble_the_ovf(ovf_file: str, backup_file=None):
@@ -556,38 +1402,38 @@ def unbubble_the_ovf(ovf_file: str, backup_file=None):
     undo a "time bubble"
     :param ovf_file: full path to OVF file
     :param backup_file: full path to backup file (default replaces ".ovf" with ".ovf.backup")
-    :return:
+    :return: ScrubReport
     """
-    if backup_file is None:
-        backup_file_path = ovf_file.replace('.ovf', '.ovf.backup')
-    else:
-        backup_file_path = backup_file
-
-    namespaces = register_all_namespaces(ovf_file)
-    tree = ET.parse(ovf_file)
-    root = tree.getroot()
+    report, data = _rewrite_the_ovf(ovf_file, [UnbubbleRule()], backup_file)
+    return report
 
-    # create the backup
-    tree.write(backup_file_path, encoding='utf-8',
-               xml_declaration=True, method='xml')
 
-    # UNDO a Time Bubble
-    bubble_keys = ('rtc.startTime', 'time.synchronize.tools.enable',
-                   'time.synchronize.tools.startup')
-    for vsc in root.findall('ovf:VirtualSystemCollection', namespaces=namespaces):
-        for vs in vsc.findall('ovf:VirtualSystem', namespaces=namespaces):
-            vm_name = vs.attrib.get(
-                '{http://schemas.dmtf.org/ovf/envelope/1}id')
-            print(f'{vm_name}')
-            for vhs in vs.findall('ovf:VirtualHardwareSection', namespaces=namespaces):
-                for item in vhs.findall('vmw:ExtraConfig', namespaces=namespaces):
-                    item_key = item.get(
-                        '{http://www.vmware.com/schema/ovf}key')
-                    if item_key in bubble_keys:
-                        if item_key == 'rtc.startTime':
-                            epoch = item.get(
-                                '{http://www.vmware.com/schema/ovf}value')
-                            print(
-                                f'Scrubbing existing bubble config: {epoch} => Date: {ctime(int(epoch))}')
-                        vhs.remove(item)
-    tree.write(ovf_file, encoding='utf-8', xml_declaration=True, method='xml')
+def prep_the_ovf(ovf_file, scrub=True, rtc_start_time=None, backup_file=None, manifest_file=None,
+                 report_file=None, verbose=True, digest_cache=None):
+    """
+    scrub, time bubble and manifest update in one go: one parse, one write and one hash of the OVF
+    :param ovf_file: full path to OVF file
+    :param scrub: apply default_scrub_rules()
+    :param rtc_start_time: epoch time for a Time Bubble; 0 removes an existing bubble, None leaves it alone
+    :param backup_file: full path to backup file (default replaces ".ovf" with ".ovf.backup")
+    :param manifest_file: full path to the MF (default replaces ".ovf" with ".mf")
+    :param report_file: write the JSON change report here as well
+    :param verbose: print each change as it is made
+    :param digest_cache: DigestCache to record the new OVF digest in
+    :return: dict - the change report
+    """
+    rules = default_scrub_rules() if scrub else []
+    if rtc_start_time is not None:
+        if rtc_start_time > 0:
+            rules.append(TimeBubbleRule(rtc_start_time))
+        else:
+            rules.append(UnbubbleRule())
+    report, data = _rewrite_the_ovf(ovf_file, rules, backup_file, verbose=verbose)
+    new_hash = sha256(data).hexdigest()
+    update_the_manifest(ovf_file, manifest_file=manifest_file, new_hash=new_hash, digest_cache=digest_cache)
+    result = report.to_dict()
+    result['sha256'] = new_hash
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(result, f, indent=2)
+    return result
@@ -0,0 +1,479 @@
+import math
+import os
+import json
+import struct
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# VMware Virtual Disk Format 5.0: hosted sparse extents and the streamOptimized variant used by OVF exports
+SECTOR_SIZE = 512
+SPARSE_MAGIC = b'KDMV'
+GD_AT_END = 0xffffffffffffffff
+FLAG_VALID_NEWLINE_TEST = 1 << 0
+FLAG_COMPRESSED_GRAINS = 1 << 16
+FLAG_MARKERS = 1 << 17
+COMPRESSION_DEFLATE = 1
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+# magic, version, flags, capacity, grainSize, descriptorOffset, descriptorSize, numGTEsPerGT, rgdOffset,
+# gdOffset, overHead, uncleanShutdown, singleEndLineChar, nonEndLineChar, doubleEndLineChar1/2, compressAlgorithm
+HEADER_FORMAT = struct.Struct('<4sIIQQQQIQQQBccccH')
+GRAIN_MARKER_FORMAT = struct.Struct('<QI')
+METADATA_MARKER_FORMAT = struct.Struct('<QII')
+DEFAULT_SAMPLE_GRAINS = 32
+
+
+class SparseExtentHeader:
+    """
+    the 512-byte header at the start of a hosted sparse extent (also repeated as the streamOptimized footer)
+    """
+    __slots__ = ('magic', 'version', 'flags', 'capacity', 'grain_size', 'descriptor_offset',
+                 'descriptor_size', 'num_gtes_per_gt', 'rgd_offset', 'gd_offset', 'overhead',
+                 'unclean_shutdown', 'compress_algorithm', 'newline_chars')
+
+    @classmethod
+    def parse(cls, sector):
+        """
+        :param sector: at least 512 bytes
+        :return: SparseExtentHeader (check .magic before trusting the rest)
+        """
+        fields = HEADER_FORMAT.unpack_from(sector)
+        header = cls()
+        (header.magic, header.version, header.flags, header.capacity, header.grain_size,
+         header.descriptor_offset, header.descriptor_size, header.num_gtes_per_gt, header.rgd_offset,
+         header.gd_offset, header.overhead, header.unclean_shutdown) = fields[:12]
+        header.newline_chars = b''.join(fields[12:16])
+        header.compress_algorithm = fields[16]
+        return header
+
+    def pack(self):
+        """
+        :return: the 512-byte on-disk form
+        """
+        data = HEADER_FORMAT.pack(self.magic, self.version, self.flags, self.capacity, self.grain_size,
+                                  self.descriptor_offset, self.descriptor_size, self.num_gtes_per_gt,
+                                  self.rgd_offset, self.gd_offset, self.overhead, self.unclean_shutdown,
+                                  *[self.newline_chars[i:i + 1] for i in range(4)], self.compress_algorithm)
+        return data.ljust(SECTOR_SIZE, b'\0')
+
+    @property
+    def stream_optimized(self):
+        return bool(self.flags & FLAG_MARKERS) and bool(self.flags & FLAG_COMPRESSED_GRAINS)
+
+    @property
+    def grain_bytes(self):
+        return self.grain_size * SECTOR_SIZE
+
+    @property
+    def gt_count(self):
+        return math.ceil(self.capacity / (self.grain_size * self.num_gtes_per_gt))
+
+    def to_dict(self):
+        return {'version': self.version, 'flags': self.flags, 'capacity_sectors': self.capacity,
+                'grain_size_sectors': self.grain_size, 'num_gtes_per_gt': self.num_gtes_per_gt,
+                'gd_offset': self.gd_offset, 'overhead_sectors': self.overhead,
+                'compress_algorithm': self.compress_algorithm}
+
+
+class VmdkInspection:
+    """
+    result of inspect_vmdk()
+    """
+    __slots__ = ('path', 'file_size', 'kind', 'header', 'footer', 'descriptor', 'grain_directory',
+                 'grains_checked', 'problems')
+
+    def __init__(self, path):
+        self.path = path
+        self.file_size = 0
+        self.kind = 'unknown'
+        self.header = None
+        self.footer = None
+        self.descriptor = ''
+        self.grain_directory = []
+        self.grains_checked = 0
+        self.problems = []
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def to_dict(self):
+        return {'path': self.path, 'ok': self.ok, 'kind': self.kind, 'file_size': self.file_size,
+                'header': self.header.to_dict() if self.header else None,
+                'gd_offset': self.footer.gd_offset if self.footer else None,
+                'grains_checked': self.grains_checked, 'problems': self.problems}
+
+
+def _read_at(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+def _read_metadata_marker(f, sector):
+    """
+    :return: (num_sectors, marker_type) of the metadata marker at sector, or None if it is not a metadata marker
+    """
+    data = _read_at(f, sector * SECTOR_SIZE, METADATA_MARKER_FORMAT.size)
+    if len(data) < METADATA_MARKER_FORMAT.size:
+        return None
+    num_sectors, size, marker_type = METADATA_MARKER_FORMAT.unpack(data)
+    if size != 0:
+        return None
+    return num_sectors, marker_type
+
+
+def read_grain_table(f, header, gt_sector):
+    """
+    :param f: open binary file
+    :param header: SparseExtentHeader
+    :param gt_sector: sector offset of the grain table (the GD entry)
+    :return: list of grain sector offsets (0 = unallocated)
+    """
+    data = _read_at(f, gt_sector * SECTOR_SIZE, header.num_gtes_per_gt * 4)
+    return list(struct.unpack(f'<{len(data) // 4}I', data[:len(data) // 4 * 4]))
+
+
+def read_grain_directory(f, header, gd_sector):
+    """
+    :return: list of grain table sector offsets (0 = no grain table)
+    """
+    data = _read_at(f, gd_sector * SECTOR_SIZE, header.gt_count * 4)
+    return list(struct.unpack(f'<{len(data) // 4}I', data[:len(data) // 4 * 4]))
+
+
+def read_grain(f, header, grain_sector):
+    """
+    read a streamOptimized grain: marker (LBA + compressed size) followed by deflated data
+    :return: (lba, compressed bytes)
+    """
+    marker = _read_at(f, grain_sector * SECTOR_SIZE, GRAIN_MARKER_FORMAT.size)
+    if len(marker) < GRAIN_MARKER_FORMAT.size:
+        raise ValueError(f'grain marker at sector {grain_sector} is past the end of the file')
+    lba, size = GRAIN_MARKER_FORMAT.unpack(marker)
+    return lba, f.read(size)
+
+
+def _sample_indexes(count, samples):
+    if count <= samples:
+        return list(range(count))
+    step = count / samples
+    # evenly spread, always including the last one (where truncation shows up first)
+    return sorted({int(i * step) for i in range(samples)} | {count - 1})
+
+
+def _check_stream_optimized(f, inspection, sample_grains):
+    header = inspection.header
+    size = inspection.file_size
+    problems = inspection.problems
+    if size % SECTOR_SIZE:
+        problems.append('file size is not a whole number of sectors (truncated?)')
+        return
+    total_sectors = size // SECTOR_SIZE
+    if total_sectors < 4:
+        problems.append('file too small for header, footer and end-of-stream marker')
+        return
+    # ... grains, GTs, GD marker + GD, footer marker, footer, end-of-stream marker
+    if _read_at(f, size - SECTOR_SIZE, SECTOR_SIZE) != bytes(SECTOR_SIZE):
+        problems.append('missing end-of-stream marker')
+    footer_marker = _read_metadata_marker(f, total_sectors - 3)
+    if footer_marker is None or footer_marker[1] != MARKER_FOOTER:
+        problems.append('missing footer marker')
+    footer = SparseExtentHeader.parse(_read_at(f, size - 2 * SECTOR_SIZE, SECTOR_SIZE))
+    if footer.magic != SPARSE_MAGIC:
+        problems.append('missing footer (truncated or zeroed tail?)')
+        return
+    inspection.footer = footer
+    if footer.capacity != header.capacity or footer.grain_size != header.grain_size:
+        problems.append('footer does not match header (capacity/grain size)')
+        return
+    gd_sector = footer.gd_offset
+    if gd_sector == GD_AT_END or gd_sector == 0 or gd_sector >= total_sectors - 3:
+        problems.append(f'footer grain directory offset {gd_sector} is outside the file')
+        return
+    gd_marker = _read_metadata_marker(f, gd_sector - 1)
+    if gd_marker is None or gd_marker[1] != MARKER_GD:
+        problems.append(f'no grain directory marker before sector {gd_sector}')
+        return
+    gd = read_grain_directory(f, footer, gd_sector)
+    inspection.grain_directory = gd
+    if len(gd) != footer.gt_count:
+        problems.append(f'grain directory has {len(gd)} of {footer.gt_count} entries')
+        return
+    allocated_gts = [(i, entry) for i, entry in enumerate(gd) if entry]
+    for gt_index, gt_sector in allocated_gts:
+        if gt_sector >= gd_sector:
+            problems.append(f'grain table {gt_index} at sector {gt_sector} is past the grain directory')
+            return
+
+    # sample grain tables and, in each one, a grain; check markers, ordering and that the grain inflates
+    samples = _sample_indexes(len(allocated_gts), sample_grains)
+    for sample in samples:
+        gt_index, gt_sector = allocated_gts[sample]
+        gt_marker = _read_metadata_marker(f, gt_sector - 1)
+        if gt_marker is None or gt_marker[1] != MARKER_GT:
+            problems.append(f'no grain table marker before sector {gt_sector}')
+            return
+        gt = read_grain_table(f, footer, gt_sector)
+        allocated = [(j, entry) for j, entry in enumerate(gt) if entry]
+        if not allocated:
+            problems.append(f'grain table {gt_index} is allocated but empty')
+            continue
+        j, grain_sector = allocated[len(allocated) // 2] if sample != samples[-1] else allocated[-1]
+        if grain_sector >= gt_sector:
+            problems.append(f'grain at sector {grain_sector} is past its grain table')
+            continue
+        expected_lba = (gt_index * footer.num_gtes_per_gt + j) * footer.grain_size
+        try:
+            lba, compressed = read_grain(f, footer, grain_sector)
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        if lba != expected_lba:
+            problems.append(f'grain at sector {grain_sector} has LBA {lba}, expected {expected_lba} '
+                            f'(sparse hole or corrupt grain)')
+            continue
+        try:
+            data = zlib.decompress(compressed)
+        except zlib.error as e:
+            problems.append(f'grain at LBA {lba} does not inflate: {e}')
+            continue
+        if len(data) > footer.grain_bytes:
+            problems.append(f'grain at LBA {lba} inflates to {len(data)} bytes')
+        inspection.grains_checked += 1
+
+
+def _check_sparse(f, inspection, sample_grains):
+    header = inspection.header
+    total_sectors = inspection.file_size // SECTOR_SIZE
+    if header.gd_offset == 0 or header.gd_offset >= total_sectors:
+        inspection.problems.append(f'grain directory offset {header.gd_offset} is outside the file')
+        return
+    gd = read_grain_directory(f, header, header.gd_offset)
+    inspection.grain_directory = gd
+    gt_sectors = [entry for entry in gd if entry]
+    for gt_sector in gt_sectors:
+        if gt_sector >= total_sectors:
+            inspection.problems.append(f'grain table at sector {gt_sector} is outside the file (truncated?)')
+            return
+    for sample in _sample_indexes(len(gt_sectors), sample_grains):
+        gt = read_grain_table(f, header, gt_sectors[sample])
+        grains = [entry for entry in gt if entry]
+        if grains and max(grains) + header.grain_size > total_sectors:
+            inspection.problems.append(f'grain at sector {max(grains)} is outside the file (truncated?)')
+            return
+        inspection.grains_checked += len(grains)
+
+
+def inspect_vmdk(vmdk_file, sample_grains=DEFAULT_SAMPLE_GRAINS):
+    """
+    Check the structure of a VMDK without reading all of it: sparse header, embedded descriptor, footer and
+    end-of-stream marker, grain directory and a sample of grain tables/grain markers (streamOptimized grains
+    are also inflated). Catches truncated files, zeroed tails and sparse holes left by aborted transfers.
+    :param vmdk_file: full path to the VMDK
+    :param sample_grains: number of grain tables to sample
+    :return: VmdkInspection
+    """
+    inspection = VmdkInspection(vmdk_file)
+    try:
+        inspection.file_size = os.path.getsize(vmdk_file)
+        with open(vmdk_file, 'rb') as f:
+            first_sector = f.read(SECTOR_SIZE)
+            if first_sector.startswith(b'# Disk DescriptorFile'):
+                # a descriptor for flat/split extents: nothing more to check here
+                inspection.kind = 'descriptor'
+                return inspection
+            if len(first_sector) < SECTOR_SIZE or first_sector[:4] != SPARSE_MAGIC:
+                inspection.problems.append('missing sparse extent header magic')
+                return inspection
+            header = SparseExtentHeader.parse(first_sector)
+            inspection.header = header
+            if header.grain_size == 0 or header.num_gtes_per_gt == 0 or header.capacity == 0:
+                inspection.problems.append('sparse header has zero capacity, grain size or GT size')
+                return inspection
+            if header.descriptor_offset and header.descriptor_size:
+                raw = _read_at(f, header.descriptor_offset * SECTOR_SIZE, header.descriptor_size * SECTOR_SIZE)
+                inspection.descriptor = raw.split(b'\0', 1)[0].decode('utf-8', errors='replace')
+            if header.stream_optimized:
+                inspection.kind = 'streamOptimized'
+                if header.compress_algorithm != COMPRESSION_DEFLATE:
+                    inspection.problems.append(f'unsupported compression algorithm {header.compress_algorithm}')
+                    return inspection
+                _check_stream_optimized(f, inspection, sample_grains)
+            else:
+                inspection.kind = 'monolithicSparse'
+                _check_sparse(f, inspection, sample_grains)
+    except OSError as e:
+        inspection.problems.append(f'unable to read: {e}')
+    return inspection
+
+
+# grain signatures: one record per allocated grain of a streamOptimized VMDK
+# lba, grain sector, compressed size, sha256 of the deflated bytes and of the inflated grain (16 bytes each)
+GRAIN_SIGNATURE_FORMAT = struct.Struct('<QQI16s16s')
+GRAIN_SIGNATURE_VERSION = 1
+GRAIN_SIGNATURE_SUFFIX = '.grainsig'
+GRAIN_HASH_BATCH = 256
+
+
+class GrainRecord:
+    """
+    one grain of a streamOptimized VMDK, as listed in a GrainSignature
+    """
+    __slots__ = ('lba', 'sector', 'compressed_size', 'compressed_hash', 'data_hash')
+
+    def __init__(self, lba, sector, compressed_size, compressed_hash, data_hash):
+        self.lba = lba
+        self.sector = sector
+        self.compressed_size = compressed_size
+        self.compressed_hash = compressed_hash
+        self.data_hash = data_hash
+
+    @property
+    def offset(self):
+        return self.sector * SECTOR_SIZE
+
+    @property
+    def length(self):
+        """
+        bytes taken by the grain marker, the deflated data and the padding to the next sector
+        """
+        size = GRAIN_MARKER_FORMAT.size + self.compressed_size
+        return size + (-size % SECTOR_SIZE)
+
+    def pack(self):
+        return GRAIN_SIGNATURE_FORMAT.pack(self.lba, self.sector, self.compressed_size, self.compressed_hash,
+                                           self.data_hash)
+
+
+class GrainSignature:
+    """
+    per-grain hashes of a streamOptimized VMDK (what a delta transfer compares)
+    """
+    __slots__ = ('file_size', 'mtime', 'capacity', 'grain_size', 'grains')
+
+    def __init__(self, file_size, mtime, capacity, grain_size, grains):
+        self.file_size = file_size
+        self.mtime = mtime
+        self.capacity = capacity
+        self.grain_size = grain_size
+        # GrainRecord list, in file order
+        self.grains = grains
+
+    def to_bytes(self):
+        header = json.dumps({'version': GRAIN_SIGNATURE_VERSION, 'file_size': self.file_size, 'mtime': self.mtime,
+                             'capacity': self.capacity, 'grain_size': self.grain_size,
+                             'grains': len(self.grains)}).encode() + b'\n'
+        return header + b''.join(grain.pack() for grain in self.grains)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        :raise ValueError: not a grain signature (or another version)
+        """
+        line_end = data.find(b'\n')
+        if line_end < 0:
+            raise ValueError('not a grain signature')
+        header = json.loads(data[:line_end])
+        if header.get('version') != GRAIN_SIGNATURE_VERSION:
+            raise ValueError(f"unsupported grain signature version {header.get('version')}")
+        body = data[line_end + 1:]
+        if len(body) != header['grains'] * GRAIN_SIGNATURE_FORMAT.size:
+            raise ValueError('truncated grain signature')
+        grains = [GrainRecord(*fields) for fields in GRAIN_SIGNATURE_FORMAT.iter_unpack(body)]
+        return cls(header['file_size'], header['mtime'], header['capacity'], header['grain_size'], grains)
+
+
+def list_stream_optimized_grains(f, footer):
+    """
+    :param f: open binary file
+    :param footer: the footer SparseExtentHeader (it has the grain directory offset)
+    :return: list of (grain sector, lba) for every allocated grain, in file order
+    """
+    grains = []
+    for gt_index, gt_sector in enumerate(read_grain_directory(f, footer, footer.gd_offset)):
+        if not gt_sector:
+            continue
+        for j, grain_sector in enumerate(read_grain_table(f, footer, gt_sector)):
+            if grain_sector:
+                grains.append((grain_sector, (gt_index * footer.num_gtes_per_gt + j) * footer.grain_size))
+    grains.sort()
+    return grains
+
+
+def _hash_grains(batch):
+    result = []
+    for compressed in batch:
+        result.append((hashlib.sha256(compressed).digest()[:16],
+                       hashlib.sha256(zlib.decompress(compressed)).digest()[:16]))
+    return result
+
+
+def compute_grain_signature(vmdk_file, max_workers=None):
+    """
+    read every grain of a streamOptimized VMDK and hash it, deflated and inflated (inflating and hashing run
+    in parallel; both release the GIL)
+    :param vmdk_file: full path to the VMDK
+    :return: GrainSignature
+    :raise ValueError: not a valid streamOptimized VMDK
+    """
+    inspection = inspect_vmdk(vmdk_file, sample_grains=1)
+    if inspection.kind != 'streamOptimized' or not inspection.ok:
+        raise ValueError(f"{vmdk_file}: not a valid streamOptimized VMDK ({'; '.join(inspection.problems)})")
+    footer = inspection.footer
+    st = os.stat(vmdk_file)
+    records = []
+    workers = max_workers or os.cpu_count() or 1
+    with open(vmdk_file, 'rb') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        grains = list_stream_optimized_grains(f, footer)
+        batches = []
+        for start in range(0, len(grains), GRAIN_HASH_BATCH):
+            batch = []
+            for grain_sector, expected_lba in grains[start:start + GRAIN_HASH_BATCH]:
+                lba, compressed = read_grain(f, footer, grain_sector)
+                if lba != expected_lba:
+                    raise ValueError(f'{vmdk_file}: grain at sector {grain_sector} has LBA {lba}, '
+                                     f'expected {expected_lba}')
+                batch.append((GrainRecord(lba, grain_sector, len(compressed), b'', b''), compressed))
+            batches.append(([record for record, _ in batch],
+                            executor.submit(_hash_grains, [compressed for _, compressed in batch])))
+            # keep a bounded number of batches in memory
+            while len(batches) > 2 * workers:
+                records.extend(_finish_batch(*batches.pop(0)))
+        for batch in batches:
+            records.extend(_finish_batch(*batch))
+    return GrainSignature(st.st_size, int(st.st_mtime), footer.capacity, footer.grain_size, records)
+
+
+def _finish_batch(records, future):
+    for record, (compressed_hash, data_hash) in zip(records, future.result()):
+        record.compressed_hash = compressed_hash
+        record.data_hash = data_hash
+    return records
+
+
+def load_grain_signature(vmdk_file, cache_dir=None, max_workers=None):
+    """
+    the grain signature of a VMDK, from <cache_dir>/<name>.grainsig when it is for the same size and mtime
+    :param cache_dir: where signatures are kept (None: always compute)
+    :return: GrainSignature
+    """
+    st = os.stat(vmdk_file)
+    cache_file = os.path.join(cache_dir, os.path.basename(vmdk_file) + GRAIN_SIGNATURE_SUFFIX) if cache_dir else None
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                signature = GrainSignature.from_bytes(f.read())
+            if (signature.file_size, signature.mtime) == (st.st_size, int(st.st_mtime)):
+                return signature
+        except ValueError:
+            pass
+    signature = compute_grain_signature(vmdk_file, max_workers)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as f:
+            f.write(signature.to_bytes())
+        os.replace(cache_file + '.tmp', cache_file)
+    return signature
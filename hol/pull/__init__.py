@@ -0,0 +1,550 @@
+import os
+import json
+import stat
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hol.ovf import BYTES_PER_MB, BYTES_PER_GB
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+# read size per request; SFTP reads are pipelined in windows of this many bytes
+PULL_BLOCK_SIZE = BYTES_PER_MB
+SFTP_REQUEST_SIZE = 32 * 1024
+# files smaller than this are fetched whole by one worker
+MIN_SEGMENT_SIZE = 64 * BYTES_PER_MB
+# partial files and their resume state
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+STATE_SAVE_INTERVAL = 5
+PROGRESS_INTERVAL = 5
+SEGMENT_RETRIES = 5
+
+# progress event types
+EVENT_START = 'start'
+EVENT_FILE_START = 'file_start'
+EVENT_PROGRESS = 'progress'
+EVENT_FILE_DONE = 'file_done'
+EVENT_FILE_SKIPPED = 'file_skipped'
+EVENT_FILE_ERROR = 'file_error'
+EVENT_DONE = 'done'
+
+logging.basicConfig(level=logging.INFO)
+
+
+class PullError(Exception):
+    """
+    a file (or range of it) could not be transferred
+    """
+
+    def __init__(self, message, file_name=None, offset=None):
+        super().__init__(message)
+        self.file_name = file_name
+        self.offset = offset
+
+
+class LocalTransport:
+    """
+    a source directory on a locally mounted filesystem (NFS mount of a peer, another disk, tests)
+    """
+
+    def __init__(self, root='/'):
+        self.root = root
+
+    def list_files(self, path):
+        """
+        :return: dict of relative path => (size, mtime) for every file below path
+        """
+        files = {}
+        for root, dirs, names in os.walk(path):
+            for name in names:
+                st = os.stat(os.path.join(root, name))
+                files[os.path.relpath(os.path.join(root, name), path)] = (st.st_size, int(st.st_mtime))
+        return files
+
+    def read_blocks(self, path, offset, length, block_size=PULL_BLOCK_SIZE):
+        """
+        :return: generator of bytes for [offset, offset + length)
+        """
+        with open(path, 'rb', buffering=0) as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(block_size, length))
+                if not data:
+                    raise PullError(f'{path} ended at {offset}', path, offset)
+                offset += len(data)
+                length -= len(data)
+                yield data
+
+    def stat(self, path):
+        """
+        :return: (size, mtime), or None if path does not exist
+        """
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, int(st.st_mtime)
+
+    def read_text(self, path):
+        """
+        :return: contents of a small file, or None if it does not exist
+        """
+        try:
+            with open(path) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        pass
+
+
+class SftpTransport:
+    """
+    SFTP over key-based SSH (paramiko): the same access lftp used, one SSH connection per transport
+    """
+
+    def __init__(self, host, user, port=22, key_filename=None, timeout=60):
+        if paramiko is None:
+            raise PullError('the sftp transport needs paramiko (pip install paramiko)')
+        self.host = host
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        # same as ssh -o BatchMode=yes: unknown host keys are refused, not accepted silently
+        self.client.set_missing_host_key_policy(paramiko.RejectPolicy())
+        self.client.connect(host, port=port, username=user, key_filename=key_filename, timeout=timeout,
+                            allow_agent=True, look_for_keys=True)
+        self.client.get_transport().set_keepalive(30)
+        self.sftp = self.client.open_sftp()
+
+    def list_files(self, path):
+        files = {}
+        pending = ['']
+        while pending:
+            relative = pending.pop()
+            for attr in self.sftp.listdir_attr(os.path.join(path, relative)):
+                name = os.path.join(relative, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    pending.append(name)
+                elif stat.S_ISREG(attr.st_mode):
+                    files[name] = (attr.st_size, int(attr.st_mtime))
+        return files
+
+    def read_blocks(self, path, offset, length, block_size=PULL_BLOCK_SIZE):
+        with self.sftp.open(path, 'rb') as f:
+            while length > 0:
+                window = min(block_size, length)
+                # readv pipelines the requests instead of one 32 KB round trip at a time
+                requests = [(offset + o, min(SFTP_REQUEST_SIZE, window - o))
+                            for o in range(0, window, SFTP_REQUEST_SIZE)]
+                data = b''.join(f.readv(requests))
+                if len(data) != window:
+                    raise PullError(f'{self.host}:{path} short read at {offset}', path, offset)
+                offset += window
+                length -= window
+                yield data
+
+    def stat(self, path):
+        try:
+            attr = self.sftp.stat(path)
+        except FileNotFoundError:
+            return None
+        return attr.st_size, int(attr.st_mtime)
+
+    def read_text(self, path):
+        try:
+            with self.sftp.open(path, 'r') as f:
+                return f.read().decode()
+        except FileNotFoundError:
+            return None
+
+    def close(self):
+        try:
+            self.sftp.close()
+        finally:
+            self.client.close()
+
+
+class TransportPool:
+    """
+    reusable connections to one source, at most max_size at a time; broken connections are discarded
+    """
+
+    def __init__(self, factory, max_size, name='source'):
+        self.factory = factory
+        self.name = name
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                return self.factory()
+            except Exception:
+                self._slots.release()
+                raise
+
+    def release(self, transport, broken=False):
+        if broken:
+            transport.close()
+        else:
+            self._idle.put(transport)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ProgressReporter:
+    """
+    turns byte counts from many threads into progress events (and a periodic log line)
+    """
+
+    def __init__(self, callback=None, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.total_bytes = 0
+        self.done_bytes = 0
+        self.transferred_bytes = 0
+        self.start_time = time.monotonic()
+        self._last = self.start_time
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        fields['event'] = event
+        fields['time'] = time.time()
+        if self.callback is not None:
+            self.callback(fields)
+
+    def add(self, byte_count):
+        with self._lock:
+            self.done_bytes += byte_count
+            self.transferred_bytes += byte_count
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            done, total, rate = self.done_bytes, self.total_bytes, self.rate()
+        logging.info(f'{done / BYTES_PER_GB:.2f} of {total / BYTES_PER_GB:.2f} GB ({rate / BYTES_PER_MB:.1f} MB/s)')
+        self.emit(EVENT_PROGRESS, bytes=done, total=total, rate=rate)
+
+    def add_resumed(self, byte_count):
+        """
+        bytes already there from an earlier attempt: done, but not transferred (they do not count in the rate)
+        """
+        with self._lock:
+            self.done_bytes += byte_count
+
+    def rate(self):
+        elapsed = time.monotonic() - self.start_time
+        return self.transferred_bytes / elapsed if elapsed > 0 else 0
+
+
+class FileTransfer:
+    """
+    one file being pulled into <target>.part, with its segments and resume state (<target>.part.json)
+    """
+
+    def __init__(self, name, size, mtime, target_path):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.target_path = target_path
+        self.part_path = target_path + PART_SUFFIX
+        self.state_path = target_path + STATE_SUFFIX
+        # [start, end, next] -- bytes [start, next) are on disk
+        self.segments = []
+        self.fd = None
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    def prepare(self, segment_count):
+        """
+        open the partial file, resuming from the saved state if it is for the same source file
+        :return: bytes already on disk
+        """
+        state = None
+        if os.path.exists(self.part_path) and os.path.exists(self.state_path):
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except ValueError:
+                state = None
+            if state is not None and (state['size'], state['mtime']) != (self.size, self.mtime):
+                logging.info(f'{self.name} changed on the source, starting over')
+                state = None
+        os.makedirs(os.path.dirname(self.target_path), exist_ok=True)
+        self.fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | (0 if state else os.O_TRUNC), 0o644)
+        if state:
+            self.segments = [list(segment) for segment in state['segments']]
+        else:
+            os.ftruncate(self.fd, self.size)
+            self.segments = split_range(0, self.size, segment_count)
+            self.save_state(force=True)
+        # anything not covered by a segment is already on disk
+        return self.size - sum(segment[1] - segment[2] for segment in self.segments)
+
+    def write(self, segment, data):
+        """
+        write the next bytes of a segment (clipped to its end, which may have moved if part of it was handed
+        to another worker)
+        :return: number of bytes written
+        """
+        with self._lock:
+            offset = segment[2]
+            data = data[:max(segment[1] - offset, 0)]
+        os.pwrite(self.fd, data, offset)
+        with self._lock:
+            segment[2] += len(data)
+        self.save_state()
+        return len(data)
+
+    def complete(self, segment):
+        """
+        forget a finished segment (what no segment covers is on disk)
+        :return: True if the whole file is on disk
+        """
+        with self._lock:
+            if segment[2] >= segment[1]:
+                self.segments = [s for s in self.segments if s is not segment]
+            return all(s[2] >= s[1] for s in self.segments)
+
+    def save_state(self, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_save < STATE_SAVE_INTERVAL:
+                return
+            self._last_save = now
+            state = {'size': self.size, 'mtime': self.mtime, 'segments': [list(s) for s in self.segments]}
+        # the data has to be on disk before the state says it is
+        os.fsync(self.fd)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def remaining(self):
+        with self._lock:
+            return [segment for segment in self.segments if segment[2] < segment[1]]
+
+    def finish(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.part_path, self.target_path)
+        # like mirror: keep the source mtime so an unchanged file is skipped next time
+        os.utime(self.target_path, (self.mtime, self.mtime))
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def abandon(self):
+        # keep the .part and the state for the next run
+        if self.fd is not None:
+            self.save_state(force=True)
+            os.close(self.fd)
+            self.fd = None
+
+
+def split_range(start, end, count):
+    """
+    :return: list of [start, end, next] segments covering [start, end) in count pieces (fewer for small ranges)
+    """
+    length = end - start
+    if length <= 0:
+        # an empty file: one segment that is already complete
+        return [[start, end, start]]
+    count = max(1, min(count, length // MIN_SEGMENT_SIZE or 1))
+    step = -(-length // count)
+    return [[s, min(s + step, end), s] for s in range(start, end, step)] or [[start, end, start]]
+
+
+class PullResult:
+    """
+    per-file outcome of a pull
+    """
+    __slots__ = ('files', 'transferred_bytes', 'elapsed')
+
+    def __init__(self):
+        # file name => 'done' | 'skipped' | error message
+        self.files = {}
+        self.transferred_bytes = 0
+        self.elapsed = 0
+
+    @property
+    def ok(self):
+        return all(status in ('done', 'skipped') for status in self.files.values())
+
+    def failed(self):
+        return {name: status for name, status in self.files.items() if status not in ('done', 'skipped')}
+
+    def to_dict(self):
+        return {'ok': self.ok, 'files': self.files, 'transferred_bytes': self.transferred_bytes,
+                'elapsed': round(self.elapsed, 1)}
+
+
+class PullEngine:
+    """
+    pull a directory tree from a source: up to parallel_files files at a time, large files in up to
+    parallel_segments ranges read concurrently (the lftp "mirror --parallel --use-pget-n" model), into .part
+    files that resume where they left off
+    """
+
+    def __init__(self, transport_factory, parallel_files=4, parallel_segments=4, progress_callback=None):
+        """
+        :param transport_factory: callable returning a new transport (LocalTransport, SftpTransport, ...)
+        :param parallel_files: files transferred at the same time
+        :param parallel_segments: concurrent ranges per large file
+        :param progress_callback: function(event dict) for structured progress events
+        """
+        self.parallel_files = parallel_files
+        self.parallel_segments = parallel_segments
+        self.pool = TransportPool(transport_factory, parallel_files * parallel_segments)
+        self.progress_callback = progress_callback
+        self.progress = ProgressReporter(progress_callback)
+
+    def list_files(self, source_dir):
+        transport = self.pool.acquire()
+        try:
+            files = transport.list_files(source_dir)
+        except Exception:
+            self.pool.release(transport, broken=True)
+            raise
+        self.pool.release(transport)
+        return files
+
+    def pull(self, source_dir, target_dir, only=None, force=False, delete=False):
+        """
+        :param source_dir: directory on the source
+        :param target_dir: local directory to mirror it into
+        :param only: just these relative file names (e.g. the ones that failed verification)
+        :param force: transfer even files that look complete (same size and mtime)
+        :param delete: remove local files that are not on the source (lftp mirror --delete)
+        :return: PullResult
+        """
+        start = time.monotonic()
+        result = PullResult()
+        self.progress = ProgressReporter(self.progress_callback)
+        files = self.list_files(source_dir)
+        if delete and only is None:
+            remove_extra_files(target_dir, files)
+        if only is not None:
+            files = {name: files[name] for name in only if name in files}
+            for name in only:
+                if name not in files:
+                    result.files[name] = 'not on the source'
+        work = []
+        for name, (size, mtime) in sorted(files.items(), key=lambda item: -item[1][0]):
+            target_path = os.path.join(target_dir, name)
+            if not force and _is_complete(target_path, size, mtime):
+                result.files[name] = 'skipped'
+                self.progress.emit(EVENT_FILE_SKIPPED, file=name, size=size)
+                continue
+            work.append(FileTransfer(name, size, mtime, target_path))
+        self.progress.total_bytes = sum(f.size for f in work)
+        self.progress.emit(EVENT_START, files=len(work), total=self.progress.total_bytes,
+                           skipped=len(files) - len(work))
+        with ThreadPoolExecutor(max_workers=self.parallel_files) as executor:
+            for name, status in zip([f.name for f in work],
+                                    executor.map(lambda f: self._pull_file(source_dir, f), work)):
+                result.files[name] = status
+        result.transferred_bytes = self.progress.transferred_bytes
+        result.elapsed = time.monotonic() - start
+        self.progress.emit(EVENT_DONE, ok=result.ok, bytes=result.transferred_bytes, elapsed=result.elapsed,
+                           failed=result.failed())
+        return result
+
+    def _pull_file(self, source_dir, transfer):
+        try:
+            resumed = transfer.prepare(self.parallel_segments)
+        except (OSError, ValueError) as e:
+            self.progress.emit(EVENT_FILE_ERROR, file=transfer.name, error=str(e))
+            return f'unable to create {transfer.part_path}: {e}'
+        self.progress.add_resumed(resumed)
+        if resumed:
+            logging.info(f'{transfer.name}: resuming with {resumed / BYTES_PER_MB:.0f} MB already here')
+        self.progress.emit(EVENT_FILE_START, file=transfer.name, size=transfer.size, resumed=resumed)
+        source_path = os.path.join(source_dir, transfer.name)
+        remaining = transfer.remaining()
+        try:
+            if len(remaining) > 1:
+                with ThreadPoolExecutor(max_workers=self.parallel_segments) as executor:
+                    for _ in executor.map(lambda segment: self._pull_segment(source_path, transfer, segment),
+                                          remaining):
+                        pass
+            else:
+                for segment in remaining:
+                    self._pull_segment(source_path, transfer, segment)
+        except Exception as e:
+            transfer.abandon()
+            logging.error(str(e))
+            self.progress.emit(EVENT_FILE_ERROR, file=transfer.name, error=str(e),
+                               offset=getattr(e, 'offset', None))
+            return str(e)
+        transfer.finish()
+        self.progress.emit(EVENT_FILE_DONE, file=transfer.name, size=transfer.size)
+        return 'done'
+
+    def _pull_segment(self, source_path, transfer, segment):
+        attempt = 0
+        while segment[2] < segment[1]:
+            transport = self.pool.acquire()
+            try:
+                for data in transport.read_blocks(source_path, segment[2], segment[1] - segment[2]):
+                    self.progress.add(transfer.write(segment, data))
+            except Exception as e:
+                self.pool.release(transport, broken=True)
+                attempt += 1
+                if attempt > SEGMENT_RETRIES:
+                    raise PullError(f'{transfer.name}: giving up at offset {segment[2]}: {e}', transfer.name,
+                                    segment[2])
+                logging.warning(f'{transfer.name}: {e}, reconnecting (attempt {attempt})')
+                time.sleep(min(2 ** attempt, 60))
+                continue
+            self.pool.release(transport)
+
+    def close(self):
+        self.pool.close()
+
+
+def remove_extra_files(target_dir, files):
+    """
+    delete local files that are not in files (leaving partial transfers of files that are)
+    """
+    for root, dirs, names in os.walk(target_dir):
+        for name in names:
+            relative = os.path.relpath(os.path.join(root, name), target_dir)
+            for suffix in (STATE_SUFFIX, PART_SUFFIX):
+                if relative.endswith(suffix):
+                    relative = relative[:-len(suffix)]
+                    break
+            if relative not in files:
+                logging.info(f'removing {relative}: not on the source')
+                os.remove(os.path.join(root, name))
+
+
+def _is_complete(target_path, size, mtime):
+    try:
+        st = os.stat(target_path)
+    except FileNotFoundError:
+        return False
+    return st.st_size == size and int(st.st_mtime) == mtime
+
+
+def sftp_transport_factory(host, user, key_filename=None):
+    """
+    :return: a transport factory for PullEngine
+    """
+    return lambda: SftpTransport(host, user, key_filename=key_filename)
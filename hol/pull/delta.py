@@ -0,0 +1,308 @@
+import os
+import time
+import shlex
+import hashlib
+import logging
+import subprocess
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from hol.ovf import BYTES_PER_MB
+from hol.ovf.vmdk import GrainSignature, GRAIN_MARKER_FORMAT, load_grain_signature
+from hol.pull import TransportPool, ProgressReporter, SftpTransport, PART_SUFFIX, PullError, \
+    sftp_transport_factory
+
+# per-grain signatures are cached under the library root, mirroring the template directories
+GRAIN_SIGNATURE_DIR_NAME = '.grainsigs'
+# largest byte range fetched in one request
+DELTA_RANGE_SIZE = 16 * BYTES_PER_MB
+LOCAL_PIECE_BATCH = 1024
+# zlib levels tried when a grain's content is here but was deflated differently (6 is zlib's default)
+RECOMPRESS_LEVELS = (6, 9, 1, 5, 7, 8, 4, 3, 2)
+
+PIECE_REMOTE = 'remote'
+PIECE_COPY = 'copy'
+PIECE_RECOMPRESS = 'recompress'
+
+logging.basicConfig(level=logging.INFO)
+
+
+def grain_signature_cache_dir(repository, vmdk_file):
+    """
+    :return: where the signature of a VMDK in the library is cached (None for files outside the library)
+    """
+    relative = os.path.relpath(os.path.dirname(os.path.abspath(vmdk_file)), os.path.abspath(repository))
+    if relative.startswith('..'):
+        return None
+    return os.path.join(repository, GRAIN_SIGNATURE_DIR_NAME, relative)
+
+
+class DeltaStats:
+    """
+    what a delta transfer reused and what it had to fetch
+    """
+    __slots__ = ('grains', 'unchanged_grains', 'copied_grains', 'recompressed_grains', 'fetched_grains',
+                 'total_bytes', 'fetched_bytes', 'elapsed')
+
+    def __init__(self):
+        self.grains = 0
+        # grains whose content (inflated) is already in a seed
+        self.unchanged_grains = 0
+        self.copied_grains = 0
+        self.recompressed_grains = 0
+        self.fetched_grains = 0
+        self.total_bytes = 0
+        self.fetched_bytes = 0
+        self.elapsed = 0
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class DeltaPlan:
+    """
+    how to build a file identical to the source's VMDK: a list of pieces, in file order, each either fetched or
+    made here from a seed grain
+    """
+    __slots__ = ('file_size', 'pieces', 'stats')
+
+    def __init__(self, file_size):
+        self.file_size = file_size
+        # (kind, offset, length, grain record, seed path, seed grain record)
+        self.pieces = []
+        self.stats = DeltaStats()
+
+
+def plan_vmdk_delta(signature, seeds):
+    """
+    compare the source's grains with the seeds' (older versions of the disk, or any other local VMDK): a grain
+    whose deflated bytes are here is copied, one whose inflated content is here is deflated again, the rest --
+    and all metadata (header, descriptor, grain tables, directory, footer) -- is fetched
+    :param signature: GrainSignature of the source VMDK
+    :param seeds: list of (local path, GrainSignature)
+    :return: DeltaPlan
+    """
+    by_compressed = {}
+    by_data = {}
+    for seed_path, seed_signature in seeds:
+        for grain in seed_signature.grains:
+            by_compressed.setdefault(grain.compressed_hash, (seed_path, grain))
+            by_data.setdefault(grain.data_hash, (seed_path, grain))
+    plan = DeltaPlan(signature.file_size)
+    stats = plan.stats
+    stats.total_bytes = signature.file_size
+    position = 0
+    for grain in sorted(signature.grains, key=lambda g: g.sector):
+        if grain.offset < position:
+            raise ValueError(f'grain at sector {grain.sector} overlaps the previous one')
+        if grain.offset > position:
+            plan.pieces.append((PIECE_REMOTE, position, grain.offset - position, None, None, None))
+        stats.grains += 1
+        seed = by_compressed.get(grain.compressed_hash)
+        if seed is not None and seed[1].compressed_size == grain.compressed_size:
+            plan.pieces.append((PIECE_COPY, grain.offset, grain.length, grain) + seed)
+            stats.unchanged_grains += 1
+        elif grain.data_hash in by_data:
+            plan.pieces.append((PIECE_RECOMPRESS, grain.offset, grain.length, grain) + by_data[grain.data_hash])
+            stats.unchanged_grains += 1
+        else:
+            plan.pieces.append((PIECE_REMOTE, grain.offset, grain.length, grain, None, None))
+        position = grain.offset + grain.length
+    if position > signature.file_size:
+        raise ValueError('grains extend past the end of the file')
+    if position < signature.file_size:
+        plan.pieces.append((PIECE_REMOTE, position, signature.file_size - position, None, None, None))
+    return plan
+
+
+def coalesce_ranges(ranges, max_length=DELTA_RANGE_SIZE):
+    """
+    :param ranges: (offset, length) pairs
+    :return: sorted (offset, length) with adjacent ranges joined, each at most max_length
+    """
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1][1] += length
+        else:
+            merged.append([offset, length])
+    result = []
+    for offset, length in merged:
+        while length > 0:
+            step = min(length, max_length)
+            result.append((offset, step))
+            offset += step
+            length -= step
+    return result
+
+
+def _grain_bytes(grain, compressed):
+    data = GRAIN_MARKER_FORMAT.pack(grain.lba, len(compressed)) + compressed
+    return data + bytes(grain.length - len(data))
+
+
+def _build_local_piece(piece, seed_fds):
+    """
+    :return: the bytes of a grain made from a seed, or None if it has to be fetched after all
+    """
+    kind, offset, length, grain, seed_path, seed_grain = piece
+    try:
+        compressed = os.pread(seed_fds[seed_path], seed_grain.compressed_size,
+                              seed_grain.offset + GRAIN_MARKER_FORMAT.size)
+    except OSError as e:
+        logging.warning(f'{seed_path}: {e}')
+        return None
+    if hashlib.sha256(compressed).digest()[:16] != seed_grain.compressed_hash:
+        logging.warning(f'{seed_path} changed since its signature was made')
+        return None
+    if kind == PIECE_COPY:
+        return _grain_bytes(grain, compressed)
+    data = zlib.decompress(compressed)
+    for level in RECOMPRESS_LEVELS:
+        candidate = zlib.compress(data, level)
+        if len(candidate) == grain.compressed_size and \
+                hashlib.sha256(candidate).digest()[:16] == grain.compressed_hash:
+            return _grain_bytes(grain, candidate)
+    return None
+
+
+def apply_vmdk_delta(plan, transport_factory, remote_path, target_path, connections=4, progress_callback=None,
+                     max_workers=None):
+    """
+    build target_path (via target_path.part) from the seeds and the source, following the plan
+    :param transport_factory: callable returning a transport to the source (see hol.pull)
+    :param remote_path: the VMDK on the source
+    :param connections: concurrent range requests to the source
+    :return: DeltaStats
+    """
+    start = time.monotonic()
+    stats = plan.stats
+    part_path = target_path + PART_SUFFIX
+    os.makedirs(os.path.dirname(os.path.abspath(target_path)), exist_ok=True)
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, plan.file_size)
+        remote = [(offset, length) for kind, offset, length, grain, seed, seed_grain in plan.pieces
+                  if kind == PIECE_REMOTE]
+        stats.fetched_grains = sum(1 for piece in plan.pieces if piece[0] == PIECE_REMOTE and piece[3])
+        local = [piece for piece in plan.pieces if piece[0] != PIECE_REMOTE]
+        seed_fds = {}
+        try:
+            for piece in local:
+                if piece[4] not in seed_fds:
+                    seed_fds[piece[4]] = os.open(piece[4], os.O_RDONLY)
+            # inflating and deflating release the GIL
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for batch_start in range(0, len(local), LOCAL_PIECE_BATCH):
+                    batch = local[batch_start:batch_start + LOCAL_PIECE_BATCH]
+                    for piece, data in zip(batch, executor.map(lambda p: _build_local_piece(p, seed_fds), batch)):
+                        if data is None:
+                            remote.append((piece[1], piece[2]))
+                            stats.fetched_grains += 1
+                            continue
+                        os.pwrite(fd, data, piece[1])
+                        if piece[0] == PIECE_COPY:
+                            stats.copied_grains += 1
+                        else:
+                            stats.recompressed_grains += 1
+        finally:
+            for seed_fd in seed_fds.values():
+                os.close(seed_fd)
+        ranges = coalesce_ranges(remote)
+        progress = ProgressReporter(progress_callback)
+        progress.total_bytes = sum(length for offset, length in ranges)
+        logging.info(f'{os.path.basename(target_path)}: {stats.copied_grains + stats.recompressed_grains} of '
+                     f'{stats.grains} grain(s) from seeds, fetching {progress.total_bytes / BYTES_PER_MB:.1f} MB '
+                     f'of {plan.file_size / BYTES_PER_MB:.1f} MB')
+        pool = TransportPool(transport_factory, connections)
+
+        def fetch(byte_range):
+            offset, length = byte_range
+            transport = pool.acquire()
+            try:
+                for data in transport.read_blocks(remote_path, offset, length):
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    progress.add(len(data))
+            except Exception:
+                pool.release(transport, broken=True)
+                raise
+            pool.release(transport)
+
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                for _ in executor.map(fetch, ranges):
+                    pass
+        finally:
+            pool.close()
+        stats.fetched_bytes = progress.transferred_bytes
+        os.fsync(fd)
+    except Exception as e:
+        os.close(fd)
+        raise PullError(f'{remote_path}: delta transfer failed: {e}', os.path.basename(remote_path))
+    os.close(fd)
+    os.replace(part_path, target_path)
+    stats.elapsed = round(time.monotonic() - start, 1)
+    return stats
+
+
+def fetch_remote_grain_signature(ssh_user, host, scripts_path, remote_file, remote_repository, transport):
+    """
+    have the source compute (or reuse) the signature of one of its VMDKs with vmdk_delta.py, then read it
+    :return: GrainSignature
+    """
+    command = f"cd {shlex.quote(scripts_path)} && ./vmdk_delta.py signature --file {shlex.quote(remote_file)} " \
+              f"--repository {shlex.quote(remote_repository)}"
+    result = subprocess.run(['ssh', '-o', 'BatchMode=yes', f'{ssh_user}@{host}', command],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise PullError(f'{host}: unable to get the grain signature of {remote_file}: {result.stderr.strip()}')
+    signature_path = result.stdout.strip().splitlines()[-1]
+    st = transport.stat(signature_path)
+    if st is None:
+        raise PullError(f'{host}: {signature_path} is missing')
+    return GrainSignature.from_bytes(b''.join(transport.read_blocks(signature_path, 0, st[0])))
+
+
+def delta_sync_vmdk(signature, seed_files, transport_factory, remote_path, target_path, repository=None,
+                    connections=4, progress_callback=None):
+    """
+    rebuild the source's VMDK from local seeds plus the grains that changed
+    :param signature: GrainSignature of the source VMDK
+    :param seed_files: local VMDKs (earlier versions) to take grains from
+    :param repository: library root, to cache the seeds' signatures
+    :return: DeltaStats
+    """
+    seeds = []
+    for seed_file in seed_files:
+        cache_dir = grain_signature_cache_dir(repository, seed_file) if repository else None
+        try:
+            seeds.append((seed_file, load_grain_signature(seed_file, cache_dir)))
+        except (OSError, ValueError) as e:
+            logging.warning(f'not using {seed_file} as a seed: {e}')
+    plan = plan_vmdk_delta(signature, seeds)
+    stats = apply_vmdk_delta(plan, transport_factory, remote_path, target_path, connections, progress_callback)
+    # same mtime as the source, like a pull: a later pull/mirror sees the file as up to date
+    os.utime(target_path, (signature.mtime, signature.mtime))
+    return stats
+
+
+def delta_sync_from_source(configuration, source_catalog, remote_file, remote_repository, seed_files, target_path,
+                           repository=None, progress_callback=None):
+    """
+    rebuild a VMDK of the source catalog node here from local seeds plus the grains that changed (SFTP, key-based
+    SSH as configured in Infrastructure)
+    :param remote_file: the VMDK on the source
+    :param remote_repository: the library root on the source (where it caches its signatures)
+    :return: DeltaStats
+    """
+    infrastructure = configuration['Infrastructure']
+    ssh_user, ssh_key = infrastructure['ssh_username'], infrastructure.get('ssh_key') or None
+    transport = SftpTransport(source_catalog, ssh_user, key_filename=ssh_key)
+    try:
+        signature = fetch_remote_grain_signature(ssh_user, source_catalog, configuration['Tools']['scripts'],
+                                                 remote_file, remote_repository, transport)
+    finally:
+        transport.close()
+    return delta_sync_vmdk(signature, seed_files, sftp_transport_factory(source_catalog, ssh_user, ssh_key),
+                           remote_file, target_path, repository=repository,
+                           connections=infrastructure['parallel_segments'], progress_callback=progress_callback)
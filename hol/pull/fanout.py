@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import logging
+from hol.pull import PullError, PART_SUFFIX, STATE_SUFFIX, PULL_BLOCK_SIZE
+
+FANOUT_MODES = ('tree', 'chain')
+DEFAULT_FANOUT = 2
+# how often a relaying node looks at its parent's progress, and how long it waits without any
+RELAY_POLL_SECONDS = 2
+RELAY_STALL_SECONDS = 600
+
+logging.basicConfig(level=logging.INFO)
+
+
+class FanoutNode:
+    """
+    one target in a distribution plan
+    """
+    __slots__ = ('name', 'parent', 'depth', 'children')
+
+    def __init__(self, name, parent, depth):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.children = []
+
+    def to_dict(self):
+        return {'name': self.name, 'parent': self.parent, 'depth': self.depth, 'children': self.children}
+
+
+def plan_fanout(origin, targets, mode='tree', fanout=DEFAULT_FANOUT):
+    """
+    arrange targets so that each node pulls from the origin or from a node that already pulls: a tree where
+    every node (the origin too) feeds at most fanout children -- depth log(N) -- or a chain (each node feeds one).
+    Targets are placed in the order given, so list nearby nodes next to each other.
+    :param origin: node that holds the template
+    :param targets: nodes that should get it
+    :param mode: 'tree' or 'chain'
+    :param fanout: children per node (tree)
+    :return: list of FanoutNode, parents before their children
+    """
+    if mode not in FANOUT_MODES:
+        raise ValueError(f'unknown fan-out mode {mode}, expected one of {FANOUT_MODES}')
+    if mode == 'chain':
+        fanout = 1
+    if fanout < 1:
+        raise ValueError('fanout must be at least 1')
+    nodes = {origin: FanoutNode(origin, None, 0)}
+    # breadth first: the next free slot is always on the shallowest node that has one
+    feeders = [origin]
+    plan = []
+    for target in targets:
+        if target in nodes:
+            continue
+        parent = nodes[feeders[0]]
+        node = FanoutNode(target, parent.name, parent.depth + 1)
+        parent.children.append(target)
+        if len(parent.children) >= fanout:
+            feeders.pop(0)
+        nodes[target] = node
+        feeders.append(target)
+        plan.append(node)
+    return plan
+
+
+def plan_depth(target_count, mode='tree', fanout=DEFAULT_FANOUT):
+    """
+    :return: number of hops to the deepest node
+    """
+    if target_count == 0:
+        return 0
+    if mode == 'chain' or fanout == 1:
+        return target_count
+    # a full tree of depth d below the origin holds fanout + fanout^2 + ... + fanout^d nodes
+    depth, capacity = 0, 0
+    while capacity < target_count:
+        depth += 1
+        capacity += fanout ** depth
+    return depth
+
+
+def available_ranges(state, size):
+    """
+    :param state: a .part.json state (segments of [start, end, next])
+    :return: sorted list of (start, end) byte ranges that are on disk
+    """
+    missing = sorted((segment[2], segment[1]) for segment in state['segments'] if segment[2] < segment[1])
+    ranges, position = [], 0
+    for start, end in missing:
+        if start > position:
+            ranges.append((position, start))
+        position = max(position, end)
+    if position < size:
+        ranges.append((position, size))
+    return ranges
+
+
+class RelayTransport:
+    """
+    read a template from a parent node that may still be pulling it: bytes come from the parent's finished file
+    or, while it is in progress, from its .part file as far as its .part.json says they are on disk. The file
+    list (names, sizes, mtimes) comes from the origin, so a parent that has not started yet is waited for.
+    """
+
+    def __init__(self, upstream, source_dir, files, poll_seconds=RELAY_POLL_SECONDS,
+                 stall_seconds=RELAY_STALL_SECONDS):
+        """
+        :param upstream: transport to the parent node
+        :param source_dir: the template directory on the parent
+        :param files: the origin's listing (relative path => (size, mtime))
+        """
+        self.upstream = upstream
+        self.source_dir = source_dir
+        self.files = files
+        self.poll_seconds = poll_seconds
+        self.stall_seconds = stall_seconds
+
+    def list_files(self, path):
+        return dict(self.files)
+
+    def _available(self, path, size, mtime):
+        """
+        :return: True if the parent has the whole file, else the ranges of its .part that are on disk
+        """
+        if self.upstream.stat(path) == (size, mtime):
+            return True
+        text = self.upstream.read_text(path + STATE_SUFFIX)
+        if text is None:
+            return []
+        try:
+            state = json.loads(text)
+        except ValueError:
+            # caught it mid-write; the parent replaces it atomically, but be safe
+            return []
+        # a leftover .part of some other version of the file is no use
+        if (state['size'], state['mtime']) != (size, mtime):
+            return []
+        return available_ranges(state, size)
+
+    def read_blocks(self, path, offset, length, block_size=PULL_BLOCK_SIZE):
+        name = os.path.relpath(path, self.source_dir)
+        size, mtime = self.files[name]
+        end = offset + length
+        last_progress = time.monotonic()
+        while offset < end:
+            available = self._available(path, size, mtime)
+            if available is True:
+                yield from self.upstream.read_blocks(path, offset, end - offset, block_size)
+                return
+            ready = next((min(range_end, end) for range_start, range_end in available
+                          if range_start <= offset < range_end), None)
+            if ready is None:
+                if time.monotonic() - last_progress > self.stall_seconds:
+                    raise PullError(f'{name}: the parent has not received byte {offset} '
+                                    f'in {self.stall_seconds}s', name, offset)
+                time.sleep(self.poll_seconds)
+                continue
+            try:
+                for data in self.upstream.read_blocks(path + PART_SUFFIX, offset, ready - offset, block_size):
+                    offset += len(data)
+                    yield data
+            except FileNotFoundError:
+                # renamed to the final name between the check and the read
+                continue
+            last_progress = time.monotonic()
+
+    def stat(self, path):
+        return self.upstream.stat(path)
+
+    def read_text(self, path):
+        return self.upstream.read_text(path)
+
+    def close(self):
+        self.upstream.close()
+
+
+def relay_transport_factory(upstream_factory, source_dir, files):
+    """
+    :return: a transport factory for PullEngine that relays from a parent node
+    """
+    return lambda: RelayTransport(upstream_factory(), source_dir, files)
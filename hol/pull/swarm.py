@@ -0,0 +1,298 @@
+import os
+import time
+import logging
+import threading
+from hol.ovf import BYTES_PER_MB
+from hol.pull import TransportPool, ProgressReporter, FileTransfer, PullResult, PullError, remove_extra_files, \
+    _is_complete, EVENT_START, EVENT_FILE_START, EVENT_FILE_DONE, EVENT_FILE_SKIPPED, EVENT_FILE_ERROR, EVENT_DONE
+
+# a range should take about this long on the source that fetches it
+TARGET_RANGE_SECONDS = 10
+MIN_RANGE_SIZE = 8 * BYTES_PER_MB
+MAX_RANGE_SIZE = 1024 * BYTES_PER_MB
+INITIAL_RANGE_SIZE = 32 * BYTES_PER_MB
+# weight of the newest range in a source's throughput estimate
+RATE_SMOOTHING = 0.3
+# consecutive failures before a source is dropped from the swarm
+SOURCE_MAX_FAILURES = 3
+
+EVENT_SOURCE_DROPPED = 'source_dropped'
+
+logging.basicConfig(level=logging.INFO)
+
+
+class SwarmSource:
+    """
+    one peer in the swarm: its connections and what it has delivered
+    """
+    __slots__ = ('name', 'pool', 'rate', 'bytes', 'ranges', 'failures', 'dropped')
+
+    def __init__(self, name, transport_factory, connections):
+        self.name = name
+        self.pool = TransportPool(transport_factory, connections, name)
+        # bytes per second per connection (None until the first range completes)
+        self.rate = None
+        self.bytes = 0
+        self.ranges = 0
+        self.failures = 0
+        self.dropped = False
+
+    def range_size(self):
+        if self.rate is None:
+            return INITIAL_RANGE_SIZE
+        size = int(self.rate * TARGET_RANGE_SECONDS)
+        return max(MIN_RANGE_SIZE, min(MAX_RANGE_SIZE, size - size % BYTES_PER_MB))
+
+    def record(self, byte_count, seconds):
+        self.bytes += byte_count
+        self.ranges += 1
+        self.failures = 0
+        if seconds > 0 and byte_count >= MIN_RANGE_SIZE:
+            rate = byte_count / seconds
+            self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+
+    def to_dict(self):
+        return {'bytes': self.bytes, 'ranges': self.ranges, 'dropped': self.dropped,
+                'rate': round(self.rate or 0)}
+
+
+class SwarmEngine:
+    """
+    pull a directory tree from several sources holding the same content at once: every source works from one
+    shared queue of byte ranges, each range sized to what that source has been delivering (about
+    TARGET_RANGE_SECONDS worth), so a fast peer takes more of the file than a slow one. When nothing is left to
+    hand out, idle connections take over the back half of ranges still in flight, so the last bytes do not wait
+    on the slowest peer. Partial files resume like PullEngine's.
+    """
+
+    def __init__(self, sources, connections_per_source=4, progress_callback=None):
+        """
+        :param sources: dict of source name => transport factory
+        :param connections_per_source: concurrent ranges per source
+        :param progress_callback: function(event dict) for structured progress events
+        """
+        if not sources:
+            raise ValueError('a swarm needs at least one source')
+        self.sources = [SwarmSource(name, factory, connections_per_source) for name, factory in sources.items()]
+        self.connections_per_source = connections_per_source
+        self.progress_callback = progress_callback
+        self.progress = ProgressReporter(progress_callback)
+        self._cv = threading.Condition()
+        self._pending = []
+        self._open = []
+        # id(segment) => (transfer, segment, source)
+        self._in_flight = {}
+        self._results = {}
+
+    def list_files(self, source_dir):
+        """
+        list every source; sources whose listing (names and sizes) differs from the first one's are dropped
+        :return: dict of relative path => (size, mtime) from the first source
+        """
+        reference = None
+        for source in self.sources:
+            transport = source.pool.acquire()
+            try:
+                files = transport.list_files(source_dir)
+            except Exception as e:
+                source.pool.release(transport, broken=True)
+                self._drop(source, f'unable to list {source_dir}: {e}')
+                continue
+            source.pool.release(transport)
+            if reference is None:
+                reference = files
+            elif {n: s for n, (s, m) in files.items()} != {n: s for n, (s, m) in reference.items()}:
+                self._drop(source, f'{source_dir} differs from the other sources')
+        if reference is None:
+            raise PullError(f'no source could list {source_dir}')
+        return reference
+
+    def _drop(self, source, reason):
+        logging.warning(f'{source.name}: {reason}, dropping it from the swarm')
+        source.dropped = True
+        self.progress.emit(EVENT_SOURCE_DROPPED, source=source.name, reason=reason)
+
+    def pull(self, source_dir, target_dir, only=None, force=False, delete=False):
+        """
+        same as PullEngine.pull, with the ranges spread over every source
+        :return: PullResult
+        """
+        start = time.monotonic()
+        result = PullResult()
+        self.progress = ProgressReporter(self.progress_callback)
+        files = self.list_files(source_dir)
+        if delete and only is None:
+            remove_extra_files(target_dir, files)
+        if only is not None:
+            files = {name: files[name] for name in only if name in files}
+            for name in only:
+                if name not in files:
+                    result.files[name] = 'not on the source'
+        self._pending = []
+        for name, (size, mtime) in sorted(files.items(), key=lambda item: -item[1][0]):
+            target_path = os.path.join(target_dir, name)
+            if not force and _is_complete(target_path, size, mtime):
+                result.files[name] = 'skipped'
+                self.progress.emit(EVENT_FILE_SKIPPED, file=name, size=size)
+                continue
+            self._pending.append(FileTransfer(name, size, mtime, target_path))
+        self.progress.total_bytes = sum(f.size for f in self._pending)
+        self.progress.emit(EVENT_START, files=len(self._pending), total=self.progress.total_bytes,
+                           skipped=len(files) - len(self._pending),
+                           sources=[s.name for s in self.sources if not s.dropped])
+        transfers = list(self._pending)
+        self._open, self._in_flight, self._results = [], {}, {}
+        workers = [threading.Thread(target=self._worker, args=(source_dir, source), name=f'{source.name}-{n}',
+                                    daemon=True)
+                   for source in self.sources if not source.dropped for n in range(self.connections_per_source)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        for transfer in transfers:
+            if transfer.name not in self._results:
+                transfer.abandon()
+                self._results[transfer.name] = 'incomplete: no source left to fetch it from'
+                self.progress.emit(EVENT_FILE_ERROR, file=transfer.name, error=self._results[transfer.name])
+            result.files[transfer.name] = self._results[transfer.name]
+        result.transferred_bytes = self.progress.transferred_bytes
+        result.elapsed = time.monotonic() - start
+        for source in self.sources:
+            logging.info(f'{source.name}: {source.bytes / BYTES_PER_MB:.0f} MB in {source.ranges} range(s)'
+                         f"{' (dropped)' if source.dropped else ''}")
+        self.progress.emit(EVENT_DONE, ok=result.ok, bytes=result.transferred_bytes, elapsed=result.elapsed,
+                           failed=result.failed(), sources={s.name: s.to_dict() for s in self.sources})
+        return result
+
+    def _next_range(self, source):
+        """
+        :return: (transfer, segment) to fetch from source, or None when there is nothing left for it
+        """
+        with self._cv:
+            while not source.dropped:
+                size = source.range_size()
+                work = self._carve(size) or self._steal(source)
+                if work is not None:
+                    self._in_flight[id(work[1])] = (work[0], work[1], source)
+                    return work
+                if not self._in_flight:
+                    return None
+                # something in flight may fail and come back
+                self._cv.wait()
+            return None
+
+    def _carve(self, size):
+        while True:
+            for transfer in self._open:
+                for segment in transfer.remaining():
+                    if id(segment) in self._in_flight:
+                        continue
+                    with transfer._lock:
+                        if segment[1] - segment[2] <= size + MIN_RANGE_SIZE:
+                            return transfer, segment
+                        piece = [segment[2], segment[2] + size, segment[2]]
+                        segment[0] = segment[2] = segment[2] + size
+                        transfer.segments.append(piece)
+                    return transfer, piece
+            if not self._pending:
+                return None
+            self._open_next()
+
+    def _open_next(self):
+        transfer = self._pending.pop(0)
+        try:
+            # one segment: the swarm cuts ranges from it as sources ask for them
+            resumed = transfer.prepare(1)
+        except (OSError, ValueError) as e:
+            self._results[transfer.name] = f'unable to create {transfer.part_path}: {e}'
+            self.progress.emit(EVENT_FILE_ERROR, file=transfer.name, error=self._results[transfer.name])
+            return
+        self.progress.add_resumed(resumed)
+        if resumed:
+            logging.info(f'{transfer.name}: resuming with {resumed / BYTES_PER_MB:.0f} MB already here')
+        self.progress.emit(EVENT_FILE_START, file=transfer.name, size=transfer.size, resumed=resumed)
+        if transfer.remaining():
+            self._open.append(transfer)
+        else:
+            self._finish(transfer)
+
+    def _steal(self, source):
+        """
+        the end game: split the in-flight range with the most left to go, if it belongs to a slower source
+        """
+        best = None
+        for transfer, segment, owner in self._in_flight.values():
+            left = segment[1] - segment[2]
+            if owner is not source and (owner.rate or 0) <= (source.rate or 0) and left >= 2 * MIN_RANGE_SIZE \
+                    and (best is None or left > best[2]):
+                best = (transfer, segment, left)
+        if best is None:
+            return None
+        transfer, segment, left = best
+        with transfer._lock:
+            middle = segment[2] + (segment[1] - segment[2]) // 2
+            middle -= middle % BYTES_PER_MB
+            if middle - segment[2] < MIN_RANGE_SIZE // 2:
+                return None
+            piece = [middle, segment[1], middle]
+            segment[1] = middle
+            transfer.segments.append(piece)
+        return transfer, piece
+
+    def _finish(self, transfer):
+        if transfer in self._open:
+            self._open.remove(transfer)
+        try:
+            transfer.finish()
+        except OSError as e:
+            self._results[transfer.name] = str(e)
+            self.progress.emit(EVENT_FILE_ERROR, file=transfer.name, error=str(e))
+            return
+        self._results[transfer.name] = 'done'
+        self.progress.emit(EVENT_FILE_DONE, file=transfer.name, size=transfer.size)
+
+    def _worker(self, source_dir, source):
+        while True:
+            work = self._next_range(source)
+            if work is None:
+                return
+            transfer, segment = work
+            start, offset = time.monotonic(), segment[2]
+            try:
+                transport = source.pool.acquire()
+            except Exception as e:
+                self._failed(source, transfer, segment, e)
+                continue
+            try:
+                for data in transport.read_blocks(os.path.join(source_dir, transfer.name), segment[2],
+                                                  segment[1] - segment[2]):
+                    self.progress.add(transfer.write(segment, data))
+                    if segment[2] >= segment[1]:
+                        break
+            except Exception as e:
+                source.pool.release(transport, broken=True)
+                self._failed(source, transfer, segment, e)
+                continue
+            source.pool.release(transport)
+            with self._cv:
+                source.record(segment[2] - offset, time.monotonic() - start)
+                del self._in_flight[id(segment)]
+                if transfer.complete(segment) and transfer in self._open \
+                        and not any(t is transfer for t, s, o in self._in_flight.values()):
+                    self._finish(transfer)
+                self._cv.notify_all()
+
+    def _failed(self, source, transfer, segment, error):
+        with self._cv:
+            del self._in_flight[id(segment)]
+            source.failures += 1
+            logging.warning(f'{source.name}: {transfer.name} at {segment[2]}: {error}')
+            if source.failures >= SOURCE_MAX_FAILURES:
+                self._drop(source, f'{source.failures} failures in a row')
+            self._cv.notify_all()
+        if not source.dropped:
+            time.sleep(min(2 ** source.failures, 60))
+
+    def close(self):
+        for source in self.sources:
+            source.pool.close()
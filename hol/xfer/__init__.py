@@ -1,13 +1,45 @@
 import os
+import sys
+import errno
+import ctypes
+import stat
+import time
+import fcntl
+import json
+import socket
+import subprocess
 import yaml
 import logging
 import shutil
+import sqlite3
 import requests
 import base64
 from pathlib import Path
+from hol.library import LibraryIndex
 
 BYTES_PER_MB = 1024 ** 2
 BYTES_PER_GB = 1024 ** 3
+DIRECTORY_SIZE_CACHE_TTL = 600
+# used to estimate the cost of re-fetching a template that has no recorded export/pull duration
+DEFAULT_REFETCH_BYTES_PER_SECOND = 50 * BYTES_PER_MB
+# evicted templates are renamed into <repository>/.trash and deleted in the background by reap_trash()
+TRASH_DIR_NAME = '.trash'
+REAPER_LOCK_NAME = '.reaper.lock'
+# keep the reaper from starving the exports/pulls that are writing to the same disks
+REAP_BYTES_PER_SECOND = 1024 * BYTES_PER_MB
+# large files are truncated in steps rather than unlinked in one go (freeing 100+ GB of extents at once stalls the fs)
+REAP_TRUNCATE_STEP = 4 * BYTES_PER_GB
+# renameat2(2): swap two paths in one step, so a new version of a template replaces the old one atomically
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+# space reserved by running exports/pulls, shared by every process working on a repository
+RESERVATION_LEDGER_NAME = '.hol-reservations.json'
+RESERVATION_LOCK_NAME = '.hol-reservations.lock'
+# estimates come from ovf:size, which is what lands on disk, plus the descriptor/manifest and fs overhead
+RESERVATION_MARGIN = 0.05
+
+# directory path => (st_mtime_ns, monotonic time of scan, DirectoryUsage of its own files, subdirectory paths)
+_DIRECTORY_SIZE_CACHE = {}
 
 logging.basicConfig(level=logging.INFO)
 
@@ -68,23 +100,136 @@ def read_hol_xfer_auth(credentials_path: str):
     return credentials_dict
 
 
-def get_directory_size(directory: str):
+class DirectoryUsage:
+    """
+    space used by a directory tree: allocated (st_blocks) and apparent (st_size) bytes.
+    Files with more than one link are kept by inode so that hardlinks are only counted once.
+    """
+    __slots__ = ('allocated_bytes', 'apparent_bytes', 'file_count', 'linked_inodes', 'link_counts')
+
+    def __init__(self):
+        self.allocated_bytes = 0
+        self.apparent_bytes = 0
+        self.file_count = 0
+        # (st_dev, st_ino) => (allocated, apparent) for files with st_nlink > 1
+        self.linked_inodes = {}
+        # (st_dev, st_ino) => (st_nlink, links found in this tree)
+        self.link_counts = {}
+
+    def add(self, other):
+        self.allocated_bytes += other.allocated_bytes
+        self.apparent_bytes += other.apparent_bytes
+        self.file_count += other.file_count
+        self.linked_inodes.update(other.linked_inodes)
+        for key, (nlink, seen) in other.link_counts.items():
+            self.link_counts[key] = (nlink, self.link_counts.get(key, (nlink, 0))[1] + seen)
+
+    @property
+    def total_allocated_bytes(self):
+        return self.allocated_bytes + sum(a for a, _ in self.linked_inodes.values())
+
+    @property
+    def total_apparent_bytes(self):
+        return self.apparent_bytes + sum(s for _, s in self.linked_inodes.values())
+
+
+def _scan_directory(path: str, st: os.stat_result):
+    """
+    recursive scandir walk using the stat results of the entries. What a directory holds directly (its files and
+    the names of its subdirectories) is cached by its mtime (entries added/removed/renamed) for at most
+    DIRECTORY_SIZE_CACHE_TTL seconds; subdirectories are stat'ed and checked on every call, so an entry added or
+    removed anywhere in the tree is seen (files growing in place or gaining hard links elsewhere do not change the
+    directory mtime). The cache lives in the process: it only pays off in long-running ones (the daemon,
+    run_pipeline.py); the short-lived bin scripts walk the whole tree every time.
+    """
+    now = time.monotonic()
+    cached = _DIRECTORY_SIZE_CACHE.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns and now - cached[1] < DIRECTORY_SIZE_CACHE_TTL:
+        own, subdirectories = cached[2], cached[3]
+    else:
+        own = DirectoryUsage()
+        own.allocated_bytes += st.st_blocks * 512
+        subdirectories = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+                        continue
+                    entry_st = entry.stat(follow_symlinks=False)
+                except (FileNotFoundError, PermissionError):
+                    # removed while we were looking, or not ours to look at
+                    continue
+                own.file_count += 1
+                if entry_st.st_nlink > 1:
+                    key = (entry_st.st_dev, entry_st.st_ino)
+                    own.linked_inodes[key] = (entry_st.st_blocks * 512, entry_st.st_size)
+                    own.link_counts[key] = (entry_st.st_nlink, own.link_counts.get(key, (0, 0))[1] + 1)
+                else:
+                    own.allocated_bytes += entry_st.st_blocks * 512
+                    own.apparent_bytes += entry_st.st_size
+        _DIRECTORY_SIZE_CACHE[path] = (st.st_mtime_ns, now, own, subdirectories)
+    usage = DirectoryUsage()
+    usage.add(own)
+    for subdirectory in subdirectories:
+        try:
+            usage.add(_scan_directory(subdirectory, os.stat(subdirectory, follow_symlinks=False)))
+        except (FileNotFoundError, PermissionError):
+            continue
+    return usage
+
+
+def get_directory_usage(directory: str):
+    """
+    walk a directory tree and return its allocated and apparent sizes
+    :param directory: full path to the directory (or a file)
+    :return: DirectoryUsage
+    """
+    directory = os.path.abspath(directory)
+    st = os.stat(directory, follow_symlinks=False)
+    if not stat.S_ISDIR(st.st_mode):
+        usage = DirectoryUsage()
+        usage.allocated_bytes = st.st_blocks * 512
+        usage.apparent_bytes = st.st_size
+        usage.file_count = 1
+        return usage
+    return _scan_directory(directory, st)
+
+
+def get_freed_bytes(usage: DirectoryUsage, links_removed: dict):
+    """
+    space given back by removing a tree: its own files, plus the hardlinked inodes whose last link goes with it
+    (a template deduplicated against another frees nothing for the files they share)
+    :param usage: DirectoryUsage of the tree
+    :param links_removed: (st_dev, st_ino) => links removed so far, updated here; share it between the trees of
+                          one plan so an inode is freed by whichever removes its last link
+    :return: int bytes
+    """
+    freed = usage.allocated_bytes
+    for key, (nlink, seen) in usage.link_counts.items():
+        before = links_removed.get(key, 0)
+        links_removed[key] = before + seen
+        if before < nlink <= before + seen:
+            freed += usage.linked_inodes[key][0]
+    return freed
+
+
+def get_directory_size(directory: str, allocated=True):
     """
     returns space consumed by directory in bytes
     :param directory: full path to the directory you'd like the size of
+    :param allocated: count blocks actually allocated (sparse files, each hardlinked inode once) rather than
+                      apparent file sizes
     :return: int = amount of space consumed in BYTES
     """
-    total_bytes = 0
     try:
-        for elem in os.scandir(directory):
-            total_bytes += os.path.getsize(elem)
-    except NotADirectoryError:
-        # if `directory` isn't a directory, just return the file size
-        return os.path.getsize(directory)
+        usage = get_directory_usage(directory)
     except PermissionError:
         # if we can't open the folder, return 0
         return 0
-    return total_bytes
+    if allocated:
+        return usage.total_allocated_bytes
+    return usage.total_apparent_bytes
 
 
 def get_free_space_bytes(directory: str):
@@ -92,44 +237,504 @@ def get_free_space_bytes(directory: str):
     return free
 
 
-def cleanup_oldest(the_path: str, pattern: str, threshold_gb: int, really_delete=False):
+def _walk_allocated_bytes(path: str, unlinked_only=False):
+    # uncached: for trees whose files shrink or grow in place (trash being reaped, exports being written)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            if not unlinked_only or st.st_nlink == 1:
+                total += st.st_blocks * 512
+    return total
+
+
+def get_trash_bytes(the_path: str):
+    """
+    space (allocated bytes) still held by entries waiting in the_path/.trash for the reaper -- not cached,
+    since the reaper shrinks files in place
+    :param the_path: the repository root
+    :return: int bytes
+    """
+    # a hardlink that survives elsewhere frees nothing when the trash is reaped
+    return _walk_allocated_bytes(os.path.join(the_path, TRASH_DIR_NAME), unlinked_only=True)
+
+
+def get_reclaimable_free_space_bytes(the_path: str):
+    """
+    free space plus what the trash reaper is about to give back
+    :param the_path: the repository root
+    :return: int bytes
+    """
+    return get_free_space_bytes(the_path) + get_trash_bytes(the_path)
+
+
+def move_to_trash(the_path: str, item_path: str):
+    """
+    atomically take an item out of the library by renaming it into the_path/.trash (same filesystem)
+    :param the_path: the repository root
+    :param item_path: full path of the file/directory to remove
+    :return: str -- the new path inside the trash
+    """
+    trash_path = os.path.join(the_path, TRASH_DIR_NAME)
+    os.makedirs(trash_path, exist_ok=True)
+    target = os.path.join(trash_path, f'{os.path.basename(item_path)}.{time.time_ns()}')
+    os.rename(item_path, target)
+    return target
+
+
+def _exchange_paths(path_a: str, path_b: str):
+    """
+    atomically swap two paths on the same filesystem with renameat2(RENAME_EXCHANGE)
+    :return: True if swapped, False if the kernel, C library or filesystem cannot do it
+    """
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    if renameat2(AT_FDCWD, os.fsencode(path_a), AT_FDCWD, os.fsencode(path_b), RENAME_EXCHANGE) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), path_a, None, path_b)
+
+
+def replace_in_library(the_path: str, new_path: str, item_path: str):
+    """
+    put a new version of a library item (assembled next to it, e.g. in .staging) in place of the old one, with no
+    moment where neither is there: an atomic exchange where the filesystem supports it, else the old version is
+    renamed aside and renamed back if the new one cannot be put in place. The old version goes to the trash.
+    :param the_path: the repository root
+    :param new_path: full path of the new version (same filesystem)
+    :param item_path: full path of the item to replace (it need not exist)
+    :return: None
+    """
+    if not os.path.lexists(item_path):
+        os.rename(new_path, item_path)
+        return
+    if _exchange_paths(new_path, item_path):
+        old_path = new_path
+    else:
+        old_path = f'{new_path}.old'
+        os.rename(item_path, old_path)
+        try:
+            os.rename(new_path, item_path)
+        except BaseException:
+            os.rename(old_path, item_path)
+            raise
+    try:
+        move_to_trash(the_path, old_path)
+    except OSError as e:
+        # the new version is in place: this only leaks space
+        logging.warning(f'unable to move the old version of {item_path} to the trash, it is in {old_path}: {e}')
+
+
+def _reap_file(file_path: str, throttle):
+    st = os.lstat(file_path)
+    if st.st_nlink == 1 and stat.S_ISREG(st.st_mode):
+        size = st.st_size
+        while size > REAP_TRUNCATE_STEP:
+            size -= REAP_TRUNCATE_STEP
+            os.truncate(file_path, size)
+            throttle(REAP_TRUNCATE_STEP)
+        os.unlink(file_path)
+        throttle(size)
+    else:
+        os.unlink(file_path)
+
+
+def reap_trash(the_path: str, max_bytes_per_second=REAP_BYTES_PER_SECOND):
+    """
+    delete everything in the_path/.trash, oldest first, freeing at most max_bytes_per_second.
+    Only one reaper runs per repository (flock on .trash/.reaper.lock); a second one returns immediately.
+    :param the_path: the repository root
+    :param max_bytes_per_second: I/O bound for the deletions (0 = as fast as possible)
+    :return: int -- bytes (apparent) released, or None if another reaper holds the lock
+    """
+    trash_path = os.path.join(the_path, TRASH_DIR_NAME)
+    if not os.path.isdir(trash_path):
+        return 0
+    lock_f = open(os.path.join(trash_path, REAPER_LOCK_NAME), 'a')
+    try:
+        try:
+            fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.debug(f'another reaper is already working on {trash_path}')
+            return None
+        start = time.monotonic()
+        released = 0
+
+        def throttle(nbytes):
+            nonlocal released
+            released += nbytes
+            if max_bytes_per_second:
+                ahead = released / max_bytes_per_second - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        # keep going until the trash is empty: more victims may arrive while we work
+        while True:
+            victims = sorted((entry for entry in os.scandir(trash_path) if entry.name != REAPER_LOCK_NAME),
+                             key=lambda entry: entry.stat(follow_symlinks=False).st_mtime)
+            if not victims:
+                break
+            for victim in victims:
+                try:
+                    if victim.is_dir(follow_symlinks=False):
+                        for root, dirs, files in os.walk(victim.path, topdown=False):
+                            for name in files:
+                                _reap_file(os.path.join(root, name), throttle)
+                            for name in dirs:
+                                dir_path = os.path.join(root, name)
+                                if os.path.islink(dir_path):
+                                    os.unlink(dir_path)
+                                else:
+                                    os.rmdir(dir_path)
+                        os.rmdir(victim.path)
+                    else:
+                        _reap_file(victim.path, throttle)
+                    logging.info(f'reaped {victim.name}')
+                except OSError as e:
+                    # leave it for the next pass/reaper rather than spinning on it
+                    logging.error(f'unable to reap {victim.path}: {e}')
+                    return released
+        return released
+    finally:
+        lock_f.close()
+
+
+def start_trash_reaper(the_path: str, max_bytes_per_second=REAP_BYTES_PER_SECOND):
+    """
+    run reap_trash() in a detached process so the caller does not wait for the deletions
+    :param the_path: the repository root
+    :param max_bytes_per_second: I/O bound for the deletions
+    :return: subprocess.Popen
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (package_root, env.get('PYTHONPATH')) if p)
+    code = 'import sys; from hol.xfer import reap_trash; reap_trash(sys.argv[1], int(sys.argv[2]))'
+    return subprocess.Popen([sys.executable, '-c', code, the_path, str(int(max_bytes_per_second))],
+                            env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def _pid_is_running(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SpaceReservationLedger:
+    """
+    space promised to exports/pulls that are running (or about to) against a repository. The ledger is a JSON
+    file in the repository guarded by an flock, so concurrent jobs see each other's reservations; entries of
+    processes that died on this host are purged whenever the ledger is read.
+    A reservation only counts for what has not been written yet: the bytes already allocated under its path
+    are already gone from the free space.
+    """
+
+    def __init__(self, repository: str):
+        self.repository = repository
+        self.ledger_path = os.path.join(repository, RESERVATION_LEDGER_NAME)
+        self.lock_path = os.path.join(repository, RESERVATION_LOCK_NAME)
+        self.host = socket.gethostname()
+
+    def _read(self):
+        try:
+            with open(self.ledger_path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logging.warning(f'discarding unreadable reservation ledger {self.ledger_path}')
+            return []
+        live = [e for e in entries if e['host'] != self.host or _pid_is_running(e['pid'])]
+        for entry in entries:
+            if entry not in live:
+                logging.info(f"purging stale reservation {entry['id']} for {entry['template']} (pid {entry['pid']})")
+        return live
+
+    def _write(self, entries):
+        tmp_path = f'{self.ledger_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=2)
+        os.replace(tmp_path, self.ledger_path)
+
+    def _locked(self):
+        lock_f = open(self.lock_path, 'a')
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        return lock_f
+
+    @staticmethod
+    def outstanding_bytes(entry):
+        """
+        :return: the part of a reservation that has not been written to disk yet
+        """
+        written = _walk_allocated_bytes(entry['path']) if entry.get('path') else 0
+        return max(entry['bytes'] - written, 0)
+
+    def entries(self):
+        """
+        :return: list of live reservations (dicts: id, template, bytes, path, pid, host, created)
+        """
+        with self._locked():
+            entries = self._read()
+            self._write(entries)
+        return entries
+
+    def reserved_bytes(self, entries=None):
+        if entries is None:
+            entries = self.entries()
+        return sum(self.outstanding_bytes(e) for e in entries)
+
+    def available_bytes(self, entries=None):
+        """
+        free space (counting the trash) that nobody has reserved
+        """
+        return get_reclaimable_free_space_bytes(self.repository) - self.reserved_bytes(entries)
+
+    def reserve(self, template: str, size_bytes: int, path=None, floor_bytes=0):
+        """
+        atomically reserve space if it is available
+        :param template: template name (for the logs / listing)
+        :param size_bytes: how much the job will write
+        :param path: where the job writes; bytes allocated there count against the reservation
+        :param floor_bytes: free space that must remain after this reservation
+        :return: reservation id, or None if it does not fit
+        """
+        with self._locked():
+            entries = self._read()
+            available = self.available_bytes(entries)
+            if available - size_bytes < floor_bytes:
+                self._write(entries)
+                logging.info(f'cannot reserve {size_bytes / BYTES_PER_GB:.2f} GB for {template}: '
+                             f'{available / BYTES_PER_GB:.2f} GB unreserved, {len(entries)} reservation(s) held')
+                return None
+            reservation_id = f'{self.host}-{os.getpid()}-{time.time_ns()}'
+            entries.append({'id': reservation_id, 'template': template, 'bytes': int(size_bytes), 'path': path,
+                            'pid': os.getpid(), 'host': self.host, 'created': time.time()})
+            self._write(entries)
+        logging.info(f'reserved {size_bytes / BYTES_PER_GB:.2f} GB for {template}')
+        return reservation_id
+
+    def wait_and_reserve(self, template: str, size_bytes: int, path=None, floor_bytes=0, timeout=0,
+                         poll_interval=60):
+        """
+        queue for space: retry reserve() until it succeeds or timeout seconds have passed
+        :return: reservation id or None
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            reservation_id = self.reserve(template, size_bytes, path, floor_bytes)
+            if reservation_id is not None or time.monotonic() >= deadline:
+                return reservation_id
+            time.sleep(min(poll_interval, max(deadline - time.monotonic(), 0)))
+
+    def release(self, reservation_id: str):
+        with self._locked():
+            entries = [e for e in self._read() if e['id'] != reservation_id]
+            self._write(entries)
+        logging.debug(f'released reservation {reservation_id}')
+
+
+class EvictionCandidate:
+    """
+    a top-level library entry that may be removed to free space
+    """
+    __slots__ = ('path', 'name', 'size_bytes', 'mtime', 'last_used', 'use_count', 'refetch_seconds', 'pinned')
+
+    def __init__(self, path, size_bytes, mtime, record=None):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size_bytes = size_bytes
+        self.mtime = mtime
+        record = record or {}
+        # never used since we started keeping records: fall back to when it landed in the library
+        self.last_used = record.get('last_used') or mtime
+        self.use_count = record.get('use_count') or 0
+        self.refetch_seconds = record.get('refetch_seconds')
+        self.pinned = bool(record.get('pinned'))
+
+    def estimated_refetch_seconds(self):
+        if self.refetch_seconds:
+            return self.refetch_seconds
+        return self.size_bytes / DEFAULT_REFETCH_BYTES_PER_SECOND
+
+    def to_dict(self):
+        return {'name': self.name, 'size_gb': round(self.size_bytes / BYTES_PER_GB, 2), 'mtime': self.mtime,
+                'last_used': self.last_used, 'use_count': self.use_count,
+                'refetch_seconds': round(self.estimated_refetch_seconds(), 1), 'pinned': self.pinned}
+
+
+class EvictionPolicy:
+    """
+    orders eviction candidates: lowest sort_key is evicted first
+    """
+    name = 'oldest'
+
+    def sort_key(self, candidate: EvictionCandidate, now: float):
+        # oldest modification time first (the original cleanup_oldest behavior)
+        return candidate.mtime
+
+    def order(self, candidates, now=None):
+        if now is None:
+            now = time.time()
+        return sorted(candidates, key=lambda c: self.sort_key(c, now))
+
+
+class LruEvictionPolicy(EvictionPolicy):
+    """
+    least recently used (exported, pulled or imported) first
+    """
+    name = 'lru'
+
+    def sort_key(self, candidate, now):
+        return candidate.last_used
+
+
+class SizeWeightedEvictionPolicy(EvictionPolicy):
+    """
+    big, idle templates first: idle time multiplied by size, so one stale 500 GB template goes before
+    several stale 20 GB ones
+    """
+    name = 'size'
+
+    def sort_key(self, candidate, now):
+        idle_seconds = max(now - candidate.last_used, 1)
+        return -(idle_seconds * candidate.size_bytes)
+
+
+class RefetchCostEvictionPolicy(EvictionPolicy):
+    """
+    keep what is expensive to get back (GreedyDual-Size-Frequency style): the value of keeping a template is
+    how often it is used times how long it takes to re-export/pull, per byte it occupies, decayed with idle time
+    """
+    name = 'cost'
+
+    def __init__(self, half_life_days=7):
+        self.half_life_seconds = half_life_days * 86400
+
+    def sort_key(self, candidate, now):
+        idle_seconds = max(now - candidate.last_used, 0)
+        decay = 0.5 ** (idle_seconds / self.half_life_seconds)
+        return (candidate.use_count + 1) * candidate.estimated_refetch_seconds() * decay / \
+            max(candidate.size_bytes, 1)
+
+
+EVICTION_POLICIES = {policy.name: policy for policy in
+                     (EvictionPolicy, LruEvictionPolicy, SizeWeightedEvictionPolicy, RefetchCostEvictionPolicy)}
+
+
+def get_eviction_policy(name: str):
+    """
+    :param name: one of EVICTION_POLICIES ('oldest', 'lru', 'size', 'cost')
+    :return: EvictionPolicy instance
+    """
+    try:
+        return EVICTION_POLICIES[name]()
+    except KeyError:
+        raise ValueError(f'unknown eviction policy {name}, expected one of {list(EVICTION_POLICIES)}')
+
+
+def plan_eviction(the_path: str, pattern: str, threshold_gb: int, policy='oldest', pinned=()):
     """
-    using pattern and threshold_gb, free space on the_path by removing the oldest matching files/directories
+    work out which matching entries would be removed, in order, to get threshold_gb free on the_path
+    :param the_path: the full path to the directory to be cleaned up
+    :param pattern: a substring that must be contained in the top-level candidate items for cleanup
+    :param threshold_gb: the minimum number of GB that should be free on the_path
+    :param policy: EvictionPolicy or policy name
+    :param pinned: names that must never be evicted (in addition to those pinned in the library index)
+    :return: (list of EvictionCandidate to remove, in order; free GB once they are gone)
+    """
+    if isinstance(policy, str):
+        policy = get_eviction_policy(policy)
+    try:
+        with LibraryIndex(the_path) as index:
+            records = index.access_records()
+    except (sqlite3.Error, OSError) as e:
+        logging.warning(f'no access records available for {the_path}: {e}')
+        records = {}
+    # whatever is already in the trash is as good as free
+    free_gb = get_reclaimable_free_space_bytes(the_path) / BYTES_PER_GB
+    candidates = []
+    usages = {}
+    for item in Path(the_path).iterdir():
+        # skip library state (.hol-index.sqlite etc.)
+        if item.name.startswith('.') or pattern not in item.name:
+            continue
+        try:
+            usages[item.name] = get_directory_usage(item)
+        except PermissionError:
+            usages[item.name] = DirectoryUsage()
+        candidate = EvictionCandidate(str(item), usages[item.name].total_allocated_bytes, os.path.getmtime(item),
+                                      records.get(item.name))
+        if candidate.pinned or item.name in pinned:
+            logging.debug(f'{item.name} is pinned')
+            continue
+        candidates.append(candidate)
+
+    plan = []
+    links_removed = {}
+    for candidate in policy.order(candidates):
+        if free_gb >= threshold_gb:
+            break
+        # TODO: should we ignore size 0 or attempt to remove it?
+        plan.append(candidate)
+        free_gb += get_freed_bytes(usages[candidate.name], links_removed) / BYTES_PER_GB
+    return plan, free_gb
+
+
+def cleanup_oldest(the_path: str, pattern: str, threshold_gb: int, really_delete=False, policy='oldest',
+                   pinned=(), reap=True):
+    """
+    using pattern and threshold_gb, free space on the_path by removing matching files/directories in the order
+    given by the eviction policy (default: oldest first). Removal is a rename into the_path/.trash; the space
+    is given back by a background reaper (see reap_trash), so callers should check
+    get_reclaimable_free_space_bytes() rather than get_free_space_bytes().
     :param the_path: the full path to the directory to be cleaned up
     :param pattern: a substring that musty be contained in the top-level candidate items for cleanup
     :param threshold_gb: the minimum number of GB that should be free on the_path at function exit
-    :param really_delete: REALLY perform the deletion? (there is no going back)
-    :return:
-    """
-    total, used, free = shutil.disk_usage(the_path)
-    free_gb = free / BYTES_PER_GB
-    # list the directory, sorted by date (oldest creation date first)
-    contents_by_created_date = sorted(
-        Path(the_path).iterdir(), key=os.path.getmtime)
-
-    for item in contents_by_created_date:
-        if pattern in item.name and free_gb < threshold_gb:
-            item_size = get_directory_size(item)
-            item_size_gb = item_size / BYTES_PER_GB
-            # TODO: should we ignore size 0 or attempt to remove it?
-            try:
-                if really_delete:
-                    shutil.rmtree(item)
-                else:
-                    logging.info(f"not really removing {item}")
-            except OSError as e:
-                logging.error(f"BAD THINGS HAPPENED while removing {item}:")
-                logging.error({e})
+    :param really_delete: REALLY perform the deletion? (there is no going back) -- otherwise just log the plan
+    :param policy: EvictionPolicy or policy name, see EVICTION_POLICIES
+    :param pinned: names that must never be removed
+    :param reap: start a detached reaper for the trash (otherwise leave it to bin/reap_trash.py / cron)
+    :return: list of EvictionCandidate -- the eviction plan
+    """
+    plan, planned_free_gb = plan_eviction(the_path, pattern, threshold_gb, policy, pinned)
+    free_gb = get_reclaimable_free_space_bytes(the_path) / BYTES_PER_GB
+    for item in plan:
+        item_size_gb = item.size_bytes / BYTES_PER_GB
+        try:
+            if really_delete:
+                move_to_trash(the_path, item.path)
             else:
-                free_gb += item_size_gb
-                logging.info(
-                    f'Free space after removing {item} of size {item_size_gb:.2f} = {free_gb:.2f}')
+                logging.info(f"not really removing {item.path} ({item_size_gb:.2f} GB, "
+                             f"last used {time.ctime(item.last_used)}, {item.use_count} use(s))")
+        except OSError as e:
+            logging.error(f"BAD THINGS HAPPENED while removing {item.path}:")
+            logging.error({e})
+        else:
+            free_gb += item_size_gb
+            logging.info(
+                f'Free space after removing {item.path} of size {item_size_gb:.2f} = {free_gb:.2f}')
+    if really_delete and plan and reap:
+        start_trash_reaper(the_path)
     # check it again!
-    total, used, free = shutil.disk_usage(the_path)
-    free_gb = free / BYTES_PER_GB
-    if free_gb < threshold_gb:
+    free_gb = get_reclaimable_free_space_bytes(the_path) / BYTES_PER_GB
+    if free_gb < threshold_gb and really_delete:
         logging.warning(
             f'available free space ({free_gb:.2f} GB) is still less than threshold ({threshold_gb} GB)')
+    return plan
 
 
 def fetch_credentials_from_hol_central(api_endpoint: str, vcd_instance: str, org: str, bearer_token: str):
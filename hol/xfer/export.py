@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from hol.ovf import parse_ovf_envelope, load_ovf_envelope, get_disk_map_from_envelope, read_the_manifest, \
+    hash_files, clone_file, BYTES_PER_GB
+from hol.xfer import replace_in_library
+from hol.xfer.vcd import VcdRestError
+
+# new versions are assembled in <repository>/.staging/<template>.<pid> and renamed into place when complete
+EXPORT_STAGING_DIR_NAME = '.staging'
+# files whose size matches are compared with the source at a few offsets (when the transfer service allows ranges)
+EXPORT_SAMPLE_BLOCKS = 8
+EXPORT_SAMPLE_SIZE = 64 * 1024
+ACTION_CLONE = 'clone'
+ACTION_DOWNLOAD = 'download'
+# what the source catalog item looked like when the local copy was exported: <template>/<template>.source.json
+SOURCE_FINGERPRINT_SUFFIX = '.source.json'
+DECISION_SKIP = 'skip'
+DECISION_INCREMENTAL = 'incremental'
+DECISION_FULL = 'full'
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ExportFile:
+    """
+    one file of the source template and what an incremental export does with it
+    """
+    __slots__ = ('file_id', 'href', 'size', 'local_name', 'action', 'reason')
+
+    def __init__(self, file_id, href, size, local_name, action, reason=''):
+        self.file_id = file_id
+        self.href = href
+        self.size = size
+        self.local_name = local_name
+        self.action = action
+        self.reason = reason
+
+    def to_dict(self):
+        return {'file_id': self.file_id, 'href': self.href, 'size': self.size, 'local_name': self.local_name,
+                'action': self.action, 'reason': self.reason}
+
+
+class ExportPlan:
+    """
+    the source template's descriptor and, per file, whether the local copy is reused or the file downloaded
+    """
+    __slots__ = ('template', 'entity_href', 'descriptor', 'descriptor_href', 'files')
+
+    def __init__(self, template, entity_href, descriptor, descriptor_href, files):
+        self.template = template
+        self.entity_href = entity_href
+        self.descriptor = descriptor
+        # the descriptor in the transfer area (None until the template is enabled for download)
+        self.descriptor_href = descriptor_href
+        self.files = files
+
+    @property
+    def download_bytes(self):
+        return sum(f.size or 0 for f in self.files if f.action == ACTION_DOWNLOAD)
+
+    @property
+    def reused_bytes(self):
+        return sum(f.size or 0 for f in self.files if f.action == ACTION_CLONE)
+
+    def to_dict(self):
+        return {'template': self.template, 'entity_href': self.entity_href,
+                'download_bytes': self.download_bytes, 'reused_bytes': self.reused_bytes,
+                'files': [f.to_dict() for f in self.files]}
+
+
+def match_local_files(source_envelope, local_envelope):
+    """
+    pair the files of a new descriptor with those of the local copy: disks by VM and disk name (file names
+    change between revisions), everything else by ovf:id, then by name
+    :return: dict of source href => local file name
+    """
+    local_names = {}
+    local_disks = get_disk_map_from_envelope(local_envelope)
+    for vm_disk, href in get_disk_map_from_envelope(source_envelope).items():
+        if vm_disk in local_disks:
+            local_names[href] = local_disks[vm_disk]
+    local_hrefs = {f.href for f in local_envelope.files.values()}
+    for file_id, f in source_envelope.files.items():
+        if f.href in local_names:
+            continue
+        if file_id in local_envelope.files:
+            local_names[f.href] = local_envelope.files[file_id].href
+        elif f.href in local_hrefs:
+            local_names[f.href] = f.href
+    return local_names
+
+
+def compare_with_local(template, entity_href, descriptor, template_path, digest_cache=None):
+    """
+    decide per file of a source descriptor: reuse the local file when the sizes match and the local copy does not
+    contradict its own manifest (only digests already in the cache are consulted), else download it
+    :return: ExportPlan
+    """
+    source = parse_ovf_envelope(descriptor)
+    local_ovf = os.path.join(template_path, f'{template}.ovf')
+    local_names = match_local_files(source, load_ovf_envelope(local_ovf)) if os.path.isfile(local_ovf) else {}
+    manifest = read_the_manifest(os.path.join(template_path, f'{template}.mf'))
+    files = []
+    for file_id, f in source.files.items():
+        size = int(f.size) if f.size else None
+        local_name = local_names.get(f.href)
+        local_file = os.path.join(template_path, local_name) if local_name else None
+        reason = ''
+        if local_name is None:
+            reason = 'new'
+        elif not os.path.isfile(local_file):
+            reason = 'missing locally'
+        elif size is None:
+            reason = 'size unknown'
+        elif os.path.getsize(local_file) != size:
+            reason = 'size differs'
+        elif digest_cache is not None and local_name in manifest:
+            algorithm, digest = manifest[local_name]
+            cached = digest_cache.lookup(local_file, algorithm)
+            if cached is not None and cached != digest:
+                reason = 'local copy does not match its manifest'
+        files.append(ExportFile(file_id, f.href, size, local_name, ACTION_DOWNLOAD if reason else ACTION_CLONE,
+                                reason))
+    return ExportPlan(template, entity_href, descriptor, None, files)
+
+
+def samples_match(session, url, local_file, size):
+    """
+    :return: True/False, or None if the transfer service does not serve ranges
+    """
+    positions = sorted({max(0, min(size - EXPORT_SAMPLE_SIZE, size * i // (EXPORT_SAMPLE_BLOCKS - 1)))
+                        for i in range(EXPORT_SAMPLE_BLOCKS)})
+    with open(local_file, 'rb') as f:
+        for position in positions:
+            length = min(EXPORT_SAMPLE_SIZE, size - position)
+            remote = session.read_range(url, position, length)
+            if remote is None:
+                return None
+            if remote != os.pread(f.fileno(), length, position):
+                return False
+    return True
+
+
+def plan_incremental_export(session, cloud_catalog, vapp_template_name, repository, sample=True, digest_cache=None,
+                            source_changed=False):
+    """
+    compare a catalog item with the local copy of the template: first by the descriptor alone (no download is
+    enabled if nothing differs, sampling is off and the source is the one the local copy came from), then, for
+    files whose size matches, by sampled byte ranges
+    :param session: logged-in VcdSession
+    :param sample: compare EXPORT_SAMPLE_BLOCKS ranges of each matching file with the source
+    :param digest_cache: DigestCache for the local files
+    :param source_changed: the catalog item is not the one the local copy was exported from (or nobody knows)
+    :return: ExportPlan, or None if the catalog item does not exist
+    """
+    catalog_item = session.find_catalog_item(cloud_catalog, vapp_template_name)
+    if catalog_item is None:
+        return None
+    entity_href = catalog_item['entity']
+    template_path = os.path.join(repository, vapp_template_name)
+    plan = compare_with_local(vapp_template_name, entity_href, session.get_ovf_descriptor(entity_href),
+                              template_path, digest_cache)
+    if not sample and not source_changed and all(f.action == ACTION_CLONE for f in plan.files):
+        return plan
+    # what gets written is the descriptor in the transfer area, which names the files as they are served
+    descriptor_href = session.enable_download(entity_href)
+    plan = compare_with_local(vapp_template_name, entity_href, session.get(descriptor_href, accept='*/*').content,
+                              template_path, digest_cache)
+    plan.descriptor_href = descriptor_href
+    if sample:
+        transfer_base = descriptor_href.rsplit('/', 1)[0] + '/'
+        for f in plan.files:
+            if f.action != ACTION_CLONE:
+                continue
+            match = samples_match(session, transfer_base + f.href, os.path.join(template_path, f.local_name),
+                                  f.size)
+            if match is None:
+                logging.warning('the transfer service does not serve byte ranges: comparing sizes only')
+                break
+            if not match:
+                f.action = ACTION_DOWNLOAD
+                f.reason = 'sampled bytes differ'
+    return plan
+
+
+def descriptor_changed(plan, repository):
+    """
+    :return: True if the descriptor in the transfer area is not the local OVF byte for byte (a scrubbed local
+        copy counts as changed); False if the plan only has the API descriptor, which is never the same bytes
+    """
+    if plan.descriptor_href is None:
+        return False
+    try:
+        with open(os.path.join(repository, plan.template, f'{plan.template}.ovf'), 'rb') as f:
+            return f.read() != plan.descriptor
+    except FileNotFoundError:
+        return True
+
+
+def write_manifest(manifest_file, digests):
+    """
+    :param digests: dict of file name => sha256 hex digest, in the order they should be listed
+    """
+    with open(manifest_file, 'w') as f:
+        for file_name, digest in digests.items():
+            f.write(f'SHA256({file_name})= {digest}\n')
+
+
+def export_staging_path(repository, template):
+    """
+    :return: where this process assembles a new version of a template (reserve library space against it)
+    """
+    return os.path.join(repository, EXPORT_STAGING_DIR_NAME, f'{template}.{os.getpid()}')
+
+
+def perform_incremental_export(session, plan, repository, progress_callback=None, digest_cache=None):
+    """
+    build the new version of a template in a staging directory -- clones (reflinks, else hard links) of the local
+    files that did not change, downloads of those that did, the source descriptor and a fresh manifest -- then swap
+    it in for the old version (which goes to the library trash)
+    :param session: logged-in VcdSession
+    :param plan: ExportPlan from plan_incremental_export
+    :param progress_callback: function(bytes_downloaded)
+    :param digest_cache: DigestCache, to hash only what was downloaded
+    :return: path of the template
+    """
+    template_path = os.path.join(repository, plan.template)
+    staging_path = export_staging_path(repository, plan.template)
+    if plan.download_bytes and plan.descriptor_href is None:
+        raise ValueError(f'{plan.template}: files to download, but the template was not enabled for download')
+    local_manifest = read_the_manifest(os.path.join(template_path, f'{plan.template}.mf'))
+    os.makedirs(staging_path)
+    try:
+        digests = {f.href: None for f in plan.files}
+        # downloads first: until they are done, what is allocated in the staging directory is what a space
+        # reservation against it has consumed (the clones would count as written too, although they take no space)
+        for f in plan.files:
+            if f.action == ACTION_CLONE:
+                continue
+            target = os.path.join(staging_path, f.href)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            logging.info(f'{f.href}: downloading {(f.size or 0) / BYTES_PER_GB:.2f} GB ({f.reason})')
+            written = session.download(plan.descriptor_href.rsplit('/', 1)[0] + '/' + f.href, target,
+                                       progress_callback)
+            if f.size is not None and written != f.size:
+                raise VcdRestError('GET', f.href, 500, f'downloaded {written} of {f.size} bytes')
+        for f in plan.files:
+            if f.action != ACTION_CLONE:
+                continue
+            target = os.path.join(staging_path, f.href)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            method = clone_file(os.path.join(template_path, f.local_name), target)
+            algorithm, digest = local_manifest.get(f.local_name, (None, None))
+            digests[f.href] = digest if algorithm == 'sha256' else None
+            logging.info(f'{f.href}: unchanged, {method} of {f.local_name}')
+        to_hash = [os.path.join(staging_path, name) for name, digest in digests.items() if digest is None]
+        hashed = hash_files(to_hash, 'sha256', digest_cache=digest_cache)
+        for name in digests:
+            digests[name] = digests[name] or hashed[os.path.join(staging_path, name)]
+        ovf_name = f'{plan.template}.ovf'
+        with open(os.path.join(staging_path, ovf_name), 'wb') as ovf_f:
+            ovf_f.write(plan.descriptor)
+        digests[ovf_name] = hashlib.sha256(plan.descriptor).hexdigest()
+        write_manifest(os.path.join(staging_path, f'{plan.template}.mf'), digests)
+        replace_in_library(repository, staging_path, template_path)
+    except BaseException:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    return template_path
+
+
+class SourceFingerprint:
+    """
+    what identifies the source of a local copy -- the catalog item's vAppTemplate href and creation date (a new
+    revision under the same name is a new entity) -- plus the sizes of the files the export produced
+    """
+    __slots__ = ('cloud_host', 'cloud_org', 'cloud_catalog', 'entity_href', 'created', 'files', 'recorded_at')
+
+    def __init__(self, cloud_host, cloud_org, cloud_catalog, entity_href, created, files=None, recorded_at=None):
+        self.cloud_host = cloud_host
+        self.cloud_org = cloud_org
+        self.cloud_catalog = cloud_catalog
+        self.entity_href = entity_href
+        self.created = created
+        # file name => size, for the files in the References of the local OVF
+        self.files = files or {}
+        self.recorded_at = recorded_at
+
+    @classmethod
+    def from_catalog_record(cls, record, cloud_host, cloud_org, cloud_catalog):
+        """
+        :param record: catalogItem query record (VcdSession.find_catalog_item)
+        """
+        return cls(cloud_host, cloud_org, cloud_catalog, record.get('entity'), record.get('creationDate'))
+
+    def to_dict(self):
+        return {'cloud_host': self.cloud_host, 'cloud_org': self.cloud_org, 'cloud_catalog': self.cloud_catalog,
+                'entity_href': self.entity_href, 'created': self.created, 'files': self.files,
+                'recorded_at': self.recorded_at}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['cloud_host'], d['cloud_org'], d['cloud_catalog'], d['entity_href'], d.get('created'),
+                   d.get('files'), d.get('recorded_at'))
+
+    def same_source(self, other):
+        return (self.cloud_host, self.cloud_org, self.cloud_catalog, self.entity_href, self.created) == \
+            (other.cloud_host, other.cloud_org, other.cloud_catalog, other.entity_href, other.created)
+
+
+def source_fingerprint_path(repository, template):
+    return os.path.join(repository, template, f'{template}{SOURCE_FINGERPRINT_SUFFIX}')
+
+
+def read_source_fingerprint(repository, template):
+    """
+    :return: SourceFingerprint, or None if there is none (or it cannot be read)
+    """
+    try:
+        with open(source_fingerprint_path(repository, template)) as f:
+            return SourceFingerprint.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f'ignoring the source fingerprint of {template}: {e}')
+        return None
+
+
+def record_source_fingerprint(repository, template, fingerprint):
+    """
+    write the fingerprint next to a freshly exported template, with the sizes of the files its OVF references
+    (the descriptor and manifest themselves are left out: scrubbing rewrites them)
+    :return: SourceFingerprint as written
+    """
+    template_path = os.path.join(repository, template)
+    envelope = load_ovf_envelope(os.path.join(template_path, f'{template}.ovf'))
+    fingerprint.files = {}
+    for f in envelope.files.values():
+        file_path = os.path.join(template_path, f.href)
+        if os.path.isfile(file_path):
+            fingerprint.files[f.href] = os.path.getsize(file_path)
+    fingerprint.recorded_at = time.time()
+    path = source_fingerprint_path(repository, template)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(fingerprint.to_dict(), f, indent=2)
+    os.replace(path + '.tmp', path)
+    return fingerprint
+
+
+def local_copy_problems(repository, template, fingerprint):
+    """
+    :return: list of reasons the local copy is not what the fingerprint says was exported (empty if it is)
+    """
+    template_path = os.path.join(repository, template)
+    if not os.path.isfile(os.path.join(template_path, f'{template}.ovf')):
+        return ['no OVF']
+    if not fingerprint.files:
+        return ['no files recorded']
+    problems = []
+    for file_name, size in fingerprint.files.items():
+        file_path = os.path.join(template_path, file_name)
+        if not os.path.isfile(file_path):
+            problems.append(f'{file_name} missing')
+        elif os.path.getsize(file_path) != size:
+            problems.append(f'{file_name} is {os.path.getsize(file_path)} bytes, not {size}')
+    return problems
+
+
+def decide_export(repository, template, current):
+    """
+    skip, incremental or full, from the catalog item's current fingerprint (one query) and the local copy
+    :param current: SourceFingerprint.from_catalog_record of the source as it is now
+    :return: (decision, reason)
+    """
+    if not os.path.isfile(os.path.join(repository, template, f'{template}.ovf')):
+        return DECISION_FULL, 'no local copy'
+    recorded = read_source_fingerprint(repository, template)
+    if recorded is None:
+        return DECISION_INCREMENTAL, 'the local copy has no source fingerprint'
+    if not recorded.same_source(current):
+        return DECISION_INCREMENTAL, f'the source changed ({recorded.entity_href} {recorded.created} -> ' \
+                                     f'{current.entity_href} {current.created})'
+    problems = local_copy_problems(repository, template, recorded)
+    if problems:
+        return DECISION_INCREMENTAL, f"the local copy is incomplete: {'; '.join(problems[:3])}"
+    return DECISION_SKIP, f'unchanged since {time.ctime(recorded.recorded_at)}'
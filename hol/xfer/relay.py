@@ -0,0 +1,323 @@
+import os
+import time
+import queue
+import shutil
+import hashlib
+import logging
+import threading
+import requests
+from hol.ovf import parse_ovf_envelope, apply_scrub_rules, default_scrub_rules, ScrubReport, \
+    BYTES_PER_MB, BYTES_PER_GB
+from hol.xfer import replace_in_library
+from hol.xfer.vcd import VcdRestError, VCD_REQUEST_TIMEOUT, VCD_DOWNLOAD_BLOCK_SIZE
+from hol.xfer.export import write_manifest, export_staging_path
+
+# the range size of each PUT on the target (the same as the pyvcloud import)
+RELAY_FRAGMENT_SIZE = 50 * BYTES_PER_MB
+# bytes read from the source but not yet uploaded, per file: bounds memory, and how far the source may run ahead
+RELAY_BUFFER_SIZE = 512 * BYTES_PER_MB
+# how long a full buffer waits for the uploader before checking whether the relay was abandoned
+RELAY_PUT_POLL_SECONDS = 1
+# a dropped source download is re-opened from the next unread byte this many times in a row (without progress)
+RELAY_SOURCE_RETRIES = 5
+# wait before re-opening the source, multiplied by the attempt number
+RELAY_SOURCE_RETRY_SECONDS = 10
+
+logging.basicConfig(level=logging.INFO)
+
+
+class RelayFile:
+    """
+    one file of the template and what the relay did with it
+    """
+    __slots__ = ('href', 'size', 'relayed_bytes', 'digest', 'first_byte_seconds', 'seconds')
+
+    def __init__(self, href, size):
+        self.href = href
+        self.size = size
+        self.relayed_bytes = 0
+        # sha256 of the bytes relayed (only computed when they are also written to the library)
+        self.digest = None
+        self.first_byte_seconds = None
+        self.seconds = None
+
+    def to_dict(self):
+        return {'href': self.href, 'size': self.size, 'relayed_bytes': self.relayed_bytes, 'digest': self.digest,
+                'first_byte_seconds': self.first_byte_seconds, 'seconds': self.seconds}
+
+
+class RelayBuffer:
+    """
+    bounded queue of fragments between the thread reading a source transfer URI and the uploader: the reader
+    blocks once max_bytes are waiting, so memory stays bounded however far apart the two transfer rates are
+    """
+
+    _END = object()
+
+    def __init__(self, max_bytes=RELAY_BUFFER_SIZE, fragment_size=RELAY_FRAGMENT_SIZE):
+        self.fragment_size = fragment_size
+        self._queue = queue.Queue(maxsize=max(1, max_bytes // fragment_size))
+        self._abandoned = threading.Event()
+        self._error = None
+
+    def put(self, fragment):
+        """
+        :return: False if the consumer went away (stop reading)
+        """
+        while not self._abandoned.is_set():
+            try:
+                self._queue.put(fragment, timeout=RELAY_PUT_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self, error=None):
+        """
+        end of the stream, or the exception the reader failed with (raised to the consumer)
+        """
+        self._error = error
+        self.put(self._END)
+
+    def abandon(self):
+        """
+        the consumer gives up: unblock the reader
+        """
+        self._abandoned.set()
+
+    def wait_abandoned(self, timeout):
+        """
+        sleep up to timeout seconds, unless the consumer gives up first
+        :return: True if it did
+        """
+        return self._abandoned.wait(timeout)
+
+    def __iter__(self):
+        while True:
+            fragment = self._queue.get()
+            if fragment is self._END:
+                if self._error is not None:
+                    raise self._error
+                return
+            yield fragment
+
+
+def open_source(session, source_url, offset=0):
+    """
+    GET a source transfer URI, from offset on (a Range request) when resuming
+    :return: streaming requests.Response
+    """
+    headers = {'Range': f'bytes={offset}-'} if offset else None
+    response = session.http.get(source_url, headers=headers, stream=True, timeout=VCD_REQUEST_TIMEOUT)
+    if offset and response.status_code == 200:
+        response.close()
+        raise VcdRestError('GET', source_url, 200, f'Range request ignored, unable to resume at byte {offset}')
+    if response.status_code != (206 if offset else 200):
+        response.close()
+        raise VcdRestError('GET', source_url, response.status_code, response.text)
+    return response
+
+
+def read_into_buffer(session, source_url, response, buffer, size, tee_file=None, file_hash=None):
+    """
+    reader thread: cut a streaming source response into buffer.fragment_size fragments, writing each block to
+    the tee file (and hash) on the way. If the source connection drops, the GET is re-opened from the next unread
+    byte, so the upload, tee file and hash still see every byte once and in order.
+    :param response: the open response for the start of the file (see open_source)
+    :param size: bytes in the file
+    """
+    offset = 0
+    retries = 0
+    pending = bytearray()
+    try:
+        while True:
+            try:
+                if response is None:
+                    response = open_source(session, source_url, offset)
+                for block in response.iter_content(chunk_size=VCD_DOWNLOAD_BLOCK_SIZE):
+                    if tee_file is not None:
+                        tee_file.write(block)
+                    if file_hash is not None:
+                        file_hash.update(block)
+                    offset += len(block)
+                    retries = 0
+                    pending += block
+                    if len(pending) >= buffer.fragment_size:
+                        if not buffer.put(bytes(pending[:buffer.fragment_size])):
+                            return
+                        del pending[:buffer.fragment_size]
+                if offset >= size:
+                    break
+                raise requests.ConnectionError(f'the source stopped at byte {offset} of {size}')
+            except (requests.RequestException, VcdRestError) as e:
+                # an error status (other than 5xx) will not go away by asking again
+                if retries >= RELAY_SOURCE_RETRIES or (isinstance(e, VcdRestError) and e.status_code < 500):
+                    raise
+                retries += 1
+                logging.warning(f'{source_url}: {e}; resuming at byte {offset} ({retries}/{RELAY_SOURCE_RETRIES})')
+                if buffer.wait_abandoned(RELAY_SOURCE_RETRY_SECONDS * retries):
+                    return
+            finally:
+                if response is not None:
+                    response.close()
+                    response = None
+        if pending and not buffer.put(bytes(pending)):
+            return
+        buffer.close()
+    except Exception as e:
+        buffer.close(e)
+
+
+def scrub_descriptor(descriptor, name):
+    """
+    apply the default scrub rules to a descriptor in memory
+    :return: (bytes, ScrubReport)
+    """
+    envelope = parse_ovf_envelope(descriptor)
+    report = apply_scrub_rules(envelope, default_scrub_rules(), ScrubReport(name, verbose=False))
+    return envelope.serialize(), report
+
+
+def relay_file(session, source_url, target_org, target_uri, relay, buffer_size=RELAY_BUFFER_SIZE,
+               fragment_size=RELAY_FRAGMENT_SIZE, tee_path=None, progress_callback=None):
+    """
+    stream one file from a source transfer URI to a target upload URI through a RelayBuffer
+    :param session: logged-in VcdSession on the source cloud
+    :param target_org: pyvcloud Org on the target cloud (upload_stream)
+    :param relay: RelayFile, updated with what was relayed
+    :param tee_path: also write the bytes there (and compute their sha256)
+    :param progress_callback: function(bytes_uploaded)
+    :return: bytes uploaded
+    """
+    start = time.monotonic()
+    response = open_source(session, source_url)
+    if relay.size is None:
+        content_length = response.headers.get('Content-Length')
+        if content_length is None:
+            response.close()
+            raise VcdRestError('GET', source_url, 500, 'size unknown: not in the descriptor nor the response')
+        relay.size = int(content_length)
+
+    buffer = RelayBuffer(buffer_size, fragment_size)
+    tee_file = open(tee_path, 'wb') if tee_path else None
+    file_hash = hashlib.sha256() if tee_path else None
+    reader = threading.Thread(target=read_into_buffer,
+                              args=(session, source_url, response, buffer, relay.size, tee_file, file_hash),
+                              name=f'relay-{relay.href}', daemon=True)
+    reader.start()
+
+    def on_progress(uploaded, total):
+        if relay.first_byte_seconds is None:
+            relay.first_byte_seconds = time.monotonic() - start
+            logging.info(f'{relay.href}: first range on the target after {relay.first_byte_seconds:.1f} s')
+        if progress_callback is not None:
+            progress_callback(uploaded - relay.relayed_bytes)
+        relay.relayed_bytes = uploaded
+
+    try:
+        uploaded = target_org.upload_stream(buffer, target_uri, relay.size, name=relay.href, callback=on_progress)
+    except BaseException:
+        buffer.abandon()
+        raise
+    finally:
+        reader.join()
+        if tee_file is not None:
+            tee_file.close()
+    if uploaded != relay.size:
+        raise VcdRestError('GET', source_url, 500, f'relayed {uploaded} of {relay.size} bytes')
+    relay.digest = file_hash.hexdigest() if file_hash is not None else None
+    relay.seconds = time.monotonic() - start
+    return uploaded
+
+
+def delete_target_item(target_org, target_catalog, item_name):
+    """
+    remove the catalog item of a failed relay from the target, so a retry does not find a half-uploaded template
+    """
+    try:
+        target_org.delete_catalog_item(target_catalog, item_name)
+        logging.info(f'deleted the partial {item_name} from {target_catalog} on the target')
+    # whatever pyvcloud raises: the relay error is the one to report
+    except Exception as e:
+        logging.error(f'unable to delete the partial {item_name} from {target_catalog} on the target: {e}')
+
+
+def relay_template(session, cloud_catalog, vapp_template_name, target_org, target_catalog, item_name=None,
+                   description='', scrub=True, buffer_size=RELAY_BUFFER_SIZE, fragment_size=RELAY_FRAGMENT_SIZE,
+                   tee_repository=None, digest_cache=None, progress_callback=None):
+    """
+    copy a vApp template from one cloud to another without staging it on disk: the descriptor is read from the
+    source transfer area (and scrubbed in memory), the target catalog item is created from it, then each file is
+    streamed from the source straight into upload ranges on the target, one file at a time
+    :param session: logged-in VcdSession on the source cloud
+    :param cloud_catalog: source catalog name
+    :param target_org: pyvcloud Org on the target cloud (create_ovf_upload, upload_stream)
+    :param item_name: name of the new catalog item (default: the template name)
+    :param scrub: apply the default scrub rules to the descriptor uploaded to the target
+    :param buffer_size: bytes held in memory per file between the download and the upload
+    :param fragment_size: bytes per upload range
+    :param tee_repository: also write the template (as exported: the source descriptor, plus a manifest) to this
+        library; it is assembled in .staging (export_staging_path) and swapped in once complete
+    :param digest_cache: DigestCache of that library, given the digests computed on the way through
+    :param progress_callback: function(bytes_uploaded)
+    :return: (list of RelayFile, ScrubReport or None), or None if the catalog item does not exist
+    :raises: whatever stopped the relay, once the partial target catalog item and tee copy are removed
+    """
+    catalog_item = session.find_catalog_item(cloud_catalog, vapp_template_name)
+    if catalog_item is None:
+        return None
+    descriptor_href = session.enable_download(catalog_item['entity'])
+    descriptor = session.get(descriptor_href, accept='*/*').content
+    transfer_base = descriptor_href.rsplit('/', 1)[0] + '/'
+
+    report = None
+    upload_descriptor = descriptor
+    if scrub:
+        upload_descriptor, report = scrub_descriptor(descriptor, f'{vapp_template_name}.ovf')
+        logging.info(f'{vapp_template_name}: {len(report.changes)} scrub change(s) made in memory')
+
+    relays = [RelayFile(f.href, int(f.size) if f.size else None)
+              for f in parse_ovf_envelope(descriptor).files.values()]
+    total_bytes = sum(r.size or 0 for r in relays)
+    logging.info(f'{vapp_template_name}: relaying {len(relays)} file(s), {total_bytes / BYTES_PER_GB:.2f} GB, '
+                 f'{buffer_size / BYTES_PER_MB:.0f} MB buffer')
+
+    item_name = item_name or vapp_template_name
+    staging_path = None
+    if tee_repository is not None:
+        staging_path = export_staging_path(tee_repository, vapp_template_name)
+        os.makedirs(staging_path)
+    item_created = False
+    try:
+        upload_uris = target_org.create_ovf_upload(target_catalog, upload_descriptor, item_name, description)
+        item_created = True
+        for relay in relays:
+            target_uri = upload_uris.get(relay.href)
+            if target_uri is None:
+                raise VcdRestError('PUT', relay.href, 404, 'no upload URI on the target')
+            tee_path = None
+            if staging_path is not None:
+                tee_path = os.path.join(staging_path, relay.href)
+                os.makedirs(os.path.dirname(tee_path), exist_ok=True)
+            relay_file(session, transfer_base + relay.href, target_org, target_uri, relay, buffer_size,
+                       fragment_size, tee_path, progress_callback)
+            logging.info(f'{relay.href}: {relay.relayed_bytes / BYTES_PER_GB:.2f} GB in {relay.seconds:.0f} s')
+        if staging_path is not None:
+            ovf_name = f'{vapp_template_name}.ovf'
+            with open(os.path.join(staging_path, ovf_name), 'wb') as f:
+                f.write(descriptor)
+            digests = {relay.href: relay.digest for relay in relays}
+            digests[ovf_name] = hashlib.sha256(descriptor).hexdigest()
+            write_manifest(os.path.join(staging_path, f'{vapp_template_name}.mf'), digests)
+            template_path = os.path.join(tee_repository, vapp_template_name)
+            replace_in_library(tee_repository, staging_path, template_path)
+            if digest_cache is not None:
+                for name, digest in digests.items():
+                    digest_cache.store(os.path.join(template_path, name), digest)
+    except BaseException:
+        if item_created:
+            delete_target_item(target_org, target_catalog, item_name)
+        if staging_path is not None:
+            shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+    return relays, report
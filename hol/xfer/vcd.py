@@ -0,0 +1,298 @@
+import logging
+import threading
+import time
+import xml.etree.ElementTree as ET
+import requests
+from hol.ovf import parse_ovf_envelope, get_ovf_size_estimate, VCLOUD_NS
+from hol.xfer import get_cloud_creds
+
+# the same API version the pyvcloud-based import pins to
+VCD_API_VERSION = '37.0'
+VCD_REQUEST_TIMEOUT = 120
+# VCD drops idle sessions after 30 minutes by default: log in again before that
+VCD_SESSION_MAX_IDLE = 20 * 60
+# enabling a template for download copies it to the transfer spool: allow for big ones
+VCD_TASK_TIMEOUT = 4 * 3600
+VCD_TASK_POLL_SECONDS = 5
+VCD_DOWNLOAD_BLOCK_SIZE = 8 * 2 ** 20
+
+
+class VcdRestError(Exception):
+    """
+    a VCD REST call returned an error status
+    """
+
+    def __init__(self, method, url, status_code, text=''):
+        super().__init__(f'{method} {url} returned {status_code}: {text[:200]}')
+        self.status_code = status_code
+
+
+class VcdSession:
+    """
+    minimal VCD REST session (login, GET, logout) for the lookups the transfer scripts make before
+    handing the heavy lifting to ovftool / pyvcloud
+    """
+
+    def __init__(self, cloud_host, cloud_org, user_name, password, api_version=VCD_API_VERSION, verify=True):
+        self.base_url = f'https://{cloud_host}'
+        self.cloud_org = cloud_org
+        self.api_version = api_version
+        self.http = requests.Session()
+        self.http.verify = verify
+        self._user_name = user_name
+        self._password = password
+
+    def __enter__(self):
+        self.login()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.logout()
+
+    def login(self):
+        response = self.http.post(f'{self.base_url}/api/sessions',
+                                  auth=(f'{self._user_name}@{self.cloud_org}', self._password),
+                                  headers={'Accept': f'application/*+xml;version={self.api_version}'},
+                                  timeout=VCD_REQUEST_TIMEOUT)
+        if response.status_code != 200:
+            raise VcdRestError('POST', '/api/sessions', response.status_code, response.text)
+        token = response.headers.get('X-VMWARE-VCLOUD-ACCESS-TOKEN')
+        if token:
+            self.http.headers['Authorization'] = f'Bearer {token}'
+        else:
+            self.http.headers['x-vcloud-authorization'] = response.headers['x-vcloud-authorization']
+
+    def logout(self):
+        try:
+            self.http.delete(f'{self.base_url}/api/session', timeout=VCD_REQUEST_TIMEOUT,
+                             headers={'Accept': f'application/*+xml;version={self.api_version}'})
+        except requests.RequestException as e:
+            logging.debug(f'VCD logout failed: {e}')
+        self.http.close()
+
+    def get(self, url, accept='application/*+xml', params=None, headers=None, stream=False):
+        """
+        :param url: full href or a path below the host, e.g. /api/query
+        :param accept: media type (the API version is appended)
+        :return: requests.Response (2xx only)
+        """
+        if url.startswith('/'):
+            url = f'{self.base_url}{url}'
+        request_headers = {'Accept': f'{accept};version={self.api_version}'}
+        if headers:
+            request_headers.update(headers)
+        response = self.http.get(url, params=params, headers=request_headers, stream=stream,
+                                 timeout=VCD_REQUEST_TIMEOUT)
+        if not 200 <= response.status_code < 300:
+            raise VcdRestError('GET', url, response.status_code, response.text)
+        return response
+
+    def post(self, url, content_type=None, data=None, accept='application/*+xml'):
+        """
+        :param url: full href or a path below the host
+        :return: requests.Response (2xx only)
+        """
+        if url.startswith('/'):
+            url = f'{self.base_url}{url}'
+        request_headers = {'Accept': f'{accept};version={self.api_version}'}
+        if content_type:
+            request_headers['Content-Type'] = content_type
+        response = self.http.post(url, data=data, headers=request_headers, timeout=VCD_REQUEST_TIMEOUT)
+        if not 200 <= response.status_code < 300:
+            raise VcdRestError('POST', url, response.status_code, response.text)
+        return response
+
+    def wait_for_task(self, task, timeout=VCD_TASK_TIMEOUT):
+        """
+        :param task: the Task element a call returned
+        :return: None once the task succeeded
+        :raises VcdRestError: if it failed, was aborted or did not finish within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            status = task.get('status')
+            if status == 'success':
+                return
+            if status in ('error', 'canceled', 'aborted'):
+                error = task.find(f'{{{VCLOUD_NS}}}Error')
+                message = error.get('message') if error is not None else status
+                raise VcdRestError('TASK', task.get('href'), 500, f"{task.get('operationName')}: {message}")
+            if time.monotonic() > deadline:
+                raise VcdRestError('TASK', task.get('href'), 408, f"{task.get('operationName')} still {status}")
+            time.sleep(VCD_TASK_POLL_SECONDS)
+            task = ET.fromstring(self.get(task.get('href')).content)
+
+    def get_entity(self, href):
+        """
+        :return: the entity's XML root element
+        """
+        return ET.fromstring(self.get(href).content)
+
+    def enable_download(self, vapp_template_href):
+        """
+        have VCD stage a vApp template for download (unless it already is)
+        :return: href of the OVF descriptor in the transfer area; the files are next to it
+        """
+        for attempt in (1, 2):
+            root = self.get_entity(vapp_template_href)
+            for link in root.findall(f'{{{VCLOUD_NS}}}Link'):
+                if link.get('rel') == 'download:default':
+                    return link.get('href')
+            if attempt == 1:
+                logging.info(f'enabling {root.get("name")} for download')
+                self.wait_for_task(ET.fromstring(self.post(f'{vapp_template_href}/action/enableDownload').content))
+        raise VcdRestError('GET', vapp_template_href, 404, 'no download link after enableDownload')
+
+    def read_range(self, url, offset, length):
+        """
+        :return: bytes at offset in a transfer file, or None if the transfer service ignores range requests
+        """
+        response = self.http.get(url, headers={'Range': f'bytes={offset}-{offset + length - 1}'}, stream=True,
+                                 timeout=VCD_REQUEST_TIMEOUT)
+        try:
+            if response.status_code == 200:
+                return None
+            if response.status_code != 206:
+                raise VcdRestError('GET', url, response.status_code, response.text)
+            return response.content
+        finally:
+            response.close()
+
+    def download(self, url, target_file, progress_callback=None):
+        """
+        stream a transfer file to disk
+        :param progress_callback: function(bytes_written)
+        :return: bytes written
+        """
+        written = 0
+        with self.http.get(url, stream=True, timeout=VCD_REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                raise VcdRestError('GET', url, response.status_code, response.text)
+            with open(target_file, 'wb') as f:
+                for block in response.iter_content(chunk_size=VCD_DOWNLOAD_BLOCK_SIZE):
+                    f.write(block)
+                    written += len(block)
+                    if progress_callback is not None:
+                        progress_callback(len(block))
+        return written
+
+    def query_records(self, query_type, query_filter):
+        """
+        :param query_type: e.g. 'catalogItem', 'vAppTemplate'
+        :param query_filter: FIQL filter, e.g. 'name==X;catalogName==Y'
+        :return: list of dicts of the record attributes
+        """
+        response = self.get('/api/query', params={'type': query_type, 'format': 'records',
+                                                  'filter': query_filter, 'pageSize': 128})
+        root = ET.fromstring(response.content)
+        return [dict(record.attrib) for record in root if record.tag.endswith('Record')]
+
+    def find_catalog_item(self, cloud_catalog, item_name):
+        """
+        :return: dict of the catalogItem query record (href, entity, ...) or None
+        """
+        records = self.query_records('catalogItem', f'name=={item_name};catalogName=={cloud_catalog}')
+        return records[0] if records else None
+
+    def get_catalog_item_size(self, catalog_item):
+        """
+        :param catalog_item: record from find_catalog_item
+        :return: the catalog item's size attribute in bytes, or None
+        """
+        root = ET.fromstring(self.get(catalog_item['href']).content)
+        size = root.get('size')
+        return int(size) if size else None
+
+    def get_ovf_descriptor(self, vapp_template_href):
+        """
+        :param vapp_template_href: href of the vAppTemplate entity
+        :return: bytes -- the OVF descriptor VCD would export
+        """
+        return self.get(f'{vapp_template_href}/ovf', accept='*/*').content
+
+
+class VcdSessionPool:
+    """
+    warm VcdSessions per (cloud host, org), for long-running processes (the hol-xfer daemon) that make many
+    small VCD calls: one login per cloud/org instead of one per job. Sessions idle for longer than max_idle
+    are replaced, as is a session whose call fails with 401.
+    """
+
+    def __init__(self, credentials, max_idle=VCD_SESSION_MAX_IDLE):
+        """
+        :param credentials: the dictionary from hol.xfer.read_hol_xfer_auth
+        :param max_idle: seconds a session may sit unused before it is logged out and replaced
+        """
+        self.credentials = credentials
+        self.max_idle = max_idle
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self, cloud_host, cloud_org):
+        user_name, password = get_cloud_creds(self.credentials, cloud_host, cloud_org)
+        session = VcdSession(cloud_host, cloud_org, user_name, password)
+        session.login()
+        logging.info(f'logged in to {cloud_host}/{cloud_org}')
+        return session
+
+    def call(self, cloud_host, cloud_org, fn):
+        """
+        run fn(session) with the warm session for cloud_host/cloud_org (serialized per session), logging in
+        again once if VCD says the session is gone
+        :return: whatever fn returns
+        """
+        key = (cloud_host, cloud_org)
+        with self._lock:
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = self._sessions[key] = {'session': None, 'last_used': 0, 'lock': threading.Lock()}
+        with entry['lock']:
+            if entry['session'] is not None and time.monotonic() - entry['last_used'] > self.max_idle:
+                entry['session'].logout()
+                entry['session'] = None
+            for attempt in (1, 2):
+                if entry['session'] is None:
+                    entry['session'] = self._new_session(cloud_host, cloud_org)
+                try:
+                    result = fn(entry['session'])
+                    entry['last_used'] = time.monotonic()
+                    return result
+                except VcdRestError as e:
+                    if e.status_code != 401 or attempt == 2:
+                        raise
+                    logging.info(f'session for {cloud_host}/{cloud_org} expired, logging in again')
+                    entry['session'] = None
+
+    def close(self):
+        with self._lock:
+            for entry in self._sessions.values():
+                if entry['session'] is not None:
+                    entry['session'].logout()
+            self._sessions.clear()
+
+
+def estimate_vcd_template_size(session, cloud_catalog, vapp_template_name):
+    """
+    estimate how much space an export of a vApp template will need, before starting it: the References ovf:size
+    totals from the template's descriptor, else the catalog item size
+    :param session: logged-in VcdSession
+    :param cloud_catalog: catalog name
+    :param vapp_template_name: template (catalog item) name
+    :return: (int bytes or None, str -- where the number came from)
+    """
+    catalog_item = session.find_catalog_item(cloud_catalog, vapp_template_name)
+    if catalog_item is None:
+        return None, 'not found'
+    try:
+        envelope = parse_ovf_envelope(session.get_ovf_descriptor(catalog_item['entity']))
+        size_bytes, exact = get_ovf_size_estimate(envelope)
+        if size_bytes and exact:
+            return size_bytes, 'descriptor'
+    except (VcdRestError, ET.ParseError) as e:
+        logging.warning(f'unable to read the descriptor of {vapp_template_name}: {e}')
+        size_bytes = None
+    catalog_size = session.get_catalog_item_size(catalog_item)
+    if catalog_size:
+        return catalog_size, 'catalog'
+    # capacities: an upper bound, but better than nothing
+    return size_bytes, 'capacity' if size_bytes else 'unknown'
@@ -15,6 +15,9 @@
 
 # August 2, 2025 - Doug Baer patched logout() to prevent failure during new cloudapi call
 
+# October 2026 - upload_fragment() retries with exponential backoff and jitter, classifies failures
+# (throttling vs. network vs. fatal) and tracks a per-transfer retry budget (UploadRetryPolicy)
+
 from datetime import datetime
 from datetime import timedelta
 from enum import Enum
@@ -22,6 +25,7 @@ import json
 import logging
 import logging.handlers as handlers
 from pathlib import Path
+import random
 import sys
 import time
 import urllib
@@ -609,6 +613,191 @@ class VAppPowerStatus(Enum):
     UNDEPLOYED = '1'
 
 
+class UploadErrorClass(Enum):
+    THROTTLE = 'throttle'
+    TRANSIENT = 'transient'
+    NETWORK = 'network'
+    FATAL = 'fatal'
+
+
+class UploadFragmentFatalException(VcdException):
+    """Raised when vCD rejects an upload fragment with a non-retryable status.
+
+    :param int status_code: HTTP status returned by the transfer service.
+    :param str range_str: the Content-Range of the rejected fragment.
+    :param str request_id: vCD request id of the failed PUT, if any.
+    """
+
+    def __init__(self, status_code, range_str, request_id=None):
+        self.status_code = status_code
+        self.range_str = range_str
+        self.request_id = request_id
+
+    def __str__(self):
+        return 'Upload of range %s failed with fatal status %s ' \
+               '(request id: %s)' % (self.range_str, self.status_code,
+                                     self.request_id)
+
+
+class UploadRetriesExhaustedException(VcdException):
+    """Raised when an upload fragment keeps failing with retryable errors.
+
+    Either the per-fragment attempt limit or the per-transfer retry budget
+    of the UploadRetryPolicy has been used up.
+
+    :param str range_str: the Content-Range of the failed fragment.
+    :param UploadErrorClass error_class: class of the last failure.
+    :param last_error: status code or exception of the last failure.
+    """
+
+    def __init__(self, range_str, error_class, last_error):
+        self.range_str = range_str
+        self.error_class = error_class
+        self.last_error = last_error
+
+    def __str__(self):
+        return 'Upload of range %s failed after exhausting retries ' \
+               '(last failure: %s, %s)' % (self.range_str,
+                                           self.error_class.value,
+                                           self.last_error)
+
+
+class UploadRetryPolicy(object):
+    """Retry policy for Client.upload_fragment().
+
+    One instance is meant to cover one file transfer: the retry budget is
+    shared by every fragment of that transfer, so a server that keeps pushing
+    back eventually fails the upload instead of being hammered forever.
+
+    Failures are classified as:
+        - THROTTLE: the transfer service asks us to slow down (416, 429,
+          503). Backs off from throttle_base_delay and honours Retry-After.
+        - TRANSIENT: other 5xx responses worth another try.
+        - NETWORK: connection resets and timeouts raised by requests.
+        - FATAL: everything else (auth, not found, bad request...). Never
+          retried, raises UploadFragmentFatalException.
+
+    Delays use exponential backoff with "full jitter": a random value
+    between 0 and min(max_delay, base * 2 ** (attempt - 1)).
+
+    :param int max_attempts: attempts per fragment, including the first one.
+    :param int retry_budget: retries allowed for the whole transfer.
+    :param float base_delay: initial backoff for TRANSIENT/NETWORK failures.
+    :param float throttle_base_delay: initial backoff for THROTTLE failures.
+    :param float max_delay: cap for a single backoff, in seconds.
+    :param random.Random rng: source of jitter (for deterministic tests).
+    """
+
+    THROTTLE_STATUS_CODES = (416, 429, 503)
+    TRANSIENT_STATUS_CODES = (500, 502, 504)
+
+    def __init__(self,
+                 max_attempts=8,
+                 retry_budget=64,
+                 base_delay=0.5,
+                 throttle_base_delay=2.0,
+                 max_delay=60.0,
+                 rng=None):
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget
+        self.base_delay = base_delay
+        self.throttle_base_delay = throttle_base_delay
+        self.max_delay = max_delay
+        self._rng = rng if rng is not None else random.Random()
+        self.retry_counts = {c: 0 for c in UploadErrorClass}
+        self.fragments = 0
+        self.total_backoff_sec = 0.0
+
+    @property
+    def retries_used(self):
+        return sum(self.retry_counts.values())
+
+    @property
+    def retries_remaining(self):
+        return max(0, self.retry_budget - self.retries_used)
+
+    def classify(self, status_code=None, exception=None):
+        """Classify a failed fragment upload.
+
+        :param int status_code: HTTP status of the response, if one arrived.
+        :param Exception exception: exception raised by requests, if any.
+
+        :return: the class of the failure.
+
+        :rtype: UploadErrorClass
+        """
+        if exception is not None:
+            if isinstance(exception, (requests.exceptions.ConnectionError,
+                                      requests.exceptions.Timeout,
+                                      requests.exceptions.ChunkedEncodingError)):
+                return UploadErrorClass.NETWORK
+            return UploadErrorClass.FATAL
+        if status_code in self.THROTTLE_STATUS_CODES:
+            return UploadErrorClass.THROTTLE
+        if status_code in self.TRANSIENT_STATUS_CODES:
+            return UploadErrorClass.TRANSIENT
+        return UploadErrorClass.FATAL
+
+    def should_retry(self, error_class, attempt):
+        """Decide if another attempt is allowed and charge the budget.
+
+        :param UploadErrorClass error_class: class of the last failure.
+        :param int attempt: number of the attempt that just failed (1-based).
+
+        :return: True if the fragment should be retried.
+
+        :rtype: bool
+        """
+        if error_class == UploadErrorClass.FATAL:
+            return False
+        if attempt >= self.max_attempts or self.retries_remaining == 0:
+            return False
+        self.retry_counts[error_class] += 1
+        return True
+
+    def backoff(self, error_class, attempt, retry_after=None):
+        """Compute how long to wait before the next attempt.
+
+        :param UploadErrorClass error_class: class of the last failure.
+        :param int attempt: number of the attempt that just failed (1-based).
+        :param str retry_after: value of the Retry-After header, if any.
+
+        :return: delay in seconds.
+
+        :rtype: float
+        """
+        if error_class == UploadErrorClass.THROTTLE:
+            base = self.throttle_base_delay
+        else:
+            base = self.base_delay
+        ceiling = min(self.max_delay, base * (2 ** (attempt - 1)))
+        delay = self._rng.uniform(0, ceiling)
+        if retry_after is not None:
+            try:
+                delay = max(delay, min(self.max_delay, float(retry_after)))
+            except ValueError:
+                # HTTP-date form of Retry-After, not worth parsing here
+                pass
+        self.total_backoff_sec += delay
+        return delay
+
+    def metrics(self):
+        """Retry counters for this transfer.
+
+        :return: fragments sent, retries per error class, budget left and
+            total time spent backing off.
+
+        :rtype: dict
+        """
+        result = {'fragments': self.fragments,
+                  'retries': self.retries_used,
+                  'retry_budget_remaining': self.retries_remaining,
+                  'backoff_sec': round(self.total_backoff_sec, 3)}
+        for error_class, count in self.retry_counts.items():
+            result[f'retries_{error_class.value}'] = count
+        return result
+
+
 class _TaskMonitor(object):
     _DEFAULT_POLL_SEC = 5
     _DEFAULT_TIMEOUT_SEC = 600
@@ -772,7 +961,8 @@ class Client(object):
         _HEADER_X_VMWARE_CLOUD_ACCESS_TOKEN_NAME
     ]
 
-    _UPLOAD_FRAGMENT_MAX_RETRIES = 5
+    _UPLOAD_FRAGMENT_MAX_RETRIES = 8
+    _UPLOAD_TRANSFER_RETRY_BUDGET = 64
 
     def _prep_base_uri(self, uri, is_cloudapi=False):
         result = uri
@@ -1410,17 +1600,65 @@ class Client(object):
 
         return response
 
-    def upload_fragment(self, uri, contents, range_str):
+    def new_upload_retry_policy(self):
+        """Create the retry policy for one file transfer.
+
+        :return: a policy with this client's attempt limit and retry budget.
+
+        :rtype: UploadRetryPolicy
+        """
+        return UploadRetryPolicy(
+            max_attempts=self._UPLOAD_FRAGMENT_MAX_RETRIES,
+            retry_budget=self._UPLOAD_TRANSFER_RETRY_BUDGET)
+
+    def report_upload_retry_metrics(self, name, retry_policy):
+        """Log the retry counters of a finished transfer.
+
+        :param str name: name of the uploaded file.
+        :param UploadRetryPolicy retry_policy: the policy used for it.
+        """
+        metrics = retry_policy.metrics()
+        line = ' '.join('%s=%s' % (k, v) for k, v in metrics.items())
+        if metrics['retries'] > 0:
+            self._logger.info('upload_retry_metrics file=%s %s' % (name, line))
+        else:
+            self._logger.debug('upload_retry_metrics file=%s %s' % (name, line))
+
+    def upload_fragment(self, uri, contents, range_str, retry_policy=None):
+        """Upload one byte range of a file to a vCD transfer URI.
+
+        :param str uri: the transfer URI of the file.
+        :param bytes contents: the bytes of this range.
+        :param str range_str: value of the Content-Range header.
+        :param UploadRetryPolicy retry_policy: policy shared by all fragments
+            of the transfer. A new one (with its own budget) is used if None.
+
+        :return: the response of the successful PUT.
+
+        :rtype: requests.Response
+
+        :raises UploadFragmentFatalException: on a non-retryable status.
+        :raises UploadRetriesExhaustedException: if retries or the retry
+            budget ran out.
+        """
+        if retry_policy is None:
+            retry_policy = self.new_upload_retry_policy()
+        retry_policy.fragments += 1
+
         headers = {}
         headers[self._HEADER_CONTENT_RANGE_NAME] = range_str
         headers[self._HEADER_CONTENT_LENGTH_NAME] = str(len(contents))
         data = contents
 
         # If we pump data too fast, server can reply back with statuses other
-        # than 200 e.g. 416. As counter measure, on receiving non 200 status,
-        # we will retry the upload for a fixed number of times. If all the
-        # retry efforts fail, we will fail the upload completely and return.
-        for attempt in range(1, self._UPLOAD_FRAGMENT_MAX_RETRIES + 1):
+        # than 200 e.g. 416. Retrying immediately only makes the congestion
+        # worse, so throttling and transient failures back off (with jitter)
+        # before the next attempt, and fatal statuses fail the upload at once.
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            retry_after = None
             try:
                 self._log_request_sent(method='PUT', uri=uri, headers=headers)
                 response = self._session.put(
@@ -1429,23 +1667,39 @@ class Client(object):
                     headers=headers,
                     verify=self._verify_ssl_certs)
                 self._log_request_response(response)
-
+            except requests.exceptions.RequestException as e:
+                error_class = retry_policy.classify(exception=e)
+                last_error = e
+                if error_class == UploadErrorClass.FATAL:
+                    raise
+            else:
                 sc = response.status_code
-                if sc != 200:
-                    self._response_code_to_exception(sc, None, response)
-                else:
+                if sc == 200:
                     return response
-            except VcdResponseException:
-                # retry if not the last attempt
-                if attempt < self._UPLOAD_FRAGMENT_MAX_RETRIES:
-                    self._logger.debug(
-                        'Failure: attempt#%s to upload data in '
-                        'range %s failed. Retrying.' % (attempt, range_str))
-                    continue
-                else:
+                error_class = retry_policy.classify(status_code=sc)
+                last_error = sc
+                retry_after = response.headers.get('Retry-After')
+                if error_class == UploadErrorClass.FATAL:
                     self._logger.error(
-                        'Reached max retry limit. Failing upload.')
-                    raise
+                        'Fatal status %s uploading range %s. Failing upload.'
+                        % (sc, range_str))
+                    raise UploadFragmentFatalException(
+                        sc, range_str, self._get_response_request_id(response))
+
+            if not retry_policy.should_retry(error_class, attempt):
+                self._logger.error(
+                    'Reached retry limit for range %s (attempt %s, %s). '
+                    'Failing upload. Retry metrics: %s' %
+                    (range_str, attempt, error_class.value,
+                     retry_policy.metrics()))
+                raise UploadRetriesExhaustedException(
+                    range_str, error_class, last_error)
+            delay = retry_policy.backoff(error_class, attempt, retry_after)
+            self._logger.debug(
+                'Failure: attempt#%s to upload data in range %s failed '
+                '(%s: %s). Retrying in %.2f seconds.' %
+                (attempt, range_str, error_class.value, last_error, delay))
+            time.sleep(delay)
 
     def download_from_uri(self,
                           uri,
@@ -15,6 +15,11 @@
 
 # August 2, 2025 - Doug Baer updated upload_ovf() bewcause using OVA is terribly inefficient.
 
+# October 2026 - _upload_part_file() shares one UploadRetryPolicy (retry budget + metrics) per file
+
+# October 2026 - upload_ovf() split into create_ovf_upload() + upload_stream() so that a descriptor and file
+#   contents can be uploaded from memory (hol-xfer relay mode)
+
 # August 4, 2025 - Doug Baer working on _download_ovf() (again, the whole OVA process is NOT efficient: there is no need to TAR the output)
 
 
@@ -756,32 +761,13 @@ class Org(object):
                 }
                 files_to_upload.append(source_file)
 
-            params = E.UploadVAppTemplateParams(name=item_name)
-            params.append(E.Description(description))
-            catalog_item_resource = self.client.post_linked_resource(
-                catalog_resource, RelationType.ADD,
-                EntityType.UPLOAD_VAPP_TEMPLATE_PARAMS.value, params)
-
-            entity_href = catalog_item_resource.Entity.get('href')
-            entity_resource = self.client.get_resource(entity_href)
-            ovf_upload_href = entity_resource.Files.File.Link.get('href')
-            self.client.put_resource(ovf_upload_href, ovf_resource,
-                                     EntityType.TEXT_XML.value)
-
-            while True:
-                time.sleep(5)
-                entity_resource = self.client.get_resource(entity_href)
-                if len(entity_resource.Files.File) > 1:
-                    break
+            upload_uris = self._create_ovf_upload(
+                catalog_resource, ovf_resource, item_name, description)
 
             for source_file in files_to_upload:
                 source_file_name = source_file.get('href')
                 source_file_size = source_file.get('size')
-                target_uri = None
-                for target_file in entity_resource.Files.File:
-                    if source_file_name == target_file.get('name'):
-                        target_uri = target_file.Link.get('href')
-                        break
+                target_uri = upload_uris.get(source_file_name)
                 if target_uri is None:
                     raise UploadException('Couldn\'t find uri to upload'
                                           ' file %s' % source_file_name)
@@ -806,6 +792,124 @@ class Org(object):
 
         return total_bytes_uploaded
 
+    def create_ovf_upload(self,
+                          catalog_name,
+                          ovf_resource,
+                          item_name,
+                          description=''):
+        """Create a catalog item from an ovf descriptor and get its upload uris.
+
+        The descriptor is uploaded; the files it references are not. Upload
+        them with upload_stream() (or a PUT per range) to the returned uris.
+
+        :param str catalog_name: name of the catalog where the template will
+            be created.
+        :param ovf_resource: the ovf descriptor, as bytes or as a parsed
+            lxml tree.
+        :param str item_name: name of the new catalog item.
+        :param str description: description of the new catalog item.
+
+        :return: upload uri of each file, keyed by the file's href in the
+            descriptor.
+
+        :rtype: dict
+
+        :raises: EntityNotFoundException: if the catalog is not found.
+        :raises: InternalServerException: if item already exists in catalog.
+        """
+        catalog_resource = self.get_catalog(catalog_name)
+        if isinstance(ovf_resource, bytes):
+            ovf_resource = objectify.fromstring(ovf_resource)
+        return self._create_ovf_upload(catalog_resource, ovf_resource,
+                                       item_name, description)
+
+    def _create_ovf_upload(self, catalog_resource, ovf_resource, item_name,
+                           description):
+        params = E.UploadVAppTemplateParams(name=item_name)
+        params.append(E.Description(description))
+        catalog_item_resource = self.client.post_linked_resource(
+            catalog_resource, RelationType.ADD,
+            EntityType.UPLOAD_VAPP_TEMPLATE_PARAMS.value, params)
+
+        entity_href = catalog_item_resource.Entity.get('href')
+        entity_resource = self.client.get_resource(entity_href)
+        ovf_upload_href = entity_resource.Files.File.Link.get('href')
+        self.client.put_resource(ovf_upload_href, ovf_resource,
+                                 EntityType.TEXT_XML.value)
+
+        while True:
+            time.sleep(5)
+            entity_resource = self.client.get_resource(entity_href)
+            if len(entity_resource.Files.File) > 1:
+                break
+
+        return {
+            target_file.get('name'): target_file.Link.get('href')
+            for target_file in entity_resource.Files.File
+        }
+
+    def upload_stream(self,
+                      fragments,
+                      target_uri,
+                      total_file_size,
+                      name=None,
+                      offset=0,
+                      callback=None):
+        """Upload a file to a transfer uri from an iterable of byte strings.
+
+        Each item is sent as one range, so the size of the items is the
+        upload chunk size.
+
+        :param fragments: iterable of bytes, the file contents in order.
+        :param str target_uri: uri where the contents will be uploaded to.
+        :param int total_file_size: size of the whole file.
+        :param str name: name of the file, for the retry metrics.
+        :param int offset: number of bytes to skip on the target uri.
+        :param function callback: a function with signature
+            function(bytes_written, total_size) to let the caller monitor
+            progress of the upload operation.
+
+        :return: number of bytes uploaded to the uri.
+
+        :rtype: int
+        """
+        uploaded_bytes = 0
+        retry_policy = self.client.new_upload_retry_policy()
+        for data in fragments:
+            data_size = len(data)
+            if data_size == 0:
+                continue
+            range_str = 'bytes %s-%s/%s' % \
+                        (offset + uploaded_bytes,
+                         offset + uploaded_bytes + data_size - 1,
+                         total_file_size)
+            response = self.client.upload_fragment(
+                target_uri, data, range_str, retry_policy)
+            uploaded_bytes += data_size
+            if callback is not None:
+                callback(offset + uploaded_bytes, total_file_size)
+
+            # We can hit an issue similar to the following issue
+            # https://github.com/requests/requests/issues/4664
+            #
+            # Our uploads would fail with the error message,
+            #
+            # urllib3.exceptions.ProtocolError: ('Connection aborted.',
+            # ConnectionResetError(10054, 'An existing connection was
+            # forcibly closed by the remote host', None, 10054, None))
+            #
+            # This error is probably caused by request lib reusing
+            # keep-alive connections that were marked as closed by the
+            # server. As a workaround for this, we will wait 1 second
+            # after issuing the PUT call if the connection is closed by
+            # the server. Spacing out the requests seems to help
+            # requests lib with pruning dead keep-alive connections.
+            if self.client.is_connection_closed(response):
+                time.sleep(1)
+        self.client.report_upload_retry_metrics(
+            name or target_uri, retry_policy)
+        return uploaded_bytes
+
     def upload_ova(self,
                    catalog_name,
                    file_name,
@@ -874,32 +978,13 @@ class Org(object):
                 }
                 files_to_upload.append(source_file)
 
-            params = E.UploadVAppTemplateParams(name=item_name)
-            params.append(E.Description(description))
-            catalog_item_resource = self.client.post_linked_resource(
-                catalog_resource, RelationType.ADD,
-                EntityType.UPLOAD_VAPP_TEMPLATE_PARAMS.value, params)
-
-            entity_href = catalog_item_resource.Entity.get('href')
-            entity_resource = self.client.get_resource(entity_href)
-            ovf_upload_href = entity_resource.Files.File.Link.get('href')
-            self.client.put_resource(ovf_upload_href, ovf_resource,
-                                     EntityType.TEXT_XML.value)
-
-            while True:
-                time.sleep(5)
-                entity_resource = self.client.get_resource(entity_href)
-                if len(entity_resource.Files.File) > 1:
-                    break
+            upload_uris = self._create_ovf_upload(
+                catalog_resource, ovf_resource, item_name, description)
 
             for source_file in files_to_upload:
                 source_file_name = source_file.get('href')
                 source_file_size = source_file.get('size')
-                target_uri = None
-                for target_file in entity_resource.Files.File:
-                    if source_file_name == target_file.get('name'):
-                        target_uri = target_file.Link.get('href')
-                        break
+                target_uri = upload_uris.get(source_file_name)
                 if target_uri is None:
                     raise UploadException('Couldn\'t find uri to upload'
                                           ' file %s' % source_file_name)
@@ -1049,40 +1134,21 @@ class Org(object):
         part_file_size = stat_info.st_size
         if total_file_size is None:
             total_file_size = part_file_size
-        uploaded_bytes = 0
+
+        def read_chunks(f):
+            remaining = part_file_size
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
 
         with open(part_file_path, 'rb') as f:
-            while uploaded_bytes < part_file_size:
-                data = f.read(chunk_size)
-                data_size = len(data)
-                if data_size <= chunk_size:
-                    range_str = 'bytes %s-%s/%s' % \
-                                (offset + uploaded_bytes,
-                                 offset + uploaded_bytes + data_size - 1,
-                                 total_file_size)
-                    response = self.client.upload_fragment(
-                        target_uri, data, range_str)
-                    uploaded_bytes += data_size
-                    if callback is not None:
-                        callback(offset + uploaded_bytes, total_file_size)
-
-                    # We can hit an issue similar to the following issue
-                    # https://github.com/requests/requests/issues/4664
-                    #
-                    # Our uploads would fail with the error message,
-                    #
-                    # urllib3.exceptions.ProtocolError: ('Connection aborted.',
-                    # ConnectionResetError(10054, 'An existing connection was
-                    # forcibly closed by the remote host', None, 10054, None))
-                    #
-                    # This error is probably caused by request lib reusing
-                    # keep-alive connections that were marked as closed by the
-                    # server. As a workaround for this, we will wait 1 second
-                    # after issuing the PUT call if the connection is closed by
-                    # the server. Spacing out the requests seems to help
-                    # requests lib with pruning dead keep-alive connections.
-                    if self.client.is_connection_closed(response):
-                        time.sleep(1)
+            uploaded_bytes = self.upload_stream(
+                read_chunks(f), target_uri, total_file_size,
+                name=os.path.basename(part_file_path), offset=offset,
+                callback=callback)
         return uploaded_bytes
 
     def capture_vapp(self,